@@ -15,10 +15,10 @@ from multiprocessing import Pool, Process, Value
 from concurrent.futures import ProcessPoolExecutor
 import logging
 from multiprocessing import Manager
-from utils_llm import get_commercial_model, prompt_commercial_model
 import pandas as pd
 from manager import get_manager
 from utils import patch_jpype
+from jvm_service import call
 
 
 logging.basicConfig(
@@ -34,22 +34,20 @@ class JmhQualityResponse(TypedDict):
     distinct_calls: int
 
 
-def evaluate(code: str) -> JmhQualityResponse:
-    from de.fraunhofer.fokus import JmhQualityAnalyzer
-
+def evaluate(code: str, src_dirs: List[Path]) -> List[JmhQualityResponse]:
     try:
-        method_to_features = JmhQualityAnalyzer.evaluate(code)
+        method_to_features = call('evaluate_quality', code=code, src_dirs=[str(x.resolve()) for x in src_dirs])
     except Exception as ex:
         return None
 
     return method_to_features
 
 def evaluate_wrapper(_args):
-    file, jmh_dir = _args
+    file, jmh_dir, src_dirs = _args
     logging.info(f"Processing file {str(file)}")
     class_name = str(file.relative_to(jmh_dir).with_suffix("")).replace('/', '.')
     code = file.read_text()
-    method_to_features = evaluate(code)
+    method_to_features = evaluate(code, src_dirs)
     if method_to_features is None:
         return
 
@@ -60,7 +58,6 @@ def main(args):
     mgr = get_manager(args.project, branch)
     jmh_dir = mgr.jmh_dir
 
-    from de.fraunhofer.fokus import JmhQualityAnalyzer
     jmh_files = [x for x in jmh_dir.rglob('*.java')]
     saved_coverage_dir = mgr.save_coverage_dir
     trial_thrpts_files = [x for x in saved_coverage_dir.rglob('*.json')]
@@ -82,7 +79,7 @@ def main(args):
 
         code = file.read_text()
         try:
-            method_to_features = JmhQualityAnalyzer.evaluate(code, [str(x) for x in mgr.src_dirs])
+            method_to_features = call('evaluate_quality', code=code, src_dirs=[str(x.resolve()) for x in mgr.src_dirs])
         except Exception as ex:
             logging.warning(f'Fail to process file: {str(file)}, exception: {str(ex)}')
             failed_to_process += 1
@@ -93,7 +90,7 @@ def main(args):
             failed_method_features += 1
             continue
 
-        method_features = json.loads(str(method_to_features))
+        method_features = method_to_features
         for features in method_features:
             method = features['name']
             full_name = f'{class_name}.{method}'
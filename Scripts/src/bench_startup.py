@@ -0,0 +1,97 @@
+import re
+import sys
+import json
+import statistics
+import subprocess
+from typing import List, Dict, Any, Optional
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+SRC_DIR = Path(__file__).parent
+# NOTE: modules whose import cost the lazy provider registry is meant to avoid
+HEAVY_MODULES = ['openai', 'anthropic', 'google.generativeai', 'PIL', 'jpype', 'pandas', 'numpy']
+
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def entry_points() -> List[str]:
+    """Every script of src/ runnable as `python src/<script>.py`."""
+    modules = []
+    for path in sorted(SRC_DIR.glob('*.py')):
+        with open(path, 'r') as fd:
+            if re.search(r'^if __name__\s*==', fd.read(), re.MULTILINE):
+                modules.append(path.stem)
+    return [x for x in modules if x != Path(__file__).stem]
+
+
+def measure(module: str, repeat: int) -> Dict[str, Any]:
+    """Import `module` in `repeat` fresh interpreters, the interpreter start itself is not counted."""
+    samples = []
+    loaded: List[str] = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                              cwd=str(SRC_DIR), capture_output=True, text=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit code {proc.returncode}'
+            return {'module': module, 'error': error}
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        samples.append(result['seconds'])
+        loaded = result['loaded']
+    return {
+        'module': module,
+        'median_ms': round(statistics.median(samples) * 1000, 1),
+        'min_ms': round(min(samples) * 1000, 1),
+        'heavy_modules': loaded,
+    }
+
+
+def main(args):
+    modules = args.modules or entry_points()
+    baseline: Dict[str, Any] = {}
+    if args.baseline is not None and Path(args.baseline).exists():
+        with open(args.baseline, 'r') as fd:
+            baseline = {x['module']: x for x in json.load(fd)}
+
+    report = []
+    for module in modules:
+        result = measure(module, args.repeat)
+        before: Optional[Dict[str, Any]] = baseline.get(module)
+        if before is not None and 'median_ms' in before and 'median_ms' in result:
+            result['baseline_ms'] = before['median_ms']
+        report.append(result)
+
+    print(f"{'script':<32} {'median ms':>10} {'baseline':>10}  heavy modules / error")
+    for x in report:
+        if 'error' in x:
+            print(f"{x['module']:<32} {'-':>10} {'-':>10}  {x['error']}")
+            continue
+        print(f"{x['module']:<32} {x['median_ms']:>10} {str(x.get('baseline_ms', '-')):>10}  {', '.join(x['heavy_modules'])}")
+
+    if args.output is not None:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2)
+        logging.info(f"Saved startup times into {args.output}")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs='*', default=None, help='entry points to measure, all scripts by default')
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", type=str, default=None, help='json of an earlier run to compare with')
+    parser.add_argument("--output", type=str, default='results/startup-times.json')
+    args = parser.parse_args()
+
+    main(args)
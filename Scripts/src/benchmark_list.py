@@ -0,0 +1,135 @@
+import json
+import hashlib
+import zipfile
+from typing import List, Dict, Optional, TypedDict, Any
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+BENCHMARK_LIST = 'META-INF/BenchmarkList'
+CACHE_DIR = Path('./tmp/benchmark-lists')
+
+# NOTE: field order of BenchmarkListEntry.toLine, values we do not need are parsed and dropped
+FIELDS = [
+    'user_class', 'generated_class', 'method', 'mode', 'threads', 'thread_groups', 'thread_group_labels',
+    'warmup_iterations', 'warmup_time', 'warmup_batch_size', 'measurement_iterations', 'measurement_time',
+    'measurement_batch_size', 'forks', 'warmup_forks', 'jvm', 'jvm_args', 'jvm_args_prepend', 'jvm_args_append',
+    'params', 'time_unit', 'ops_per_invocation', 'timeout',
+]
+
+
+class BenchmarkEntry(TypedDict):
+    # NOTE: <user class>.<method>, the name `java -jar benchmarks.jar -l` prints
+    name: str
+    mode: str
+    params: Optional[Dict[str, List[str]]]
+
+
+class _LineReader:
+    """
+    Reader of one BenchmarkList line: `JMH ` followed by tagged values, each scalar written as `<length> <chars> `.
+    """
+
+    def __init__(self, line: str):
+        self.line = line
+        self.pos = 0
+
+    def expect(self, text: str):
+        if not self.line.startswith(text, self.pos):
+            raise ValueError(f'Expected {text!r} at {self.pos} of {self.line[:80]!r}')
+        self.pos += len(text)
+
+    def tag(self) -> str:
+        tag = self.line[self.pos]
+        self.pos += 2
+        return tag
+
+    def scalar(self) -> str:
+        end = self.line.index(' ', self.pos)
+        length = int(self.line[self.pos:end])
+        value = self.line[end + 1:end + 1 + length]
+        self.pos = end + 2 + length
+        return value
+
+    def value(self) -> Any:
+        tag = self.tag()
+        if tag == 'E':
+            return None
+        if tag in ('S', 'T', 'U'):
+            return self.scalar()
+        if tag == 'I':
+            return int(self.scalar())
+        if tag == 'A':
+            return [int(self.scalar()) for _ in range(int(self.scalar()))]
+        if tag == 'L':
+            return [self.scalar() for _ in range(int(self.scalar()))]
+        if tag == 'M':
+            params = {}
+            for _ in range(int(self.scalar())):
+                key = self.scalar()
+                params[key] = [self.scalar() for _ in range(int(self.scalar()))]
+            return params
+        raise ValueError(f'Unknown tag {tag!r} at {self.pos} of {self.line[:80]!r}')
+
+
+def parse_benchmark_list(content: str) -> List[BenchmarkEntry]:
+    entries = []
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        reader = _LineReader(line)
+        reader.expect('JMH ')
+        fields: Dict[str, Any] = {}
+        # NOTE: older JMH versions write fewer trailing fields
+        for field in FIELDS:
+            if reader.pos >= len(line.rstrip()):
+                break
+            fields[field] = reader.value()
+        entries.append(BenchmarkEntry(name=f"{fields['user_class']}.{fields['method']}", mode=fields['mode'],
+                                      params=fields.get('params')))
+    return entries
+
+
+def jar_digest(jar_path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(jar_path, 'rb') as fd:
+        for block in iter(lambda: fd.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_benchmark_list(jar_path: Path, cache_dir: Path = CACHE_DIR) -> List[BenchmarkEntry]:
+    """
+    The benchmarks of a JMH jar from its META-INF/BenchmarkList, without starting a JVM. Results are cached
+    by the sha256 of the jar, so a rebuilt jar is read again. Raises ValueError for an unknown format.
+    """
+    cache_path = cache_dir / f'{jar_digest(jar_path)}.json'
+    if cache_path.exists():
+        with open(cache_path, 'r') as fd:
+            return json.load(fd)
+
+    with zipfile.ZipFile(jar_path, 'r') as jar:
+        try:
+            content = jar.read(BENCHMARK_LIST).decode('utf-8')
+        except KeyError:
+            raise ValueError(f'No {BENCHMARK_LIST} in {jar_path}')
+    entries = parse_benchmark_list(content)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as fd:
+        json.dump(entries, fd, indent=2)
+    tmp_path.replace(cache_path)
+    return entries
+
+
+def benchmark_names(entries: List[BenchmarkEntry], package: Optional[str] = None) -> List[str]:
+    """Unique benchmark names, one per method like `-l` prints them, optionally only those in `package`."""
+    names = {x['name'] for x in entries}
+    if package is not None:
+        names = {x for x in names if x.startswith(f'{package}.')}
+    return sorted(names)
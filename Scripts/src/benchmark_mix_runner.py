@@ -1,5 +1,5 @@
 import platform
-from typing import List, Optional
+from typing import List, Dict, Optional
 import sys
 import argparse
 import subprocess
@@ -11,14 +11,21 @@ import zipfile
 from collections import Counter
 import re
 import json
-import pandas as pd
+import math
+import signal
+import heapq
+import shlex
 from multiprocessing import Pool, Process, Manager as ProcessManager
 from multiprocessing.managers import SyncManager
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
 
 from utils import *
 from manager import get_manager
+from coverage_index import CoverageIndex
+from incremental_build import base_branch_of
+from benchmark_list import read_benchmark_list
+from jmh_smoke import run_smoke
 
 # Configure the logging system
 logging.basicConfig(
@@ -26,6 +33,14 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# NOTE: one fork, 5 x 500ms warmup and 30 x 1s measurement iterations for every benchmark method
+JMH_OPTS = '-f 1 -wi 5 -w 500ms -i 30 -r 1000ms -rf json -tu s -bm thrpt -gc true'
+# NOTE: expected seconds of one fork of one parameter combination, iterations plus boot of the forked JVM
+FORK_SECONDS = 5 * 0.5 + 30 * 1.0 + 3.0
+# NOTE: a group is killed once it runs this many times longer than expected, plus the boot of the host JVM
+GROUP_TIMEOUT_FACTOR = 3
+GROUP_TIMEOUT_SLACK = 300
+
 
 def run_jmh_method_wrapper(args):
     cmd, method, benchmark_dir, cpu_queue = args
@@ -42,9 +57,30 @@ def run_jmh_method_wrapper(args):
     cpu_queue.put(cpus)
 
 
-def run_jmh_method(cmd: str):
+def run_jmh_group_wrapper(args):
+    cmd, methods, group_res, benchmark_dir, cpu_queue, timeout, method_cmds = args
+    cpus = cpu_queue.get()
+    if platform.system() == 'Linux':
+        cmd = taskset_wrapper(cmd, cpus)
+    run_jmh_method(cmd, timeout)
+    cpu_queue.put(cpus)
+
+    # NOTE: JMH writes the result file at the end only, without it the host JVM died or timed out
+    completed = group_res.exists() and group_res.stat().st_size > 0
+    missing = split_group_results(group_res, methods, benchmark_dir)
+    if len(missing) == 0:
+        return
+    if completed:
+        # NOTE: their own forks failed, a single method run would fail the same way
+        logging.error(f"No result for {len(missing)}/{len(methods)} benchmark methods of group {group_res}: {missing}")
+        return
+    logging.error(f"Group {group_res} finished without results, re-running its {len(missing)} benchmark methods one by one")
+    for method in missing:
+        run_jmh_method_wrapper((method_cmds[method], method, benchmark_dir, cpu_queue))
+
+
+def run_jmh_method(cmd: str, timeout: float = 86400):
     logging.info(f"> Run command: {cmd}")
-    timeout = 86400
     try:
         proc = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
         # NOTE: attach it to cgroup if needed
@@ -60,41 +96,113 @@ def run_jmh_method(cmd: str):
             logging.info(f"Command '{cmd}' finished successfully.")
     except subprocess.TimeoutExpired:
         logging.error(f"Command '{cmd}' timed out after {timeout} seconds.")
-        proc.kill()
+        # NOTE: the shell runs in its own session, kill the JVMs it started as well
+        os.killpg(proc.pid, signal.SIGKILL)
     except Exception as ex:
         logging.error(f'Command: {cmd}, unknown error: {str(ex)}')
 
-def extract_methods_to_run(methods: List[str], branch: str, common_methods_path: Optional[Path]) -> List[str]:
-    if common_methods_path is None:
+def jmh_method_cmd(jvm_opts: str, jar_path: Path, benchmark_dir: Path, method: str) -> str:
+    benchmark_res = benchmark_dir / f'{method}.json'
+    return f'java {jvm_opts} -jar {jar_path.resolve()} {JMH_OPTS} -rff {str(benchmark_res)} {method}'
+
+def extract_methods_to_run(methods: List[str], branch: str, index: Optional[CoverageIndex]) -> List[str]:
+    """
+    Benchmarks of an injected branch (`<base>_<bug>_<method>_<line>`) which execute the mutated method according
+    to the coverage of its base branch. Other branches, or runs without an index, keep all benchmarks.
+    """
+    if index is None:
         return methods
 
     splits = branch.split('_')
     if len(splits) == 4:
         base, bug, method, line = splits
-        method = method.replace('-', '$')
-        line = int(line)
     elif len(splits) == 1:
         # NOTE: I prefer running all common methods
-        # base = splits[0]
-        # method = "*"
-        # line = -1
         return methods
     else:
         raise Exception(f"Unknown branch {branch}")
 
-    df = pd.read_csv(str(common_methods_path))
-    all_benchmarks = []
-    for _, row in df.iterrows():
-        method_line = eval(row['method'])
-        if method == '*':
-            benchmarks = row[base].split('|')
-            all_benchmarks.extend(benchmarks)
-        elif method_line[0] == method and method_line[1] == line:
-            benchmarks = row[base].split('|')
-            all_benchmarks.extend(benchmarks)
-            break
+    covering = set(index.benchmarks_for(method, int(line), [base]))
+    selected = [x for x in methods if x in covering]
+    logging.info(f"{len(selected)}/{len(methods)} benchmarks of {base} reach {method}:{line}")
+    return selected
+
+
+def expected_seconds(jar_path: Path, methods: List[str]) -> Dict[str, float]:
+    """Expected runtime of each benchmark method with `JMH_OPTS`, one fork per parameter combination."""
+    combinations = {}
+    try:
+        for entry in read_benchmark_list(jar_path):
+            params = entry['params'] or {}
+            combinations[entry['name']] = math.prod(len(x) for x in params.values())
+    except Exception as ex:
+        logging.error(f"Fail to read the parameters of {jar_path}, assume one combination per method, ex: {str(ex)}")
+    return {x: combinations.get(x, 1) * FORK_SECONDS for x in methods}
+
+
+def group_benchmark_methods(seconds: Dict[str, float], group_seconds: float, max_group_size: int) -> List[List[str]]:
+    """
+    Pack benchmark methods into groups of about `group_seconds` expected runtime and at most `max_group_size`
+    methods. The longest methods are placed first, each into the group with the least runtime so far.
+    """
+    if len(seconds) == 0:
+        return []
+    n_groups = max(math.ceil(sum(seconds.values()) / group_seconds), math.ceil(len(seconds) / max_group_size))
+    n_groups = min(n_groups, len(seconds))
+    heap = [(0.0, i) for i in range(n_groups)]
+    groups: List[List[str]] = [[] for _ in range(n_groups)]
+    for method in sorted(seconds, key=lambda x: (-seconds[x], x)):
+        total, i = heapq.heappop(heap)
+        groups[i].append(method)
+        # NOTE: a full group is not pushed back, no more methods go into it
+        if len(groups[i]) < max_group_size:
+            heapq.heappush(heap, (total + seconds[method], i))
+    return [sorted(x) for x in groups if len(x) > 0]
+
+
+def split_group_results(group_res: Path, methods: List[str], benchmark_dir: Path) -> List[str]:
+    """
+    Write the entries of each method in a grouped JMH json result into `<method>.json`, the file a single
+    method run writes. Returns the methods without any result, e.g. crashed forks.
+    """
+    if not group_res.exists() or group_res.stat().st_size == 0:
+        return methods
+    with open(group_res, 'r') as fd:
+        results = json.load(fd)
 
-    return all_benchmarks
+    method_to_results = defaultdict(list)
+    for result in results:
+        method_to_results[result['benchmark']].append(result)
+    for method, entries in method_to_results.items():
+        if method not in methods:
+            continue
+        # NOTE: write then rename, an interrupted split never leaves a partial result to be skipped later
+        tmp_path = benchmark_dir / f'{method}.json.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(entries, fd, indent=4)
+        tmp_path.replace(benchmark_dir / f'{method}.json')
+    group_res.unlink()
+    return [x for x in methods if x not in method_to_results]
+
+
+def smoke_benchmark_methods(jar_path: Path, methods: List[str], batch_size: int, benchmark_timeout: float,
+                            jobs: int) -> Dict[str, str]:
+    """
+    Run every method once in a few shared JVMs before measuring, `batch_size` methods per JVM and `jobs` JVMs at a time.
+    Returns the crashing or hanging methods with the runtime error message of `runtime-errors.json`.
+    """
+    batches = [methods[i:i + batch_size] for i in range(0, len(methods), batch_size)]
+
+    def smoke(batch: List[str]) -> Dict[str, str]:
+        include = '^(' + '|'.join(re.escape(x) for x in batch) + ')$'
+        return run_smoke([str(jar_path.resolve())], include, benchmark_timeout, jvm_args=['-Djmh.ignoreLock=true'])
+
+    failures: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for batch_failures in executor.map(smoke, batches):
+            failures.update(batch_failures)
+    # NOTE: keep only benchmark methods, a batch matching nothing is reported by its include pattern
+    return {k: v for k, v in failures.items() if k in methods}
 
 
 def main(args):
@@ -104,12 +212,22 @@ def main(args):
     # mgr = get_manager(args.project, branch)
 
     cpu_queue = get_cpu_queue()
+    bases = sorted({base_branch_of(x) for x in branches if base_branch_of(x) is not None})
+    index = None
+    if args.select_by_coverage:
+        index = CoverageIndex.load(project, bases)
+    # NOTE: injected branches are patched from the jar of their base branch, build each base once up front
+    for base in bases:
+        get_manager(project, base).compile_if_needed(base)
+    # NOTE: every branch is built in its own worktree, so the builds can run side by side
+    with ThreadPoolExecutor(max_workers=args.build_jobs) as executor:
+        branch_to_jar = dict(zip(branches, executor.map(lambda x: branch_to_mgr[x].compile_if_needed(x), branches)))
+
     # branch_to_args_list = {}
     args_list = []
     for branch, mgr in branch_to_mgr.items():
         benchmark_dir = mgr.save_benchmark_dir
-        mgr.compile_if_needed(branch)
-        jar_path = Path(f'./tmp/{mgr.cwd}/{branch}') / mgr.jar_path.name
+        jar_path = branch_to_jar[branch]
 
         methods = mgr.list_benchmark_methods(jar_path)
         logging.info(f"Listing benchmark methods {len(methods)}")
@@ -120,29 +238,58 @@ def main(args):
         if args.benchmark is not None:
             methods = [x for x in methods if x in args.benchmark]
         else:
-            methods = extract_methods_to_run(methods, branch, Path(args.common_methods_path) if args.common_methods_path else None)
+            methods = extract_methods_to_run(methods, branch, index)
+
+        if args.smoke:
+            logging.info(f"Smoke running {len(methods)} benchmark methods of {branch}")
+            runtime_errors = smoke_benchmark_methods(jar_path, methods, args.smoke_batch, args.smoke_timeout, cpu_queue.qsize())
+            runtime_errors_path = Path(args.runtime_errors) if args.runtime_errors else benchmark_dir / 'runtime-errors.json'
+            runtime_errors_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(runtime_errors_path, 'w') as fd:
+                json.dump(runtime_errors, fd, indent=2, sort_keys=True)
+            logging.info(f"{len(runtime_errors)} benchmark methods crashed in the smoke run, saved into {runtime_errors_path}")
+            methods = [x for x in methods if x not in runtime_errors]
 
         jvm_opts = "-Djmh.ignoreLock=true -Xms1g -Xmx8g"
+        if args.group:
+            # NOTE: JMH still forks a fresh JVM per benchmark, the group only shares the host JVM and harness setup
+            done = [x for x in methods if (benchmark_dir / f'{x}.json').exists() and (benchmark_dir / f'{x}.json').stat().st_size > 0]
+            methods = [x for x in methods if x not in done]
+            logging.info(f"Skip {len(done)} existed results of {branch}")
+            seconds = expected_seconds(jar_path, methods)
+            groups = group_benchmark_methods(seconds, args.group_seconds, args.group_size)
+            group_dir = Path('./tmp/jmh-groups') / project / branch
+            group_dir.mkdir(parents=True, exist_ok=True)
+            for i, group in enumerate(groups):
+                group_res = group_dir / f'{i:04d}.json'
+                include = '^(' + '|'.join(re.escape(x) for x in group) + ')$'
+                cmd = f'java {jvm_opts} -jar {jar_path.resolve()} {JMH_OPTS} -rff {str(group_res)} {shlex.quote(include)}'
+                timeout = GROUP_TIMEOUT_FACTOR * sum(seconds[x] for x in group) + GROUP_TIMEOUT_SLACK
+                method_cmds = {x: jmh_method_cmd(jvm_opts, jar_path, benchmark_dir, x) for x in group}
+                args_list.append((cmd, group, group_res, benchmark_dir, cpu_queue, timeout, method_cmds))
+            logging.info(f"Packed {len(methods)} benchmark methods of {branch} into {len(groups)} groups")
+            continue
+
         for method in methods:
-            benchmark_res = benchmark_dir / f'{method}.json'
-            cmd = f'java {jvm_opts} -jar {jar_path.resolve()} -f 1 -wi 5 -w 500ms -i 30 -r 1000ms -rf json -tu s -bm thrpt -gc true -rff {str(benchmark_res)} {method}'
+            cmd = jmh_method_cmd(jvm_opts, jar_path, benchmark_dir, method)
             _args = (cmd, method, benchmark_dir, cpu_queue)
             args_list.append(_args)
 
         # branch_to_args_list[branch] = args_list
 
     # ##############################################
+    run_wrapper = run_jmh_group_wrapper if args.group else run_jmh_method_wrapper
     if args.parallel:
         with ProcessPoolExecutor(max_workers=cpu_queue.qsize()) as executor:
             futures = []
             for _args in args_list:
-                futures.append(executor.submit(run_jmh_method_wrapper, _args))
+                futures.append(executor.submit(run_wrapper, _args))
 
             for f in futures:
                 f.result()  # Wait for all to complete
     else:
         for _args in args_list:
-            run_jmh_method_wrapper(_args)
+            run_wrapper(_args)
 
 
 if __name__ == "__main__":
@@ -151,7 +298,15 @@ if __name__ == "__main__":
     parser.add_argument("--branch", action="append")
     parser.add_argument("--parallel", action="store_true")
     parser.add_argument("--benchmark", action='append', help='run specific benchmark method')
-    parser.add_argument('--common_methods_path', type=str)
+    parser.add_argument("--select_by_coverage", action='store_true', help='run only the benchmarks reaching the mutated method of injected branches')
+    parser.add_argument("--build_jobs", type=int, default=1, help='branches built at the same time')
+    parser.add_argument("--smoke", action='store_true', help='smoke run the benchmarks first and skip the crashing ones')
+    parser.add_argument("--smoke_batch", type=int, default=200, help='benchmark methods sharing one smoke JVM')
+    parser.add_argument("--smoke_timeout", type=float, default=30.0, help='seconds one benchmark may take in the smoke run')
+    parser.add_argument("--runtime_errors", type=str, default=None, help='where to save the smoke failures, the benchmark dir by default')
+    parser.add_argument("--group", action='store_true', help='run several benchmark methods in one JMH invocation per cpu slot')
+    parser.add_argument("--group_seconds", type=float, default=1800.0, help='expected runtime of one group')
+    parser.add_argument("--group_size", type=int, default=50, help='benchmark methods of one group at most')
     args = parser.parse_args()
 
     main(args)
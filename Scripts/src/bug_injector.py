@@ -1,6 +1,6 @@
 import os
 import platform
-from typing import List, Tuple, TypedDict
+from typing import List, Dict, Tuple, TypedDict, Any
 import sys
 import shutil
 import argparse
@@ -9,14 +9,16 @@ import os
 from pathlib import Path
 import re
 import json
+from collections import defaultdict
 from multiprocessing import Pool, Process, Value
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
-from multiprocessing import Manager
-from utils_llm import get_commercial_model, prompt_commercial_model
-import pandas as pd
-from manager import get_manager
+from manager import get_manager, Manager
 from utils import patch_jpype
+from jvm_service import call, call_batch, start_jvm
+from patches import apply_patch
+from coverage_index import CoverageIndex, coverage_files
+from equivalent_mutants import find_equivalent_mutants
 
 
 logging.basicConfig(
@@ -25,16 +27,16 @@ logging.basicConfig(
 )
 
 
+BUG_TYPES = ['HWO', 'PTW', 'STS', 'EFL', 'SOC']
+
+
 class MutationResponse(TypedDict):
     mutated_code: str
     injected_bugs: int
 
 
 def mutate(code: str, method: str, line: int, bug: str, max_injected_bugs: int = 1) -> MutationResponse:
-    from de.fraunhofer.fokus import PerformanceMutator
-    result = PerformanceMutator.mutate(code, method, line, bug.upper(), max_injected_bugs)
-    res = json.loads(str(result))
-    return res
+    return call('mutate', code=code, method=method, line=line, bug=bug, max_injected_bugs=max_injected_bugs)
 
 
 # def extract_java_info(source_code: str):
@@ -111,6 +113,8 @@ def debug():
     # 5. Sample code to mutate
     # PerformanceMutator = jpype.JClass("de.fraunhofer.fokus.PerformanceMutator")
     # PerformanceMutator = jpype.JClass("de.fraunhofer.fokus.PerformanceMutator")
+    # NOTE: debug always uses the in-process JVM
+    start_jvm()
     from de.fraunhofer.fokus import PerformanceMutator
     method_code = """
 public long compute(List<Integer> nums, long total) {
@@ -260,74 +264,149 @@ public class Dummy {{
     # print(f"> injected bugs: {injected_bugs}")
 
 
+class MutantPatch(TypedDict):
+    method: str
+    line: int
+    bug: str
+    path: str
+    base: str
+    # NOTE: unified diff of `path` at `base`, see patches.py
+    patch: str
+
+
+def save_mutants(path: Path, mutants: Dict[str, MutantPatch]):
+    """Merge the mutants into the store of their base branch, keyed by mutant branch."""
+    stored = {}
+    if path.exists():
+        with open(path, 'r') as fd:
+            stored = json.load(fd)
+    stored.update(mutants)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as fd:
+        json.dump(stored, fd, indent=2, sort_keys=True)
+
+
+class MutantJob(TypedDict):
+    method: str
+    line: int
+    bug: str
+    branch: str
+    path: str
+
+
+def plan_mutants(mgr: Manager, from_branch: str, selected_methods: List[List[Any]], bugs: List[str],
+                 force: bool) -> List[MutantJob]:
+    """One job per (method, bug) pair whose branch does not exist yet, with the source file of the method."""
+    src_roots = [str(x.relative_to(mgr.cwd)) for x in mgr.src_dirs]
+    files = mgr.list_files(from_branch, src_roots)
+    existing = set(mgr.run_cmd("git for-each-ref --format='%(refname:short)' refs/heads").stdout.split())
+    jobs = []
+    # NOTE: rows of injection_strategy.py are (method, line, jmh, ju2jmh, llm2jmh)
+    for selected_method in selected_methods:
+        method, line = selected_method[0], selected_method[1]
+        if '$' in method:
+            method = method.replace('$', '-')
+        cls_name = '/'.join(method.split('.')[:-1]).split('-')[0]
+        path = next((f'{root}/{cls_name}.java' for root in src_roots if f'{root}/{cls_name}.java' in files), None)
+        if path is None:
+            logging.error(f'BUG: {cls_name}.java not exists in {from_branch}')
+            continue
+        for bug in bugs:
+            to_branch = f'{from_branch}_{bug}_{method}_{line}'
+            if not force and to_branch in existing:
+                logging.warning(f"Branch *{to_branch}* exists, please delete it before processing, \n> git branch -d {to_branch}\n> git branch -m {to_branch} bak-{to_branch}")
+                continue
+            jobs.append(MutantJob(method=method, line=line, bug=bug, branch=to_branch, path=path))
+    return jobs
+
+
 @patch_jpype
 def main(args):
     if args.debug:
         return debug()
 
-    # common_methods_path = Path(args.common_methods_path)
-    # df = pd.read_csv(str(common_methods_path))
-    # method_and_line_list = [eval(x) for x in df['method'].to_list()]
-
-    # for method_and_line in method_and_line_list:
     project = args.project
     with open(f'results/projects/{project}/coverage/selected_methods.json', 'r') as fd:
         selected_methods = json.load(fd)
 
     from_branch = args.from_branch
-    for selected_method in selected_methods:
-        mgr = get_manager(project, from_branch)
-        # method, line = args.method, args.line
-        method, line = selected_method[0], selected_method[1]
-        if '$' in method:
-            method = method.replace('$', '-')
-
-        to_branch = f'{from_branch}_{args.bug}_{method}_{line}'
-        mgr = get_manager(args.project, to_branch)
-        src_dirs = mgr.src_dirs
-
-        if not args.force and mgr.is_branch_exists(to_branch):
-            logging.warn(f"Branch *{to_branch}* exists, please delete it before processing, \n> git branch -d {to_branch}\n> git branch -m {to_branch} bak-{to_branch}")
+    bugs = BUG_TYPES if args.bug == 'ALL' else args.bug.split(',')
+    mgr = get_manager(project, from_branch)
+    jobs = plan_mutants(mgr, from_branch, selected_methods, bugs, args.force)
+    logging.info(f"Injecting {len(jobs)} mutants of {len(selected_methods)} methods, bugs: {bugs}")
+
+    # NOTE: 1. one mutate_batch per source file, all in one round trip to the warm PerformanceMutator
+    sources = {path: mgr.run_cmd(f'git show {from_branch}:{path}').stdout for path in sorted({x['path'] for x in jobs})}
+    path_to_jobs = defaultdict(list)
+    for job in jobs:
+        path_to_jobs[job['path']].append(job)
+    paths = sorted(path_to_jobs.keys())
+    responses = call_batch([('mutate_batch', {'code': sources[path], 'specs': [
+        {'method': x['method'].split('.')[-1], 'line': x['line'], 'bug': x['bug']} for x in path_to_jobs[path]]}) for path in paths])
+
+    mutants: Dict[str, MutantPatch] = {}
+    for path, response in zip(paths, responses):
+        if not response['ok']:
+            logging.error(f"Fail to mutate {path}, ex: {response['error']}")
             continue
-
-        logging.info(f"Checkout to from branch *{from_branch}*")
-        mgr.checkout_branch(from_branch)
-
-        cls_name = '/'.join(method.split('.')[:-1])
-        for src_dir in src_dirs:
-            file = src_dir / f'{cls_name.split("-")[0]}.java' if '-' in cls_name else src_dir / f'{cls_name}.java'
-            if file.exists():
-                break
-
-        if not file.exists():
-            logging.error(f'BUG: {str(file)} not exists')
-            # import ipdb; ipdb.set_trace()
-            continue
-
-        with open(file, 'r') as fd:
-            code = fd.read()
-
-        logging.info(f"process file {str(file)}")
-        pure_method = method.split('.')[-1]
-        mutated_resp = mutate(code, pure_method, line, args.bug)
-        mutated_code = mutated_resp['mutated_code']
-        injected_bugs = mutated_resp['injected_bugs']
-        if injected_bugs > 0:
-            logging.info(f"Injected {injected_bugs} {args.bug} into code base");
-            with open(file, 'w') as fp:
-                fp.write(str(mutated_code))
-            try:
-                if not args.skip_compile:
-                    logging.info("Compiling jmh jar ...")
-                    mgr.compile(from_branch)
-                mgr.checkout_new_branch(to_branch)
-                mgr.commit_injected_bug(str(file.relative_to(mgr.cwd)), f'Injected bug {args.bug} at {pure_method}:{line}')
-                logging.info(f"Inject bug {args.bug} into code successfully")
-            except Exception as ex:
-                logging.error(f"Fail to compile the code after injecting code {args.bug}, ex: {str(ex)}")
-                # NOTE: revert the changed file
-                # mgr.checkout_file(str(file))
-            # NOTE: We just inject one bug into the codebase
+        for job, variant in zip(path_to_jobs[path], response['result']):
+            if variant['injected_bugs'] == 0:
+                logging.info(f"No {job['bug']} injected into {job['method']}:{job['line']}")
+                continue
+            mutants[job['branch']] = MutantPatch(method=job['method'], line=job['line'], bug=job['bug'], path=path,
+                                                 base=from_branch, patch=variant['patch'])
+    save_mutants(Path(f'results/projects/{project}/mutants/{from_branch}.json'), mutants)
+
+    # NOTE: mutants are patched from the base jar, build it once before they all ask for it
+    base_jar = None if args.skip_compile else mgr.compile_if_needed(from_branch)
+
+    # NOTE: skip mutants no benchmark can observe before spending a build and a benchmark run on them
+    if not args.keep_equivalent:
+        # NOTE: a branch without coverage files would make every mutant look unreachable, leave it out
+        coverage_branches = [x for x in args.coverage_branch or [from_branch] if len(coverage_files(project, x)) > 0]
+        for branch in sorted(set(args.coverage_branch or [from_branch]) - set(coverage_branches)):
+            logging.warning(f"No coverage of {branch} in results/projects/{project}/coverage, run cov_report.py first")
+        if len(coverage_branches) == 0:
+            logging.warning("Skip the reachability check of the mutants, no coverage to check against")
+        index = CoverageIndex.load(project, coverage_branches) if len(coverage_branches) > 0 else None
+        src_roots = [str(x.relative_to(mgr.cwd)) for x in mgr.src_dirs]
+        skipped = find_equivalent_mutants(mutants, sources, src_roots, index, coverage_branches, base_jar,
+                                          args.jobs if args.parallel else 1)
+        for branch, reason in sorted(skipped.items()):
+            logging.info(f"Skip mutant {branch}: {reason}")
+        with open(f'results/projects/{project}/mutants/{from_branch}.skipped.json', 'w') as fd:
+            json.dump(skipped, fd, indent=2, sort_keys=True)
+        mutants = {k: v for k, v in mutants.items() if k not in skipped}
+
+    # NOTE: 2. commit the mutants with git plumbing, no checkout needed, then create all branches at once
+    modes = mgr.list_files(from_branch, paths)
+    branch_to_commit = {}
+    for branch, mutant in mutants.items():
+        pure_method = mutant['method'].split('.')[-1]
+        code = apply_patch(sources[mutant['path']], mutant['patch'])
+        branch_to_commit[branch] = mgr.commit_file(from_branch, mutant['path'], code, modes[mutant['path']],
+                                                   f"Injected bug {mutant['bug']} at {pure_method}:{mutant['line']}")
+    mgr.update_branches(branch_to_commit)
+    logging.info(f"Committed {len(branch_to_commit)} injected branches")
+    if args.skip_compile:
+        return
+
+    # NOTE: 3. build the mutants side by side, in worktrees or patched from the base jar, and drop the ones which fail
+    def build(branch: str) -> bool:
+        try:
+            get_manager(project, branch).compile_if_needed(branch)
+            return True
+        except Exception as ex:
+            logging.error(f"Fail to compile the code of {branch}, ex: {str(ex)}")
+            return False
+
+    branches = sorted(branch_to_commit.keys())
+    with ThreadPoolExecutor(max_workers=args.jobs if args.parallel else 1) as executor:
+        built = list(executor.map(build, branches))
+    for branch, ok in zip(branches, built):
+        if not ok:
+            mgr.delete_branch(branch)
+    logging.info(f"Inject bugs into {built.count(True)}/{len(branches)} branches successfully")
 
 
 if __name__ == '__main__':
@@ -335,14 +414,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--project", type=str, required=True, help='rxjava, eclipse-collections, zipkin')
     parser.add_argument("--from_branch", type=str, default='jmh')
-    parser.add_argument("--bug", type=str.upper, default='HWO', help='HWO,PTW,STS,EFL,SOC')
+    parser.add_argument("--bug", type=str.upper, default='HWO', help='HWO,PTW,STS,EFL,SOC, comma separated, or ALL')
     # parser.add_argument('--common_methods_path', type=str, required=True)
     # parser.add_argument('--method', type=str, required=True)
     # parser.add_argument('--line', type=int, required=True)
-    parser.add_argument("--parallel", action="store_true")
+    parser.add_argument("--parallel", action="store_true", help='build the mutants concurrently')
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help='mutants built at the same time with --parallel')
     parser.add_argument('--delay', type=int, default=1, help='use in HWO case, sleep for 1 ns by default')
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--force", action="store_true")
     parser.add_argument("--skip_compile", action="store_true")
+    parser.add_argument("--coverage_branch", action='append', help='benchmark branches whose coverage a mutant must be reached by, --from_branch by default')
+    parser.add_argument("--keep_equivalent", action="store_true", help='do not skip unreachable or bytecode identical mutants')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import sqlite3
+import threading
+from typing import Dict, Optional
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: set LLM4JMH_BUILD_CACHE=off to build every branch into ./tmp/<cwd>/<branch> as before
+BUILD_CACHE_DIR = os.environ.get('LLM4JMH_BUILD_CACHE', './tmp/build-cache')
+BUILD_CACHE_MAX_GB = float(os.environ.get('LLM4JMH_BUILD_CACHE_MAX_GB', '20'))
+# NOTE: jars handed out within this many hours may still be benchmarked or patched, they are never evicted
+BUILD_CACHE_MIN_AGE_HOURS = float(os.environ.get('LLM4JMH_BUILD_CACHE_MIN_AGE_HOURS', '24'))
+
+
+class BuildCache:
+    """
+    Content-addressed cache of benchmark jars, keyed by the git tree hashes of the directories a jar is built
+    from (see `Manager.build_key`), so amended branches are rebuilt and identical trees are built once.
+
+    Jars live in `<root>/<key>/<jar name>`, indexed by a SQLite file with hit/miss counters. The least recently
+    used jars are evicted once they exceed `max_bytes`, except jars used in the last `min_age` seconds, so
+    a concurrent run never loses the jar it is measuring; the cache may then exceed `max_bytes` for a while.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = int(BUILD_CACHE_MAX_GB * 1024 ** 3),
+                 min_age: float = BUILD_CACHE_MIN_AGE_HOURS * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.root / 'index.sqlite'), check_same_thread=False, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jars ('
+            'key TEXT PRIMARY KEY, project TEXT, branches TEXT, path TEXT, '
+            'size INTEGER, created_at REAL, accessed_at REAL)'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        self.conn.commit()
+
+    def _count(self, name: str, value: int = 1):
+        self.conn.execute('INSERT INTO stats(name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?', (name, value, value))
+
+    def get(self, key: str, branch: str) -> Optional[Path]:
+        with self.lock:
+            row = self.conn.execute('SELECT path, branches FROM jars WHERE key = ?', (key,)).fetchone()
+            if row is not None and not Path(row[0]).exists():
+                self.conn.execute('DELETE FROM jars WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self._count('misses')
+            else:
+                self._count('hits')
+                branches = sorted(set(json.loads(row[1])) | {branch})
+                self.conn.execute('UPDATE jars SET accessed_at = ?, branches = ? WHERE key = ?', (time.time(), json.dumps(branches), key))
+            self.conn.commit()
+        if row is not None:
+            logging.info(f"Build cache hit for [{branch}]: {row[0]}")
+        return None if row is None else Path(row[0])
+
+    def put(self, key: str, project: str, branch: str, jar_path: Path) -> Path:
+        """Copy a freshly built jar into the cache and return the cached copy."""
+        dst = self.root / key / jar_path.name
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: copy then rename, a concurrent runner never sees a partial jar
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dst.parent)
+        os.close(fd)
+        tmp = Path(tmp)
+        shutil.copy(jar_path, tmp)
+        tmp.replace(dst)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO jars(key, project, branches, path, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, project, json.dumps([branch]), str(dst), dst.stat().st_size, now, now)
+            )
+            self._evict(keep=key)
+            self.conn.commit()
+        return dst
+
+    def _evict(self, keep: str):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM jars').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        rows = self.conn.execute('SELECT key, path, size FROM jars WHERE accessed_at < ? ORDER BY accessed_at ASC',
+                                 (time.time() - self.min_age,)).fetchall()
+        for key, path, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(Path(path).parent, ignore_errors=True)
+            self.conn.execute('DELETE FROM jars WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        self._count('evictions', evicted)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            entries, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM jars').fetchone()
+            counters = dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+        }
+
+
+_cache: Optional[BuildCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_build_cache() -> Optional[BuildCache]:
+    global _cache
+    if BUILD_CACHE_DIR == 'off':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = BuildCache(Path(BUILD_CACHE_DIR))
+    return _cache
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=['stats'])
+    parser.add_argument("--path", type=str, default=BUILD_CACHE_DIR, help='build cache dir')
+    args = parser.parse_args()
+
+    cache = BuildCache(Path(args.path))
+    if args.action == 'stats':
+        print(json.dumps(cache.stats(), indent=2))
@@ -65,10 +65,11 @@ def main(args):
     save_dir = mgr.save_coverage_dir
     src_dirs = mgr.src_dirs
     class_dirs = mgr.class_dirs
-    jar_path = mgr.jar_path
 
     logging.info(f"Checkout to branch {branch}")
-    mgr.compile_if_needed(branch)
+    jar_path = mgr.compile_if_needed(branch)
+    # NOTE: the jar is built in a worktree, the report reads the sources of the main clone
+    mgr.checkout_branch(branch)
     methods = mgr.list_benchmark_methods(jar_path)
     logging.info(f"Listing benchmark {len(methods)} methods ...")
     args_list = []
@@ -97,7 +98,7 @@ def main(args):
         for _args in args_list:
             run_jmh_method_wrapper(_args)
 
-    class_dirs = mgr.unzip_jar_for_class_dirs()
+    class_dirs = mgr.unzip_jar_for_class_dirs(jar_path)
     # class_dirs = mgr.class_dirs
     args_list = []
 
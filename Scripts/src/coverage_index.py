@@ -0,0 +1,104 @@
+import json
+from typing import List, Dict, Optional
+from pathlib import Path
+from collections import defaultdict
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def method_key(method: str, line: int) -> str:
+    """`<class>.<method>:<line>`, inner classes with `$` like JaCoCo, bug_injector branches use `-`."""
+    return f"{method.replace('-', '$')}:{line}"
+
+
+def coverage_files(project: str, branch: str) -> List[Path]:
+    coverage_dir = Path(f'results/projects/{project}/coverage/{branch}')
+    return sorted(x for x in coverage_dir.glob('*.json') if not x.name.endswith('.detailed.json'))
+
+
+def fingerprint(files: List[Path]) -> List[int]:
+    """Changes whenever a coverage file of the branch is added, removed or rewritten."""
+    stats = [x.stat() for x in files]
+    return [len(stats), max((x.st_mtime_ns for x in stats), default=0), sum(x.st_size for x in stats)]
+
+
+def index_branch(files: List[Path]) -> Dict[str, List[str]]:
+    method_to_benchmarks = defaultdict(set)
+    for file in files:
+        try:
+            with open(file, 'r') as fd:
+                method_to_line = json.load(fd)
+        except json.JSONDecodeError as ex:
+            logging.error(f"Error decoding JSON from file {file}: {ex}")
+            continue
+        for method, line in method_to_line.items():
+            method_to_benchmarks[method_key(method, line)].add(file.with_suffix('').name)
+    return {k: sorted(v) for k, v in method_to_benchmarks.items()}
+
+
+class CoverageIndex:
+    """
+    Benchmarks covering each source method, built from the per-benchmark JaCoCo json files of `cov_report.py`
+    and persisted as `results/projects/<project>/coverage/coverage-index.json`:
+
+        {"<benchmark branch>": {"fingerprint": [...], "methods": {"<class>.<method>:<line>": ["<benchmark>", ...]}}}
+
+    A branch is re-indexed only when its coverage files changed.
+    """
+
+    def __init__(self, entries: Dict[str, Dict[str, List[str]]]):
+        self.entries = entries
+
+    @classmethod
+    def load(cls, project: str, branches: List[str]) -> 'CoverageIndex':
+        path = Path(f'results/projects/{project}/coverage/coverage-index.json')
+        stored = {}
+        if path.exists():
+            with open(path, 'r') as fd:
+                stored = json.load(fd)
+
+        changed = False
+        for branch in branches:
+            files = coverage_files(project, branch)
+            current = fingerprint(files)
+            if branch in stored and stored[branch]['fingerprint'] == current:
+                continue
+            stored[branch] = {'fingerprint': current, 'methods': index_branch(files)}
+            logging.info(f"Indexed coverage of {branch}: {len(files)} benchmarks cover {len(stored[branch]['methods'])} methods")
+            changed = True
+        if changed:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as fd:
+                json.dump(stored, fd)
+            tmp_path.replace(path)
+        return cls({branch: stored[branch]['methods'] for branch in branches})
+
+    def benchmarks_for(self, method: str, line: int, branches: Optional[List[str]] = None) -> List[str]:
+        """Benchmarks of `branches` (all by default) which execute the method declared at `line`."""
+        key = method_key(method, line)
+        benchmarks = set()
+        for branch in branches or self.entries.keys():
+            benchmarks.update(self.entries.get(branch, {}).get(key, []))
+        return sorted(benchmarks)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", type=str, required=True, help='rxjava, eclipse-collections, zipkin')
+    parser.add_argument("--branch", action='append', required=True, help='benchmark branches, e.g. jmh, llm2jmh, ju2jmh')
+    parser.add_argument("--method", type=str, default=None, help='print the benchmarks covering <class>.<method>')
+    parser.add_argument("--line", type=int, default=None)
+    args = parser.parse_args()
+
+    index = CoverageIndex.load(args.project, args.branch)
+    if args.method is not None:
+        print('\n'.join(index.benchmarks_for(args.method, args.line, args.branch)))
+    else:
+        for branch, methods in index.entries.items():
+            print(f"{branch}: {len(methods)} methods, {len({y for x in methods.values() for y in x})} benchmarks")
@@ -0,0 +1,181 @@
+import re
+import json
+import difflib
+import threading
+from typing import List, Dict, Optional
+from pathlib import Path
+from collections import defaultdict
+import logging
+from java_compiler import JavaDiagnostic
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+MAX_DIAGNOSTICS = 20
+
+# NOTE: simple names generated benchmarks use most often without importing them
+COMMON_IMPORTS = {
+    **{x: f'org.openjdk.jmh.annotations.{x}' for x in [
+        'Benchmark', 'BenchmarkMode', 'Fork', 'Level', 'Measurement', 'Mode', 'OperationsPerInvocation',
+        'OutputTimeUnit', 'Param', 'Scope', 'Setup', 'State', 'TearDown', 'Threads', 'Timeout', 'Warmup']},
+    'Blackhole': 'org.openjdk.jmh.infra.Blackhole',
+    **{x: f'java.util.{x}' for x in [
+        'ArrayList', 'Arrays', 'Collection', 'Collections', 'HashMap', 'HashSet', 'Iterator', 'LinkedList',
+        'List', 'Map', 'Objects', 'Optional', 'Random', 'Set', 'TreeMap', 'TreeSet', 'UUID']},
+    **{x: f'java.util.concurrent.{x}' for x in [
+        'Callable', 'ConcurrentHashMap', 'CountDownLatch', 'ExecutorService', 'Executors', 'ThreadLocalRandom', 'TimeUnit']},
+    **{x: f'java.util.function.{x}' for x in ['BiFunction', 'Consumer', 'Function', 'Predicate', 'Supplier']},
+    **{x: f'java.util.stream.{x}' for x in ['Collectors', 'IntStream', 'Stream']},
+    **{x: f'java.io.{x}' for x in [
+        'ByteArrayInputStream', 'ByteArrayOutputStream', 'IOException', 'InputStream', 'OutputStream', 'UncheckedIOException']},
+    **{x: f'java.nio.charset.{x}' for x in ['StandardCharsets']},
+}
+
+SYMBOL_PATTERN = re.compile(r'symbol:\s+class\s+(\w+)')
+
+
+def diagnostics_of(diagnostics: List[JavaDiagnostic], target: Path) -> List[JavaDiagnostic]:
+    """Only the diagnostics reported for `target`, without duplicates."""
+    target = str(target.resolve())
+    seen = set()
+    kept = []
+    for diag in diagnostics:
+        if diag['file'] is None or str(Path(diag['file']).resolve()) != target:
+            continue
+        key = (diag['line'], diag['code'], diag['message'])
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(diag)
+    return kept
+
+
+def normalize_diagnostics(diagnostics: List[JavaDiagnostic], code: str, context: int = 1) -> str:
+    """
+    Render javac diagnostics of one file for a repair prompt: each error with the source lines
+    around it instead of paths, and at most `MAX_DIAGNOSTICS` errors.
+    """
+    lines = code.split('\n')
+    parts = []
+    for diag in diagnostics[:MAX_DIAGNOSTICS]:
+        parts.append(f"Line {diag['line']}: error: {diag['message']}")
+        start, end = max(diag['line'] - 1 - context, 0), min(diag['line'] + context, len(lines))
+        for n in range(start, end):
+            marker = '>' if n == diag['line'] - 1 else ' '
+            parts.append(f"  {marker} {n + 1:4d} | {lines[n]}")
+    if len(diagnostics) > MAX_DIAGNOSTICS:
+        parts.append(f"... and {len(diagnostics) - MAX_DIAGNOSTICS} more errors")
+    return '\n'.join(parts)
+
+
+def diagnostic_signature(diag: JavaDiagnostic) -> str:
+    """
+    What an error is about, independent of the file reporting it: the javac code and message without the
+    `location:` lines, which name the generated benchmark class.
+    """
+    message = '\n'.join(x for x in diag['message'].split('\n') if not x.strip().startswith('location:'))
+    return f"{diag['code']}: {' '.join(message.split())}"
+
+
+def file_signature(diagnostics: List[JavaDiagnostic]) -> str:
+    return ' | '.join(sorted({diagnostic_signature(x) for x in diagnostics}))
+
+
+def add_imports(code: str, imports: List[str]) -> str:
+    """Insert `import` lines after the package declaration, or at the top without one."""
+    missing = [x for x in imports if not re.search(rf'^\s*import\s+{re.escape(x)}\s*;', code, re.MULTILINE)]
+    if len(missing) == 0:
+        return code
+    block = ''.join(f'import {x};\n' for x in missing)
+    found = re.search(r'^\s*package\s+[\w.]+\s*;[^\n]*\n', code, re.MULTILINE)
+    if found is None:
+        return block + code
+    return code[:found.end()] + block + code[found.end():]
+
+
+def template_fix(diagnostics: List[JavaDiagnostic], code: str, class_index: Dict[str, str]) -> Optional[str]:
+    """Fix errors with a known local fix, for now missing imports of project, JDK and JMH classes."""
+    imports = []
+    for diag in diagnostics:
+        if not diag['code'].startswith('compiler.err.cant.resolve'):
+            continue
+        found = SYMBOL_PATTERN.search(diag['message'])
+        if found is None:
+            continue
+        name = found.group(1)
+        fqcn = class_index.get(name) or COMMON_IMPORTS.get(name)
+        if fqcn is not None and fqcn not in imports:
+            imports.append(fqcn)
+    fixed = add_imports(code, imports)
+    return fixed if fixed != code else None
+
+
+def build_class_index(src_dirs: List[Path]) -> Dict[str, str]:
+    """Simple name to fully qualified name of the project classes, names defined in several packages are left out."""
+    names = defaultdict(set)
+    for src_dir in src_dirs:
+        for file in src_dir.rglob('*.java'):
+            if file.name in ('package-info.java', 'module-info.java'):
+                continue
+            names[file.stem].add(str(file.relative_to(src_dir).with_suffix('')).replace('/', '.'))
+    return {k: v.pop() for k, v in names.items() if len(v) == 1}
+
+
+class FixCache:
+    """
+    Line edits which repaired an error signature before, persisted as JSON:
+
+        {"<diagnostic signature>": {"<failing line>": "<fixed line>"}}
+
+    Learned from the diff of a failing candidate and its repaired version at the reported lines,
+    and replayed on other files failing with the same signature before asking the LLM.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fixes: Dict[str, Dict[str, str]] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as fd:
+                self.fixes = json.load(fd)
+        self.hits = 0
+
+    def learn(self, diagnostics: List[JavaDiagnostic], failing_code: str, fixed_code: str):
+        failing = failing_code.split('\n')
+        fixed = fixed_code.split('\n')
+        replaced: Dict[int, str] = {}
+        matcher = difflib.SequenceMatcher(a=failing, b=fixed, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'replace' and i2 - i1 == j2 - j1:
+                for k in range(i2 - i1):
+                    replaced[i1 + k] = fixed[j1 + k]
+
+        with self.lock:
+            for diag in diagnostics:
+                new_line = replaced.get(diag['line'] - 1)
+                if new_line is None:
+                    continue
+                old_line = failing[diag['line'] - 1].strip()
+                self.fixes.setdefault(diagnostic_signature(diag), {})[old_line] = new_line.strip()
+
+    def apply(self, diagnostics: List[JavaDiagnostic], code: str) -> Optional[str]:
+        lines = code.split('\n')
+        changed = False
+        with self.lock:
+            for diag in diagnostics:
+                edits = self.fixes.get(diagnostic_signature(diag), {})
+                n = diag['line'] - 1
+                if n < 0 or n >= len(lines) or lines[n].strip() not in edits:
+                    continue
+                indent = lines[n][:len(lines[n]) - len(lines[n].lstrip())]
+                lines[n] = indent + edits[lines[n].strip()]
+                changed = True
+            if changed:
+                self.hits += 1
+        return '\n'.join(lines) if changed else None
+
+    def save(self):
+        with self.lock, open(self.path, 'w') as fd:
+            json.dump(self.fixes, fd, indent=2, sort_keys=True)
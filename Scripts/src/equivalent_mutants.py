@@ -0,0 +1,82 @@
+import shutil
+from typing import List, Dict, Any, Optional, Tuple
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from coverage_index import CoverageIndex
+from incremental_build import compile_against_jar, disassemble
+from patches import apply_patch
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def unreachable_reason(index: CoverageIndex, mutant: Dict[str, Any], branches: Optional[List[str]] = None) -> Optional[str]:
+    """A mutant in a method no benchmark executes can not change any measurement."""
+    if len(index.benchmarks_for(mutant['method'], mutant['line'], branches)) > 0:
+        return None
+    return f"no benchmark of {', '.join(branches or index.entries.keys())} covers {mutant['method']}:{mutant['line']}"
+
+
+def compile_variant(base_jar: Path, relative: str, code: str, work_dir: Path) -> Optional[str]:
+    """Disassembled classes of one source file compiled against the base jar, None when it does not compile."""
+    entries = compile_against_jar(base_jar, {relative: code}, work_dir)
+    if entries is None or len(entries[relative]) == 0:
+        return None
+    class_names = [x[:-len('.class')].replace('/', '.') for x in entries[relative]]
+    return disassemble(str((work_dir / 'classes').resolve()), class_names)
+
+
+def bytecode_equivalent_reason(base_jar: Path, relative: str, original: str, mutant: Dict[str, Any],
+                               original_bytecode: Optional[str], work_dir: Path) -> Optional[str]:
+    """A mutant javac compiles to the same bytecode as the original, e.g. dead or constant folded code, is a no-op."""
+    if original_bytecode is None:
+        return None
+    mutated = compile_variant(base_jar, relative, apply_patch(original, mutant['patch']), work_dir)
+    if mutated is None or mutated != original_bytecode:
+        return None
+    return 'bytecode identical to the original after compilation'
+
+
+def find_equivalent_mutants(mutants: Dict[str, Dict[str, Any]], sources: Dict[str, str], src_roots: List[str],
+                            index: Optional[CoverageIndex] = None, coverage_branches: Optional[List[str]] = None,
+                            base_jar: Optional[Path] = None, jobs: int = 1) -> Dict[str, str]:
+    """
+    Mutant branches which can not be observed by a benchmark, with the reason: unreachable according to the
+    coverage index, or identical bytecode to the base branch. Checks without their input are skipped.
+    """
+    skipped: Dict[str, str] = {}
+    if index is not None:
+        for branch, mutant in mutants.items():
+            reason = unreachable_reason(index, mutant, coverage_branches)
+            if reason is not None:
+                skipped[branch] = reason
+
+    if base_jar is None:
+        return skipped
+
+    def relative_of(path: str) -> str:
+        root = next(x for x in src_roots if path.startswith(f'{x}/'))
+        return path[len(root) + 1:]
+
+    # NOTE: compile each original once, with the same javac as the mutants so only the mutation can differ
+    work_root = Path('./tmp/equivalent-mutants')
+    paths = sorted({x['path'] for branch, x in mutants.items() if branch not in skipped})
+
+    def compile_original(path: str) -> Tuple[str, Optional[str]]:
+        return path, compile_variant(base_jar, relative_of(path), sources[path], work_root / 'original' / relative_of(path))
+
+    def check(branch: str) -> Tuple[str, Optional[str]]:
+        mutant = mutants[branch]
+        return branch, bytecode_equivalent_reason(base_jar, relative_of(mutant['path']), sources[mutant['path']], mutant,
+                                                  original_bytecode[mutant['path']], work_root / branch)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        original_bytecode = dict(executor.map(compile_original, paths))
+        for branch, reason in executor.map(check, [x for x in sorted(mutants.keys()) if x not in skipped]):
+            if reason is not None:
+                skipped[branch] = reason
+    shutil.rmtree(work_root, ignore_errors=True)
+    return skipped
@@ -0,0 +1,71 @@
+import json
+import hashlib
+from typing import Dict, Any, Optional, Set
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class GenerationManifest:
+    """
+    Per source file record of what the generated outputs were produced from, saved next to the
+    generated directory as `<model>.manifest.json`:
+
+        {"io/reactivex/rxjava3/core/Flowable.java": {"source_hash": ..., "prompt_hash": ..., "benchmark": ...}}
+
+    `source_hash` is the hash of the comment-stripped source, `prompt_hash` the hash of the prompt
+    template, `benchmark` the jmh file copied into the benchmark module once it compiled.
+    """
+
+    def __init__(self, save_dir: Path):
+        self.save_dir = save_dir
+        self.path = save_dir.parent / f'{save_dir.name}.manifest.json'
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as fd:
+                self.entries = json.load(fd)
+        self.changed: Set[str] = set()
+
+    def get(self, source_file: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(source_file)
+
+    def is_up_to_date(self, source_file: str, source_hash: str, prompt_hash: str) -> bool:
+        entry = self.entries.get(source_file)
+        return entry is not None and entry.get('source_hash') == source_hash and entry.get('prompt_hash') == prompt_hash
+
+    def update(self, source_file: str, **fields):
+        self.entries.setdefault(source_file, {}).update(fields)
+
+    def discard(self, source_file: str, *fields: str):
+        entry = self.entries.get(source_file, {})
+        for field in fields:
+            entry.pop(field, None)
+
+    def mark_changed(self, source_file: str):
+        """Drop every output generated from the previous version of `source_file`."""
+        self.changed.add(source_file)
+        entry = self.entries.get(source_file, {})
+        save_path = self.save_dir / f'{source_file}.txt'
+        stale = [save_path, save_path.with_suffix('')]
+        stale.extend(save_path.parent.glob(f'{Path(source_file).name}.repair-*.txt'))
+        stale.extend(save_path.parent.glob(f'{Path(source_file).name}.chunk-*.txt'))
+        if entry.get('benchmark'):
+            stale.append(Path(entry['benchmark']))
+        for file in stale:
+            if file.exists():
+                logging.info(f"Remove stale output {str(file)}")
+                file.unlink()
+        self.discard(source_file, 'benchmark')
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w') as fd:
+            json.dump(self.entries, fd, indent=2, sort_keys=True)
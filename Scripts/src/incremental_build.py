@@ -0,0 +1,135 @@
+import os
+import re
+import shutil
+import zipfile
+import subprocess
+from typing import List, Dict, Optional
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def release_of(major: Optional[int]) -> Optional[str]:
+    """The --release javac needs to produce classes of this major version, 52 is Java 8, 53 Java 9 and so on."""
+    if major is None or major < 52:
+        return None
+    return str(major - 44)
+
+
+def base_branch_of(branch: str) -> Optional[str]:
+    """`<base>_<bug>_<method>_<line>` branches made by bug_injector, None for other branches."""
+    splits = branch.split('_')
+    return splits[0] if len(splits) == 4 else None
+
+
+def class_entries(jar: zipfile.ZipFile, source: str) -> List[str]:
+    """Entries of the classes compiled from `source` (a/b/C.java): C.class and its nested C$*.class."""
+    stem = source[:-len('.java')]
+    return sorted(x for x in jar.namelist() if x == f'{stem}.class' or (x.startswith(f'{stem}$') and x.endswith('.class')))
+
+
+def signatures(classpath: str, class_names: List[str]) -> str:
+    """Members and descriptors of the classes, without the `Compiled from` lines."""
+    result = subprocess.run(['javap', '-p', '-s', '-cp', classpath] + class_names, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True, check=True)
+    return '\n'.join(x for x in result.stdout.split('\n') if not x.startswith('Compiled from'))
+
+
+def disassemble(classpath: str, class_names: List[str]) -> str:
+    """Bytecode of the classes without constant pool indexes and debug info, equal for equivalent compilations."""
+    result = subprocess.run(['javap', '-c', '-p', '-cp', classpath] + class_names, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True, check=True)
+    lines = [x for x in result.stdout.split('\n') if not x.startswith('Compiled from')]
+    return '\n'.join(re.sub(r'#\d+(?:\.#\d+)?', '#', x) for x in lines)
+
+
+def compile_against_jar(base_jar: Path, sources: Dict[str, str], work_dir: Path) -> Optional[Dict[str, List[str]]]:
+    """
+    Compile sources (a/b/C.java -> code) against a benchmark jar into `work_dir/classes`, at the bytecode level
+    of the classes in the jar. Returns the class files of each source, None when javac fails.
+    """
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    src_dir, classes_dir = work_dir / 'src', work_dir / 'classes'
+    classes_dir.mkdir(parents=True, exist_ok=True)
+    for relative, code in sources.items():
+        (src_dir / relative).parent.mkdir(parents=True, exist_ok=True)
+        (src_dir / relative).write_text(code)
+
+    cmd = ['javac', '-nowarn', '-proc:none', '-encoding', 'UTF-8', '-cp', str(base_jar.resolve()), '-d', str(classes_dir)]
+    with zipfile.ZipFile(base_jar, 'r') as jar:
+        entries = [x for relative in sources for x in class_entries(jar, relative)]
+        major = int.from_bytes(jar.read(entries[0])[6:8], 'big') if len(entries) > 0 else None
+    release = release_of(major)
+    if release is not None:
+        cmd += ['--release', release]
+    cmd += [str(src_dir / x) for x in sources]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        logging.error(f"javac failed:\n{result.stdout}")
+        return None
+    return {x: sorted(str(y.relative_to(classes_dir)) for y in classes_dir.glob(f"{x[:-len('.java')]}*.class")
+                      if y.name == Path(x).stem + '.class' or y.name.startswith(Path(x).stem + '$'))
+            for x in sources}
+
+
+def build_mutant_jar(mgr, branch: str, base_branch: str, base_jar: Path, dst: Path) -> bool:
+    """
+    Build the benchmark jar of a mutant branch from the jar of its base branch: recompile only the source
+    files the mutant changed against the base jar, check with javap that no class signature changed, and
+    replace their classes in a copy of the base jar. Returns False when a full build is needed instead.
+    """
+    diff = mgr.run_cmd(f'git diff --name-only {base_branch} {branch}').stdout.split()
+    src_roots = [str(x.relative_to(mgr.cwd)) for x in mgr.src_dirs]
+    sources: Dict[str, str] = {}
+    for path in diff:
+        root = next((x for x in src_roots if path.startswith(f'{x}/')), None)
+        if root is None or not path.endswith('.java'):
+            logging.info(f"{branch} changes {path} outside the source dirs, full build needed")
+            return False
+        sources[path] = path[len(root) + 1:]
+    if len(sources) == 0:
+        return False
+
+    code = {relative: mgr.run_cmd(f'git show {branch}:{path}').stdout for path, relative in sources.items()}
+    with zipfile.ZipFile(base_jar, 'r') as jar:
+        old_entries = {relative: class_entries(jar, relative) for relative in sources.values()}
+    if any(len(x) == 0 for x in old_entries.values()):
+        logging.info(f"{branch} changes a class which is not in the base jar, full build needed")
+        return False
+
+    work_dir = Path(f'./tmp/incremental/{branch}')
+    try:
+        classes_dir = work_dir / 'classes'
+        new_entries = compile_against_jar(base_jar, code, work_dir)
+        if new_entries is None:
+            logging.error(f"Fail to recompile the changed files of {branch}, full build needed")
+            return False
+        if new_entries != old_entries:
+            logging.info(f"{branch} adds or removes nested classes, full build needed")
+            return False
+
+        class_names = [x[:-len('.class')].replace('/', '.') for entries in new_entries.values() for x in entries]
+        if signatures(str(base_jar.resolve()), class_names) != signatures(str(classes_dir.resolve()), class_names):
+            logging.info(f"{branch} changes a class signature, full build needed")
+            return False
+
+        # NOTE: write a patched copy next to `dst` then rename, the base jar stays untouched
+        replaced = {x for entries in new_entries.values() for x in entries}
+        tmp = dst.with_suffix(f'.{os.getpid()}.tmp')
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(base_jar, 'r') as src, zipfile.ZipFile(tmp, 'w') as out:
+            for item in src.infolist():
+                if item.filename in replaced:
+                    out.writestr(item, (classes_dir / item.filename).read_bytes())
+                else:
+                    out.writestr(item, src.read(item))
+        tmp.replace(dst)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logging.info(f"Patched {len(replaced)} classes of {branch} into a copy of the {base_branch} jar")
+    return True
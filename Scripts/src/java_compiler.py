@@ -0,0 +1,159 @@
+from typing import List, Dict, Tuple, TypedDict, Optional
+from pathlib import Path
+from collections import defaultdict
+import os
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+class JavaDiagnostic(TypedDict):
+    file: Optional[str]
+    line: int
+    column: int
+    kind: str
+    code: str
+    message: str
+
+
+def _to_java_list(items: List[str]):
+    from java.util import ArrayList
+    java_list = ArrayList()
+    for item in items:
+        java_list.add(item)
+    return java_list
+
+
+def format_diagnostics(diagnostics: List[JavaDiagnostic]) -> str:
+    """Render diagnostics the way javac prints them, e.g. `Foo.java:12: error: cannot find symbol`."""
+    lines = []
+    for diag in diagnostics:
+        location = f"{diag['file']}:{diag['line']}" if diag['file'] else '<unknown>'
+        lines.append(f"{location}: {diag['kind'].lower()}: {diag['message']}")
+    return '\n'.join(lines)
+
+
+# NOTE: diagnostics which may be caused by another file of the same batch
+CROSS_FILE_CODES = {
+    'compiler.err.duplicate.class',
+    'compiler.err.already.defined',
+    'compiler.err.cyclic.inheritance',
+}
+
+
+class IncrementalCompiler:
+    """
+    Compile single generated benchmark files with the in-process javac (javax.tools).
+
+    The project classpath is resolved once by the manager, the compiler and its file
+    manager stay warm in the running JVM, so checking a file costs one javac task
+    instead of a full `mvn clean package` / `./gradlew clean jmhJar`.
+    Annotation processing is disabled: the JMH generator only runs in the final build.
+    """
+
+    def __init__(self, classpath: List[str], output_dir: Path, options: Optional[List[str]] = None):
+        from javax.tools import ToolProvider
+
+        self.output_dir = output_dir
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # NOTE: previously accepted classes are visible to the next files
+        self.classpath = [str(self.output_dir.resolve())] + [x for x in classpath if x]
+        self.options = [
+            '-classpath', os.pathsep.join(self.classpath),
+            '-d', str(self.output_dir.resolve()),
+            '-proc:none',
+            '-implicit:none',
+            '-nowarn',
+            '-encoding', 'UTF-8',
+            '-Xmaxerrs', '100000',
+            # NOTE: keep attributing the other files of a batch after a syntax error in one of them
+            '-XDshould-stop.ifError=FLOW',
+        ] + (options or [])
+
+        self.compiler = ToolProvider.getSystemJavaCompiler()
+        if self.compiler is None:
+            raise Exception("No system java compiler found, please run the scripts with a JDK instead of a JRE")
+        self.file_manager = self.compiler.getStandardFileManager(None, None, None)
+
+    def compile(self, files: List[Path]) -> Tuple[bool, List[JavaDiagnostic]]:
+        from javax.tools import DiagnosticCollector
+
+        collector = DiagnosticCollector()
+        units = self.file_manager.getJavaFileObjectsFromStrings(_to_java_list([str(x.resolve()) for x in files]))
+        task = self.compiler.getTask(None, self.file_manager, collector, _to_java_list(self.options), None, units)
+        success = bool(task.call())
+
+        diagnostics = []
+        for diag in collector.getDiagnostics():
+            kind = str(diag.getKind().name())
+            if kind != 'ERROR':
+                continue
+            source = diag.getSource()
+            diagnostics.append(JavaDiagnostic(
+                file=str(source.getName()) if source is not None else None,
+                line=int(diag.getLineNumber()),
+                column=int(diag.getColumnNumber()),
+                kind=kind,
+                code=str(diag.getCode()),
+                message=str(diag.getMessage(None)),
+            ))
+        return success, diagnostics
+
+    def compile_batch(self, files: List[Path]) -> Dict[Path, List[JavaDiagnostic]]:
+        """
+        Compile all files in one javac task and attribute the diagnostics per source file.
+
+        Files with only their own errors are reported from this single pass. Files whose
+        errors may come from another file of the batch (duplicate classes, or diagnostics
+        without a source) are bisected and recompiled until each one is judged alone.
+        Returns the diagnostics of the files which fail to compile, keyed by the given path.
+        """
+        if len(files) == 0:
+            return {}
+
+        success, diagnostics = self.compile(files)
+        if success:
+            return {}
+        if len(files) == 1:
+            return {files[0]: diagnostics}
+
+        path_to_file = {str(x.resolve()): x for x in files}
+        file_to_diagnostics = defaultdict(list)
+        unattributed = []
+        for diag in diagnostics:
+            file = path_to_file.get(str(Path(diag['file']).resolve())) if diag['file'] else None
+            if file is None:
+                unattributed.append(diag)
+            else:
+                file_to_diagnostics[file].append(diag)
+
+        if len(unattributed) > 0:
+            suspects = list(files)
+            failed = {}
+        else:
+            suspects = [x for x, diags in file_to_diagnostics.items() if any(d['code'] in CROSS_FILE_CODES for d in diags)]
+            failed = {x: diags for x, diags in file_to_diagnostics.items() if x not in suspects}
+
+        if len(suspects) > 0:
+            logging.info(f"Bisecting {len(suspects)} files with errors that may come from other files")
+            failed.update(self._bisect(suspects))
+        return failed
+
+    def _bisect(self, files: List[Path]) -> Dict[Path, List[JavaDiagnostic]]:
+        if len(files) == 1:
+            return self.compile_batch(files)
+        mid = len(files) // 2
+        failed = self.compile_batch(files[:mid])
+        failed.update(self.compile_batch(files[mid:]))
+        return failed
+
+
+def compile_batch(classpath: List[str], output_dir: Path, files: List[Path]) -> Dict[Path, List[JavaDiagnostic]]:
+    """Run `IncrementalCompiler.compile_batch` in the jvm service if it is running, otherwise in-process."""
+    from jvm_service import call
+    path_to_file = {str(x.resolve()): x for x in files}
+    failed = call('compile_batch', classpath=classpath, output_dir=str(output_dir.resolve()), files=list(path_to_file.keys()))
+    return {path_to_file[k]: v for k, v in failed.items()}
@@ -0,0 +1,132 @@
+import os
+import re
+import time
+import shutil
+import threading
+import subprocess
+from typing import List, Dict, Tuple, Optional
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: one short iteration in the host JVM, enough to hit exceptions of @Setup and @Benchmark methods
+SMOKE_OPTIONS = ['-f', '0', '-wi', '0', '-i', '1', '-r', '10ms', '-foe', 'false']
+
+BENCHMARK_PATTERN = re.compile(r'^# Benchmark: (\S+)', re.MULTILINE)
+EXCEPTION_PATTERN = re.compile(r'^([\w.$]+(?:Exception|Error|Throwable))(?::\s*(.*?))?\n((?:[ \t]+at .+\n?)+)', re.MULTILINE)
+JMH_PROCESSOR = 'org.openjdk.jmh.generators.BenchmarkProcessor'
+
+
+def format_runtime_error(exception_type: str, stack_trace: str) -> str:
+    """The message format of `analysis_runtime_error.py`, consumed by the runtime repair prompt."""
+    return f'Exception Type: {exception_type}\nStack Trace:\n{stack_trace}'
+
+
+def parse_smoke_output(output: str) -> Dict[str, str]:
+    """Map every benchmark which reported a `<failure>` to its first exception."""
+    failures = {}
+    starts = [m for m in BENCHMARK_PATTERN.finditer(output)]
+    for i, m in enumerate(starts):
+        benchmark = m.group(1)
+        block = output[m.end():starts[i + 1].start() if i + 1 < len(starts) else len(output)]
+        if '<failure>' not in block or benchmark in failures:
+            continue
+        found = EXCEPTION_PATTERN.search(block)
+        if found:
+            failures[benchmark] = format_runtime_error(found.group(1), found.group(3))
+        else:
+            failures[benchmark] = format_runtime_error('unknown', block[block.index('<failure>'):][:2000])
+    return failures
+
+
+def _run_watched(cmd: List[str], benchmark_timeout: float) -> Tuple[str, Optional[str]]:
+    """
+    Run one smoke JVM and kill it once a single benchmark runs longer than `benchmark_timeout` seconds.
+    Return the output and the benchmark that hung, if any.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    lines: List[str] = []
+    state = {'current': None, 'started_at': time.monotonic()}
+
+    def read():
+        for line in proc.stdout:
+            lines.append(line)
+            m = BENCHMARK_PATTERN.match(line)
+            if m:
+                state['current'] = m.group(1)
+                state['started_at'] = time.monotonic()
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    hung = None
+    while proc.poll() is None:
+        if time.monotonic() - state['started_at'] > benchmark_timeout:
+            hung = state['current'] or '<startup>'
+            proc.kill()
+            break
+        time.sleep(0.1)
+    proc.wait()
+    reader.join(timeout=5)
+    return ''.join(lines), hung
+
+
+def run_smoke(classpath: List[str], include: str, benchmark_timeout: float = 30.0, iteration_timeout: str = '5s',
+              jvm_args: Optional[List[str]] = None) -> Dict[str, str]:
+    """
+    Smoke run every benchmark matching `include` once, sharing one JVM between them. A benchmark which
+    hangs is reported as a timeout, and the JVM is restarted for the benchmarks which did not run yet.
+    Returns the failing benchmarks with a runtime error message; `include` itself is reported when
+    nothing matches it.
+    """
+    failures: Dict[str, str] = {}
+    excluded: List[str] = []
+    while True:
+        cmd = ['java'] + (jvm_args or []) + ['-cp', os.pathsep.join(classpath), 'org.openjdk.jmh.Main', include]
+        cmd += SMOKE_OPTIONS + ['-to', iteration_timeout]
+        if len(excluded) > 0:
+            cmd += ['-e', ','.join(excluded)]
+        output, hung = _run_watched(cmd, benchmark_timeout)
+        failures.update(parse_smoke_output(output))
+
+        if hung is None:
+            if len(excluded) == 0 and 'No matching benchmarks' in output:
+                failures[include] = format_runtime_error('java.lang.IllegalStateException',
+                                                         '\tat org.openjdk.jmh.Main(No matching benchmarks, is any method annotated with @Benchmark?)\n')
+            return failures
+
+        logging.error(f"Smoke run of {hung} did not finish within {benchmark_timeout}s")
+        failures[hung] = format_runtime_error('java.util.concurrent.TimeoutException',
+                                              f'\tat {hung}(smoke run did not finish within {benchmark_timeout}s)\n')
+        if hung == '<startup>':
+            return failures
+        excluded.extend(f'^{re.escape(x)}$' for x in BENCHMARK_PATTERN.findall(output))
+
+
+def compile_for_smoke(java_file: Path, classpath: List[str], output_dir: Path) -> Optional[str]:
+    """
+    Compile one benchmark with the JMH annotation processor into its own `output_dir`, so its
+    META-INF/BenchmarkList only lists this file. Returns the javac output on failure.
+    """
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cmd = ['javac', '-nowarn', '-encoding', 'UTF-8', '-cp', os.pathsep.join(classpath),
+           '-processor', JMH_PROCESSOR, '-d', str(output_dir), '-s', str(output_dir / 'generated-sources'), str(java_file)]
+    (output_dir / 'generated-sources').mkdir(parents=True, exist_ok=True)
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        return result.stdout
+    return None
+
+
+def smoke_test_file(java_file: Path, class_name: str, classpath: List[str], output_dir: Path,
+                    benchmark_timeout: float = 30.0) -> Dict[str, str]:
+    """Annotation-process and smoke run the benchmarks of one generated file, return the failing ones."""
+    err = compile_for_smoke(java_file, classpath, output_dir)
+    if err is not None:
+        return {class_name: format_runtime_error('org.openjdk.jmh.runner.RunnerException', err)}
+    return run_smoke([str(output_dir.resolve())] + classpath, f'^{re.escape(class_name)}\\.', benchmark_timeout)
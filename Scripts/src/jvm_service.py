@@ -0,0 +1,517 @@
+import os
+import sys
+import json
+import socket
+import socketserver
+import threading
+from typing import List, Dict, Tuple, Any, Callable, Optional, TypedDict
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: scripts connect to this socket when a service is running, otherwise the ops run in an in-process JVM
+SOCKET_PATH = Path(os.environ.get('LLM4JMH_JVM_SOCKET', './tmp/jvm-service.sock'))
+
+JVM_OPS: Dict[str, Callable] = {}
+_op_locks: Dict[str, threading.Lock] = {}
+
+
+class JvmResponse(TypedDict):
+    ok: bool
+    result: Any
+    error: Optional[str]
+
+
+def jvm_op(thread_safe: bool = True):
+    """Register a function that runs against the JVM, callable through `call` and `call_batch`."""
+    def decorator(func):
+        JVM_OPS[func.__name__] = func
+        if not thread_safe:
+            _op_locks[func.__name__] = threading.Lock()
+        return func
+    return decorator
+
+
+def start_jvm() -> bool:
+    """Start the in-process JVM with the mutator and JavaParser jars, return False if it is already running."""
+    import jpype
+    import jpype.imports
+    if jpype.isJVMStarted():
+        return False
+
+    # NOTE: `compile_mutator` is only used for `bug injector.py`, can comment it out if running other scripts
+    # from utils import compile_mutator
+    # compile_mutator()
+    project_root = Path(os.getcwd())
+    classpath = []
+    classpath.append(str(project_root / 'target/automator-guard-1.0-SNAPSHOT.jar'))
+    javaparser_jar = str(Path("deps/javaparser-core-3.26.4.jar").resolve())
+    classpath.append(javaparser_jar)
+    jpype.startJVM(classpath=classpath)
+    return True
+
+
+def shutdown_jvm():
+    jpype = sys.modules.get('jpype')
+    if jpype is not None and jpype.isJVMStarted():
+        jpype.shutdownJVM()
+
+
+# ---------------------------------------------------------------- ops
+
+
+@jvm_op(thread_safe=False)
+def mutate(code: str, method: str, line: int, bug: str, max_injected_bugs: int = 1) -> Dict[str, Any]:
+    from de.fraunhofer.fokus import PerformanceMutator
+    result = PerformanceMutator.mutate(code, method, line, bug.upper(), max_injected_bugs)
+    return json.loads(str(result))
+
+
+class MutationSpec(TypedDict):
+    method: str
+    line: int
+    bug: str
+
+
+@jvm_op(thread_safe=False)
+def mutate_batch(code: str, specs: List[MutationSpec], max_injected_bugs: int = 1) -> List[Dict[str, Any]]:
+    """
+    Apply many mutations to one source: the source crosses into the JVM once and every variant comes back
+    as a unified diff against it (`patches.apply_patch`) instead of a full copy. Variants without an
+    injected bug have an empty patch.
+    """
+    from java.lang import String
+    from de.fraunhofer.fokus import PerformanceMutator
+    from patches import make_patch
+    java_code = String(code)
+    variants = []
+    for spec in specs:
+        result = json.loads(str(PerformanceMutator.mutate(java_code, spec['method'], spec['line'], spec['bug'].upper(), max_injected_bugs)))
+        patch = make_patch(code, result['mutated_code']) if result['injected_bugs'] > 0 else ''
+        variants.append({**spec, 'injected_bugs': result['injected_bugs'], 'patch': patch})
+    return variants
+
+
+@jvm_op(thread_safe=False)
+def evaluate_quality(code: str, src_dirs: List[str]) -> Optional[List[Dict[str, Any]]]:
+    from de.fraunhofer.fokus import JmhQualityAnalyzer
+    method_to_features = JmhQualityAnalyzer.evaluate(code, src_dirs)
+    if method_to_features is None:
+        return None
+    return json.loads(str(method_to_features))
+
+
+@jvm_op()
+def relocate_benchmark(code: str, package: str, imports: List[str]) -> Dict[str, Any]:
+    """Move a generated benchmark into `package` and add the project imports, return its top level classes."""
+    from com.github.javaparser import StaticJavaParser
+    from com.github.javaparser.ast.body import ClassOrInterfaceDeclaration
+
+    cu = StaticJavaParser.parse(code)
+    top_level_classes = [str(t.getNameAsString()) for t in cu.getTypes() if isinstance(t, ClassOrInterfaceDeclaration) and not t.isInterface()]
+
+    for imp in imports:
+        try:
+            cu.addImport(imp)
+        except Exception as ex:
+            logging.error(f"Fail to add import {imp}")
+
+    if cu.getPackageDeclaration().isPresent():
+        cu.removePackageDeclaration()
+    cu.setPackageDeclaration(package)
+    return {'classes': top_level_classes, 'code': str(cu.toString())}
+
+
+@jvm_op()
+def add_jmh_timeout(code: str, time: int = 2) -> str:
+    """Add `@Timeout(time = <time>, timeUnit = TimeUnit.SECONDS)` to every @Benchmark method without one."""
+    from com.github.javaparser import StaticJavaParser
+    from com.github.javaparser.ast.expr import NormalAnnotationExpr, Name, FieldAccessExpr, NameExpr
+    from com.github.javaparser.ast.body import ClassOrInterfaceDeclaration
+
+    cu = StaticJavaParser.parse(code)
+
+    # Ensure required imports exist
+    imports = [imp.getNameAsString() for imp in cu.getImports()]
+    if 'org.openjdk.jmh.annotations.Timeout' not in imports:
+        cu.addImport('org.openjdk.jmh.annotations.Timeout')
+    if 'java.util.concurrent.TimeUnit' not in imports:
+        cu.addImport('java.util.concurrent.TimeUnit')
+
+    def process_methods(cls: ClassOrInterfaceDeclaration):
+        for method in cls.getMethods():
+            if method.isAnnotationPresent("Benchmark") and not method.isAnnotationPresent("Timeout"):
+                # Create and add @Timeout annotation
+                timeout_annotation = NormalAnnotationExpr()
+                timeout_annotation.setName(Name("Timeout"))
+                timeout_annotation.addPair("time", str(time))
+                timeout_annotation.addPair("timeUnit", FieldAccessExpr(NameExpr("TimeUnit"), "SECONDS"))
+                method.addAnnotation(timeout_annotation)
+
+        # Process inner classes
+        for member in cls.getMembers():
+            if isinstance(member, ClassOrInterfaceDeclaration):
+                process_methods(member)
+
+    for type_decl in cu.getTypes():
+        if isinstance(type_decl, ClassOrInterfaceDeclaration):
+            process_methods(type_decl)
+
+    return str(cu.toString())
+
+
+# NOTE: method names which usually mean I/O or data copying, matched on call sites
+IO_CALL_NAMES = {
+    'read', 'write', 'readFully', 'readLine', 'flush', 'copy', 'arraycopy', 'transferTo',
+    'serialize', 'deserialize', 'encode', 'decode', 'parse', 'send', 'receive', 'load', 'store',
+}
+
+
+@jvm_op()
+def source_features(code: str) -> Dict[str, int]:
+    """
+    Static features used to decide whether a source is worth a benchmark without asking the LLM:
+    declared types by kind, methods with a body, accessors, loops, I/O calls and the summed
+    cyclomatic complexity of all methods and constructors.
+    """
+    from com.github.javaparser import StaticJavaParser
+    from com.github.javaparser.ast.body import (ClassOrInterfaceDeclaration, EnumDeclaration, AnnotationDeclaration,
+                                                MethodDeclaration, ConstructorDeclaration, CallableDeclaration)
+    from com.github.javaparser.ast.stmt import (ForStmt, ForEachStmt, WhileStmt, DoStmt, IfStmt, SwitchEntry,
+                                                CatchClause, ReturnStmt, ExpressionStmt)
+    from com.github.javaparser.ast.expr import (MethodCallExpr, ConditionalExpr, BinaryExpr, AssignExpr,
+                                                NameExpr, FieldAccessExpr)
+
+    cu = StaticJavaParser.parse(code)
+
+    def count(node, cls) -> int:
+        return int(node.findAll(cls).size())
+
+    classes = [x for x in cu.findAll(ClassOrInterfaceDeclaration)]
+    features = {
+        'classes': sum(1 for x in classes if not x.isInterface()),
+        'interfaces': sum(1 for x in classes if x.isInterface()),
+        'enums': count(cu, EnumDeclaration),
+        'annotations': count(cu, AnnotationDeclaration),
+        'methods': 0,
+        'accessors': 0,
+        'loops': 0,
+        'io_calls': 0,
+        'cyclomatic': 0,
+    }
+
+    def is_accessor(method) -> bool:
+        stmts = method.getBody().get().getStatements()
+        if stmts.size() != 1:
+            return False
+        stmt = stmts.get(0)
+        if isinstance(stmt, ReturnStmt):
+            expr = stmt.getExpression()
+            return not expr.isPresent() or isinstance(expr.get(), (NameExpr, FieldAccessExpr)) or expr.get().isLiteralExpr()
+        if isinstance(stmt, ExpressionStmt):
+            expr = stmt.getExpression()
+            return isinstance(expr, AssignExpr) and isinstance(expr.getValue(), (NameExpr, FieldAccessExpr))
+        return False
+
+    for callable_decl in cu.findAll(CallableDeclaration):
+        if isinstance(callable_decl, MethodDeclaration):
+            if not callable_decl.getBody().isPresent():
+                continue
+            features['methods'] += 1
+            if is_accessor(callable_decl):
+                features['accessors'] += 1
+        elif not isinstance(callable_decl, ConstructorDeclaration):
+            continue
+
+        loops = sum(count(callable_decl, x) for x in (ForStmt, ForEachStmt, WhileStmt, DoStmt))
+        branches = sum(count(callable_decl, x) for x in (IfStmt, CatchClause, ConditionalExpr))
+        branches += sum(1 for x in callable_decl.findAll(SwitchEntry) if x.getLabels().size() > 0)
+        branches += sum(1 for x in callable_decl.findAll(BinaryExpr)
+                        if str(x.getOperator().name()) in ('AND', 'OR'))
+        features['loops'] += loops
+        features['cyclomatic'] += 1 + loops + branches
+        features['io_calls'] += sum(1 for x in callable_decl.findAll(MethodCallExpr) if str(x.getNameAsString()) in IO_CALL_NAMES)
+
+    return features
+
+
+def _primary_type_index(cu) -> int:
+    """The top level type with the most members, i.e. the class a source file is about."""
+    sizes = [t.getMembers().size() for t in cu.getTypes()]
+    return sizes.index(max(sizes))
+
+
+def _is_chunk_unit(member) -> bool:
+    from com.github.javaparser.ast.body import MethodDeclaration, TypeDeclaration
+    return isinstance(member, MethodDeclaration) or isinstance(member, TypeDeclaration)
+
+
+@jvm_op()
+def split_methods(code: str, budget_tokens: int) -> List[str]:
+    """
+    Split a compilation unit into chunks within `budget_tokens` (~4 characters per token).
+    Every chunk keeps the package, imports, class skeleton, fields and constructors of the
+    primary type, and a group of its methods and nested types. Units larger than the
+    budget get a chunk of their own.
+    """
+    from com.github.javaparser import StaticJavaParser
+
+    cu = StaticJavaParser.parse(code)
+    if cu.getTypes().size() == 0:
+        return [code]
+    idx = _primary_type_index(cu)
+
+    skeleton = cu.clone()
+    for member in list(skeleton.getType(idx).getMembers()):
+        if _is_chunk_unit(member):
+            member.remove()
+    skeleton_code = str(skeleton.toString())
+
+    units = [x for x in cu.getType(idx).getMembers() if _is_chunk_unit(x)]
+    budget = max(budget_tokens * 4 - len(skeleton_code), 1)
+    groups, group, group_size = [], [], 0
+    for unit in units:
+        size = len(str(unit.toString()))
+        if len(group) > 0 and group_size + size > budget:
+            groups.append(group)
+            group, group_size = [], 0
+        group.append(unit)
+        group_size += size
+    if len(group) > 0:
+        groups.append(group)
+    if len(groups) <= 1:
+        return [code]
+
+    chunks = []
+    for group in groups:
+        chunk = skeleton.clone()
+        chunk_type = chunk.getType(idx)
+        for unit in group:
+            chunk_type.addMember(unit.clone())
+        chunks.append(str(chunk.toString()))
+    return chunks
+
+
+@jvm_op()
+def merge_benchmarks(codes: List[str]) -> Optional[str]:
+    """
+    Merge the benchmarks generated for the chunks of one source into the first benchmark class:
+    imports are united, members whose name (fields, types) or signature (methods) already exists
+    are dropped, other top level types are appended.
+    """
+    from com.github.javaparser import StaticJavaParser
+    from com.github.javaparser.ast.body import MethodDeclaration, FieldDeclaration, TypeDeclaration, ConstructorDeclaration
+
+    cus = []
+    for code in codes:
+        try:
+            cus.append(StaticJavaParser.parse(code))
+        except Exception as ex:
+            logging.warning(f"Skip a chunk benchmark which fails to parse: {str(ex)}")
+    cus = [x for x in cus if x.getTypes().size() > 0]
+    if len(cus) == 0:
+        return None
+
+    base = cus[0]
+    base_type = base.getType(_primary_type_index(base))
+
+    def member_keys(type_decl):
+        keys = set()
+        for member in type_decl.getMembers():
+            if isinstance(member, MethodDeclaration):
+                keys.add(('method', str(member.getSignature().asString())))
+            elif isinstance(member, FieldDeclaration):
+                keys.update(('field', str(v.getNameAsString())) for v in member.getVariables())
+            elif isinstance(member, TypeDeclaration):
+                keys.add(('type', str(member.getNameAsString())))
+        return keys
+
+    for cu in cus[1:]:
+        for imp in cu.getImports():
+            if imp not in base.getImports():
+                base.addImport(imp.clone())
+
+        other_idx = _primary_type_index(cu)
+        keys = member_keys(base_type)
+        for member in cu.getType(other_idx).getMembers():
+            if isinstance(member, ConstructorDeclaration):
+                continue
+            if isinstance(member, MethodDeclaration):
+                member_key = {('method', str(member.getSignature().asString()))}
+            elif isinstance(member, FieldDeclaration):
+                member_key = {('field', str(v.getNameAsString())) for v in member.getVariables()}
+            elif isinstance(member, TypeDeclaration):
+                member_key = {('type', str(member.getNameAsString()))}
+            else:
+                member_key = set()
+            if member_key & keys:
+                continue
+            base_type.addMember(member.clone())
+            keys |= member_key
+
+        type_names = {str(t.getNameAsString()) for t in base.getTypes()}
+        for i, type_decl in enumerate(cu.getTypes()):
+            if i != other_idx and str(type_decl.getNameAsString()) not in type_names:
+                base.addType(type_decl.clone())
+
+    return str(base.toString())
+
+
+_compilers: Dict[Tuple[Tuple[str, ...], str], Any] = {}
+_compilers_lock = threading.Lock()
+
+
+@jvm_op()
+def compile_batch(classpath: List[str], output_dir: str, files: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Batch compile with a warm compiler per (classpath, output_dir), see `IncrementalCompiler.compile_batch`."""
+    from java_compiler import IncrementalCompiler
+
+    key = (tuple(classpath), output_dir)
+    with _compilers_lock:
+        if key not in _compilers:
+            _compilers[key] = (IncrementalCompiler(classpath, Path(output_dir)), threading.Lock())
+        compiler, lock = _compilers[key]
+
+    with lock:
+        failed = compiler.compile_batch([Path(x) for x in files])
+    return {str(k): v for k, v in failed.items()}
+
+
+# ---------------------------------------------------------------- local dispatch
+
+
+def _run_op(op: str, kwargs: Dict[str, Any]) -> JvmResponse:
+    if op not in JVM_OPS:
+        return JvmResponse(ok=False, result=None, error=f'Unknown op {op}')
+    try:
+        lock = _op_locks.get(op)
+        if lock is None:
+            result = JVM_OPS[op](**kwargs)
+        else:
+            with lock:
+                result = JVM_OPS[op](**kwargs)
+        return JvmResponse(ok=True, result=result, error=None)
+    except Exception as ex:
+        return JvmResponse(ok=False, result=None, error=f'{type(ex).__name__}: {str(ex)}')
+
+
+# ---------------------------------------------------------------- client
+
+
+class JvmServiceClient:
+    """Send newline delimited JSON batches to a running service, one connection per thread."""
+
+    def __init__(self, socket_path: Path = SOCKET_PATH):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(str(self.socket_path))
+            conn = (sock, sock.makefile('rwb'))
+            self._local.conn = conn
+        return conn
+
+    def call_batch(self, requests: List[Tuple[str, Dict[str, Any]]]) -> List[JvmResponse]:
+        sock, stream = self._connection()
+        payload = {'requests': [{'op': op, 'kwargs': kwargs} for op, kwargs in requests]}
+        try:
+            stream.write(json.dumps(payload).encode('utf-8') + b'\n')
+            stream.flush()
+            line = stream.readline()
+        except OSError:
+            self._local.conn = None
+            raise
+        if not line:
+            self._local.conn = None
+            raise ConnectionError(f'JVM service at {self.socket_path} closed the connection')
+        return json.loads(line)['responses']
+
+
+_client: Optional[JvmServiceClient] = None
+
+
+def is_service_running(socket_path: Path = SOCKET_PATH) -> bool:
+    if not socket_path.exists():
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+        return True
+    except OSError:
+        return False
+
+
+def _get_client() -> Optional[JvmServiceClient]:
+    global _client
+    if _client is None and is_service_running():
+        logging.info(f"Using JVM service at {SOCKET_PATH}")
+        _client = JvmServiceClient()
+    return _client
+
+
+def call_batch(requests: List[Tuple[str, Dict[str, Any]]]) -> List[JvmResponse]:
+    """Run several ops in one round trip, in the service if it is running, otherwise in-process."""
+    client = _get_client()
+    if client is not None:
+        return client.call_batch(requests)
+    start_jvm()
+    return [_run_op(op, kwargs) for op, kwargs in requests]
+
+
+def call(op: str, **kwargs) -> Any:
+    response = call_batch([(op, kwargs)])[0]
+    if not response['ok']:
+        raise Exception(response['error'])
+    return response['result']
+
+
+# ---------------------------------------------------------------- server
+
+
+class JvmServiceHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                requests = json.loads(line)['requests']
+                responses = [_run_op(x['op'], x.get('kwargs', {})) for x in requests]
+            except Exception as ex:
+                responses = [JvmResponse(ok=False, result=None, error=f'Bad request: {str(ex)}')]
+            self.wfile.write(json.dumps({'responses': responses}).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class JvmServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path: Path):
+    start_jvm()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    if socket_path.exists():
+        socket_path.unlink()
+    with JvmServiceServer(str(socket_path), JvmServiceHandler) as server:
+        logging.info(f"JVM service is listening on {socket_path}, ops: {sorted(JVM_OPS.keys())}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=str(SOCKET_PATH))
+    args = parser.parse_args()
+
+    serve(Path(args.socket))
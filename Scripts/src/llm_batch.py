@@ -0,0 +1,160 @@
+import json
+import time
+import hashlib
+from typing import List, Dict, Any, Optional, Callable
+from pathlib import Path
+import logging
+from utils_llm import (get_commercial_model, LLMResult, PROVIDER_OF_MODEL, PROVIDER_MODEL_ID, SAMPLING_PARAMS,
+                       classify_error)
+from llm_cache import get_response_cache
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: providers exposing the OpenAI compatible files/batches endpoints
+BATCH_PROVIDERS = {'openai', 'deepseek'}
+BATCH_ENDPOINT = '/v1/chat/completions'
+FINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+def make_batch_lines(model_name: str, prompts: List[str]) -> List[Dict[str, Any]]:
+    """One JSONL request per prompt, with the same sampling parameters as the chat requests of `AsyncLLMClient`."""
+    params = SAMPLING_PARAMS[PROVIDER_OF_MODEL[model_name]]
+    model_id = PROVIDER_MODEL_ID.get(model_name, model_name)
+    return [{
+        'custom_id': str(i),
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {
+            'model': model_id,
+            'messages': [{'role': 'user', 'content': [{'type': 'text', 'text': prompt}]}],
+            **params,
+        },
+    } for i, prompt in enumerate(prompts)]
+
+
+def parse_batch_output(text: str) -> Dict[int, LLMResult]:
+    """Map the `custom_id` of every output (or error file) line to its result."""
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        index = int(entry['custom_id'])
+        response = entry.get('response') or {}
+        body = response.get('body') or {}
+        status = response.get('status_code', 0)
+        if entry.get('error') is None and status == 200 and body.get('choices'):
+            results[index] = LLMResult(text=body['choices'][0]['message']['content'], error_kind=None, error=None, attempts=1)
+            continue
+
+        error = entry.get('error') or body.get('error') or {}
+        message = error.get('message', str(error)) if isinstance(error, dict) else str(error)
+        ex = Exception(message or f'status {status}')
+        ex.status_code = status or None
+        results[index] = LLMResult(text=None, error_kind=classify_error(ex), error=message, attempts=1)
+    return results
+
+
+class BatchJob:
+    """
+    One provider batch of prompts, persisted under `work_dir` so an interrupted run resumes polling
+    the submitted batch instead of paying for it twice:
+
+        batch-<input hash>.jsonl   the submitted requests
+        batch-<input hash>.json    {"batch_id": ..., "status": ...}
+    """
+
+    def __init__(self, model_name: str, prompts: List[str], work_dir: Path):
+        provider = PROVIDER_OF_MODEL[model_name]
+        if provider not in BATCH_PROVIDERS:
+            raise ValueError(f"{model_name} has no OpenAI compatible batch endpoint, run it without --batch")
+        self.model_name = model_name
+        self.client = get_commercial_model(model_name).model
+        self.lines = make_batch_lines(model_name, prompts)
+
+        payload = '\n'.join(json.dumps(x, sort_keys=True) for x in self.lines) + '\n'
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+        work_dir.mkdir(parents=True, exist_ok=True)
+        self.input_path = work_dir / f'batch-{digest}.jsonl'
+        self.state_path = work_dir / f'batch-{digest}.json'
+        with open(self.input_path, 'w') as fd:
+            fd.write(payload)
+
+    def _load_state(self) -> Dict[str, Any]:
+        if not self.state_path.exists():
+            return {}
+        with open(self.state_path, 'r') as fd:
+            return json.load(fd)
+
+    def _save_state(self, state: Dict[str, Any]):
+        with open(self.state_path, 'w') as fd:
+            json.dump(state, fd, indent=2)
+
+    def submit(self) -> str:
+        state = self._load_state()
+        if state.get('batch_id') and state.get('status') not in ('failed', 'expired', 'cancelled'):
+            logging.info(f"Resume batch {state['batch_id']} of {self.input_path}")
+            return state['batch_id']
+
+        with open(self.input_path, 'rb') as fd:
+            input_file = self.client.files.create(file=fd, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window='24h')
+        logging.info(f"Submitted batch {batch.id} with {len(self.lines)} requests")
+        self._save_state({'batch_id': batch.id, 'status': batch.status})
+        return batch.id
+
+    def wait(self, batch_id: str, poll_interval: float = 30.0):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            self._save_state({'batch_id': batch_id, 'status': batch.status})
+            counts = getattr(batch, 'request_counts', None)
+            logging.info(f"Batch {batch_id}: {batch.status} {counts if counts is not None else ''}")
+            if batch.status in FINAL_STATUSES:
+                return batch
+            time.sleep(poll_interval)
+
+    def collect(self, batch) -> Dict[int, LLMResult]:
+        results = {}
+        for file_id in (batch.output_file_id, getattr(batch, 'error_file_id', None)):
+            if file_id:
+                results.update(parse_batch_output(self.client.files.content(file_id).text))
+        return results
+
+
+def run_batch(model_name: str, prompts: List[str], work_dir: Path,
+              on_result: Optional[Callable[[int, LLMResult], None]] = None, poll_interval: float = 30.0) -> List[LLMResult]:
+    """
+    Drop-in replacement of `prompt_many` through the provider batch endpoint: cached prompts are answered
+    locally, the rest is submitted as one JSONL batch, polled until done and returned in prompt order.
+    """
+    params = SAMPLING_PARAMS[PROVIDER_OF_MODEL[model_name]]
+    cache = get_response_cache()
+    results: List[Optional[LLMResult]] = [None] * len(prompts)
+    pending = []
+    for i, prompt in enumerate(prompts):
+        text = cache.get(model_name, prompt, params) if cache is not None else None
+        if text is None:
+            pending.append(i)
+            continue
+        results[i] = LLMResult(text=text, error_kind=None, error=None, attempts=0)
+        if on_result is not None:
+            on_result(i, results[i])
+
+    if len(pending) > 0:
+        job = BatchJob(model_name, [prompts[i] for i in pending], work_dir)
+        batch = job.wait(job.submit(), poll_interval)
+        batch_results = job.collect(batch)
+        for j, i in enumerate(pending):
+            result = batch_results.get(j, LLMResult(text=None, error_kind='unknown', error=f'batch {batch.status} without a result', attempts=1))
+            if result['text'] is not None and cache is not None:
+                cache.put(model_name, prompts[i], params, result['text'])
+            results[i] = result
+            if on_result is not None:
+                on_result(i, result)
+
+    failures = sum(1 for x in results if x['text'] is None)
+    logging.info(f"Batch answered {len(prompts) - failures}/{len(prompts)} prompts, {len(prompts) - len(pending)} from the cache")
+    return results
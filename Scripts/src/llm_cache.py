@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Any, Optional
+from pathlib import Path
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: set LLM4JMH_CACHE=off to disable the cache
+CACHE_PATH = os.environ.get('LLM4JMH_CACHE', 'results/llm-cache.sqlite')
+CACHE_MAX_MB = int(os.environ.get('LLM4JMH_CACHE_MAX_MB', '1024'))
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Ignore line endings and trailing whitespace, which do not change the answer."""
+    lines = prompt.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(x.rstrip() for x in lines).strip()
+
+
+def make_key(model_name: str, prompt: str, params: Dict[str, Any]) -> str:
+    payload = json.dumps({'model': model_name, 'prompt': normalize_prompt(prompt), 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of LLM responses keyed by (model, normalized prompt, sampling parameters).
+
+    Entries live in one SQLite file; the least recently used entries are evicted once the
+    stored responses exceed `max_bytes`. Hit/miss counters are persisted next to the entries.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = CACHE_MAX_MB * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, model TEXT, params TEXT, response TEXT, '
+            'size INTEGER, created_at REAL, accessed_at REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        self.conn.commit()
+        self.session_hits = 0
+        self.session_misses = 0
+
+    def _count(self, name: str):
+        self.conn.execute('INSERT INTO stats(name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+    def get(self, model_name: str, prompt: str, params: Dict[str, Any]) -> Optional[str]:
+        key = make_key(model_name, prompt, params)
+        with self.lock:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.session_misses += 1
+                self._count('misses')
+            else:
+                self.session_hits += 1
+                self._count('hits')
+                self.conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return None if row is None else row[0]
+
+    def put(self, model_name: str, prompt: str, params: Dict[str, Any], response: str):
+        key = make_key(model_name, prompt, params)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses(key, model, params, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, model_name, json.dumps(params, sort_keys=True), response, len(response.encode('utf-8')), now, now)
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY accessed_at ASC').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        self.conn.execute('INSERT INTO stats(name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?', ('evictions', evicted, evicted))
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            entries, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            counters = dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+            'session_hits': self.session_hits,
+            'session_misses': self.session_misses,
+        }
+
+    def export_jsonl(self, path: Path) -> int:
+        """Dump all entries as JSON lines, keyed by their hash so they can be imported on another machine."""
+        cnt = 0
+        with self.lock, open(path, 'w') as fd:
+            for key, model, params, response, created_at in self.conn.execute('SELECT key, model, params, response, created_at FROM responses'):
+                fd.write(json.dumps({'key': key, 'model': model, 'params': json.loads(params), 'response': response, 'created_at': created_at}) + '\n')
+                cnt += 1
+        return cnt
+
+    def import_jsonl(self, path: Path) -> int:
+        cnt = 0
+        now = time.time()
+        with self.lock, open(path, 'r') as fd:
+            for line in fd:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO responses(key, model, params, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (entry['key'], entry['model'], json.dumps(entry['params'], sort_keys=True), entry['response'],
+                     len(entry['response'].encode('utf-8')), entry.get('created_at', now), now)
+                )
+                cnt += 1
+            self._evict()
+            self.conn.commit()
+        return cnt
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _cache
+    if CACHE_PATH == 'off':
+        return None
+    if _cache is None:
+        _cache = ResponseCache(Path(CACHE_PATH))
+    return _cache
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=['stats', 'export', 'import'])
+    parser.add_argument("--path", type=str, default=CACHE_PATH, help='sqlite cache file')
+    parser.add_argument("--file", type=str, help='jsonl file for export/import')
+    args = parser.parse_args()
+
+    cache = ResponseCache(Path(args.path))
+    if args.action == 'stats':
+        print(json.dumps(cache.stats(), indent=2))
+    elif args.action == 'export':
+        logging.info(f"Exported {cache.export_jsonl(Path(args.file))} entries into {args.file}")
+    elif args.action == 'import':
+        logging.info(f"Imported {cache.import_jsonl(Path(args.file))} entries from {args.file}")
@@ -1,5 +1,5 @@
 import platform
-from typing import List, Tuple, Any, Optional, Literal
+from typing import List, Dict, Tuple, Any, Optional, Literal
 import sys
 import shutil
 import argparse
@@ -13,8 +13,13 @@ from multiprocessing import Pool, Process, Value
 from concurrent.futures import ProcessPoolExecutor
 import logging
 from multiprocessing import Manager
-from utils_llm import get_commercial_model, prompt_commercial_model
+from utils_llm import get_commercial_model, prompt_commercial_model, prompt_many, LLMResult, dead_letters_first, save_dead_letters, estimate_tokens
+from llm_batch import run_batch
 from utils import patch_jpype
+from java_compiler import compile_batch
+from diagnostics import diagnostics_of, normalize_diagnostics
+from jvm_service import call, call_batch
+from generation_manifest import GenerationManifest, content_hash
 from manager import get_manager
 
 logging.basicConfig(
@@ -92,29 +97,124 @@ Source Code:
     return prompt
 
 
+def get_llm_prompt_by_src_chunk(src_code: str, part: int, total: int) -> str:
+    prompt = f"""
+The source file is too large to be analyzed at once, it is split into {total} parts.
+This is part {part} of {total}: the class skeleton with its imports and fields, and a subset of its methods.
+Only consider the methods of this part, the other methods are handled separately.
+"""
+    return prompt + get_llm_prompt_by_src_code(src_code)
+
+
 def generate_performance_tests(model: str, prompt: str) -> str:
     client = get_commercial_model(model)
     resp = prompt_commercial_model(client, model, prompt, image_id="")
     return resp
 
-def generate_performance_tests_wrapper(args: Tuple[Any]):
-    model, source_file, save_path = args
-    if save_path.exists() and save_path.stat().st_size > 0:
-        logging.info(f"{str(save_path)} is generated from model {model}, skip")
-        return
-
-    save_path.parent.mkdir(exist_ok=True, parents=True)
+# NOTE: a changed prompt template invalidates every generated response
+PROMPT_TEMPLATE_HASH = content_hash(get_llm_prompt_by_src_code('{src_code}'))
+
+def prefilter_score(features: Dict[str, int]) -> int:
+    """
+    How likely a source is to need a benchmark: loops and I/O weigh most, then branching
+    beyond straight-line methods, then methods which are not plain getters or setters.
+    Interfaces, enums and constants-only classes without method bodies score 0.
+    """
+    if features['methods'] == 0 and features['cyclomatic'] == 0:
+        return 0
+    branching = features['cyclomatic'] - features['methods']
+    return 2 * features['loops'] + 2 * features['io_calls'] + max(branching, 0) + (features['methods'] - features['accessors'])
+
+def chunk_path(save_path: Path, part: int) -> Path:
+    return save_path.with_name(f'{save_path.stem}.chunk-{part}.txt')
+
+def prepare_generation_job(args: Tuple[Any]) -> List[Tuple[Path, str]]:
+    """Return the (save path, prompt) pairs still to be generated for one source file, one per chunk of a large file."""
+    model, source_file, save_path, manifest, key, chunk_tokens, prefilter_threshold = args
     with open(source_file, 'r') as fd:
         code = fd.read()
 
     pure_code = remove_java_comments(code)
-    code_with_prompt = get_llm_prompt_by_src_code(pure_code)
+    source_hash = content_hash(pure_code)
+    generated = save_path.exists() and save_path.stat().st_size > 0
+    entry = manifest.get(key)
+    if generated and (entry is None or 'source_hash' not in entry):
+        # NOTE: generated before the manifest existed, assume it matches the current source
+        manifest.update(key, source_hash=source_hash, prompt_hash=PROMPT_TEMPLATE_HASH)
+    elif entry is not None and not manifest.is_up_to_date(key, source_hash, PROMPT_TEMPLATE_HASH):
+        logging.info(f"{key} changed since the last generation, regenerate")
+        manifest.mark_changed(key)
+        generated = False
+
+    if generated:
+        logging.info(f"{str(save_path)} is generated from model {model}, skip")
+        return []
 
-    args = (model, code_with_prompt)
-    logging.info(f"Will save the response into save_path: {save_path}")
-    raw_resp = generate_performance_tests(*args)
+    save_path.parent.mkdir(exist_ok=True, parents=True)
+    manifest.update(key, source_hash=source_hash, prompt_hash=PROMPT_TEMPLATE_HASH)
+    manifest.discard(key, 'chunks', 'prefilter')
+    if prefilter_threshold is not None:
+        try:
+            score = prefilter_score(call('source_features', code=pure_code))
+        except Exception as ex:
+            logging.error(f"Fail to extract static features of {key}, prompt it anyway, ex: {str(ex)}")
+            score = None
+        if score is not None:
+            skipped = score < prefilter_threshold
+            manifest.update(key, prefilter={'score': score, 'threshold': prefilter_threshold, 'skipped': skipped})
+            if skipped:
+                logging.info(f"{key} scores {score} < {prefilter_threshold}, skip without prompting")
+                return []
+    if chunk_tokens is None or estimate_tokens(pure_code) <= chunk_tokens:
+        code_with_prompt = get_llm_prompt_by_src_code(pure_code)
+        return [(save_path, code_with_prompt)]
+
+    try:
+        chunks = call('split_methods', code=pure_code, budget_tokens=chunk_tokens)
+    except Exception as ex:
+        logging.error(f"Fail to split {key} into chunks, prompt the whole file, ex: {str(ex)}")
+        chunks = [pure_code]
+    if len(chunks) == 1:
+        return [(save_path, get_llm_prompt_by_src_code(pure_code))]
+
+    logging.info(f"Split {key} into {len(chunks)} chunks")
+    manifest.update(key, chunks=len(chunks))
+    return [(chunk_path(save_path, i), get_llm_prompt_by_src_chunk(chunk, i + 1, len(chunks)))
+            for i, chunk in enumerate(chunks) if not chunk_path(save_path, i).exists()]
+
+def merge_chunk_responses(save_path: Path, n_chunks: int) -> bool:
+    """Merge the benchmarks answered for every chunk into `save_path`, False if some chunk is still missing."""
+    paths = [chunk_path(save_path, i) for i in range(n_chunks)]
+    if not all(x.exists() for x in paths):
+        return False
+
+    codes = []
+    for path in paths:
+        with open(path, 'r') as fd:
+            code = extract_code_in_backticks(fd.read())
+        if code is not None:
+            codes.append(code)
+
+    merged = call('merge_benchmarks', codes=codes) if len(codes) > 0 else None
     with open(save_path, 'w') as fd:
-        fd.write(raw_resp)
+        if merged is None:
+            fd.write(f'SKIP: none of the {n_chunks} chunks needs a benchmark')
+        else:
+            fd.write(f'```java\n{merged}```\n')
+    logging.info(f"Merged {len(codes)}/{n_chunks} chunk benchmarks into {str(save_path)}")
+    return True
+
+def save_response(save_path: Path, result: LLMResult):
+    if result['text'] is None:
+        logging.error(f"No response for {save_path} ({result['error_kind']}), will retry in the next run")
+        return
+    logging.info(f"Save the response into save_path: {save_path}")
+    with open(save_path, 'w') as fd:
+        fd.write(result['text'])
+    if result.get('code') is not None and '.chunk-' not in save_path.name:
+        # NOTE: streamed answers come with their code block, no need to extract it again from the file
+        with open(save_path.with_suffix(''), 'w') as fd:
+            fd.write(result['code'])
 
 def extract_code_in_backticks(unprocessed_code) -> Optional[str]:
     pattern = r"```.*?\n(.*?)```"
@@ -124,49 +224,47 @@ def extract_code_in_backticks(unprocessed_code) -> Optional[str]:
     return codes[0]
 
 def save_code(save_path: Path) -> Literal[0, 1]:
+    if 'repair-' in str(save_path):
+        final_save_path = save_path.parent / save_path.name.split('.repair')[0]
+    else:
+        final_save_path = save_path.with_suffix('')
+
     skip_cnt = 0
     with open(save_path, 'r') as fd:
         raw_code = fd.read()
     if 'SKIP' in raw_code:
         skip_cnt += 1
 
+    if final_save_path.exists() and final_save_path.stat().st_mtime >= save_path.stat().st_mtime:
+        # NOTE: already written from the streamed answer, skip the regex pass and the second write
+        return skip_cnt
+
     only_code = extract_code_in_backticks(raw_code)
     if only_code is None:
         # logging.info(f"{str(source_file)} is no need to create jmh according to model {model}")
         return skip_cnt
 
-    if 'repair-' in str(save_path):
-        final_save_path = save_path.parent / save_path.name.split('.repair')[0]
-    else:
-        final_save_path = save_path.with_suffix('')
-
     with open(final_save_path, 'w') as fd:
         fd.write(only_code)
 
     return skip_cnt
 
-def grok_gradlew_error_message(output: str) -> str:
-    pattern = re.compile(
-        r'> Task :compileJmhJava FAILED\n'       # Match the task failure line
-        r'(?:.|\n)*?'                             # Lazily match any content
-        r'\n\d+ error(s?)',                       # Match final error count line
-        re.MULTILINE
-    )
-
-    match = pattern.search(output)
-    if match:
-        logging.info('############################################################')
-        logging.error(match.group())
-        logging.info('############################################################')
-        return match.group()
-    else:
-        logging.info("No compile error block found.")
-        return ''
-
-def grok_maven_error_message(output: str) -> str:
-    errors = [x for x in output.split('\n') if 'ERROR' in x or 'Compilation failure' in x]
-    return '\n'.join(errors)
-
+def write_prefilter_report(save_dir: Path, manifest: GenerationManifest, threshold: int):
+    scores = {key: entry['prefilter']['score'] for key, entry in manifest.entries.items()
+              if entry.get('prefilter', {}).get('threshold') == threshold}
+    skipped = sorted(key for key, score in scores.items() if score < threshold)
+    report = {
+        'threshold': threshold,
+        'scored_files': len(scores),
+        'skipped_files': len(skipped),
+        # NOTE: one generation request per skipped file, chunked files would have cost more
+        'avoided_llm_calls': len(skipped),
+        'skipped': {key: scores[key] for key in skipped},
+    }
+    save_dir.mkdir(parents=True, exist_ok=True)
+    with open(save_dir / 'prefilter-report.json', 'w') as fd:
+        json.dump(report, fd, indent=2)
+    logging.info(f"Pre-filter skipped {len(skipped)}/{len(scores)} scored source files without prompting the LLM")
 
 @patch_jpype
 def main(args):
@@ -200,19 +298,38 @@ def main(args):
 
     logging.info(f"Total source files: {len(source_files)}")
 
+    # NOTE: only sources whose comment-stripped text or prompt template changed are regenerated
+    manifest = GenerationManifest(save_dir)
     args_list = []
     for src_dir, source_file in source_files:
-        _args = (model, src_dir / source_file, save_dir / f'{str(source_file)}.txt')
+        _args = (model, src_dir / source_file, save_dir / f'{str(source_file)}.txt', manifest, str(source_file), args.chunk_tokens, args.prefilter_threshold)
         args_list.append(_args)
 
     # args_list = args_list[:10]
-    if args.parallel:
-        with Pool(64) as pool:
-            pool.map(generate_performance_tests_wrapper, args_list)
-        pool.join()
+    jobs = [job for jobs in map(prepare_generation_job, args_list) for job in jobs]
+    if args.prefilter_threshold is not None:
+        write_prefilter_report(save_dir, manifest, args.prefilter_threshold)
+    # NOTE: requests which failed in the last run are retried first
+    dead_letter_path = save_dir / 'dead-letter.json'
+    jobs = dead_letters_first(jobs, dead_letter_path)
+    logging.info(f"Prompting {model} for {len(jobs)} source files")
+    # NOTE: one pooled client, throughput is bounded by the provider quota instead of process fan-out
+    if args.batch:
+        # NOTE: one provider batch instead of synchronous calls, slower to finish but cheaper for bulk runs
+        results = run_batch(model, [prompt for _, prompt in jobs], save_dir / 'batches', lambda i, res: save_response(jobs[i][0], res))
     else:
-        for _args in args_list:
-            generate_performance_tests_wrapper(_args)
+        results = prompt_many(model, [prompt for _, prompt in jobs], lambda i, res: save_response(jobs[i][0], res),
+                              max_in_flight=args.concurrency if args.parallel else 1, rpm=args.rpm, tpm=args.tpm,
+                              stream=args.stream)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    save_dead_letters(dead_letter_path, {str(jobs[i][0]): res for i, res in enumerate(results) if res['text'] is None})
+    for _, source_file in source_files:
+        entry = manifest.get(str(source_file))
+        save_path = save_dir / f'{str(source_file)}.txt'
+        if entry is not None and entry.get('chunks') and not save_path.exists():
+            merge_chunk_responses(save_path, entry['chunks'])
+    manifest.save()
+    logging.info(f"Changed source files since the last generation: {len(manifest.changed)}")
 
     # skip_cnt = 0
     # for source_file in source_files:
@@ -222,7 +339,8 @@ def main(args):
     #     save_path = save_dir / args.model / f'{str(source_file.relative_to(src_dir))}.repair-{0}.txt'
     #     if save_path.exists():
     #         skip_cnt += save_code(save_path)
-    return
+    if not args.compile:
+        return
     skip_cnt = 0
     for src_dir, source_file in source_files:
         save_path = save_dir / f'{str(source_file)}.txt'
@@ -240,110 +358,84 @@ def main(args):
     subpackages = mgr.get_all_subpackages()
     # subpackages.append('org.openjdk.jmh.infra.Blackhole')
 
-    # llm2jmh_dir = Path(f'{mgr.cwd}/{to_branch}/src/test/java')
-    if args.project == 'eclipse-collections':
-        llm2jmh_dir = Path(f'{mgr.cwd}/{to_branch}/src/main/java')
-    elif args.project == 'rxjava':
-        llm2jmh_dir = Path(f'{mgr.cwd}/{to_branch}/java')
-    elif args.project == 'zipkin':
-        llm2jmh_dir = Path(f'{mgr.cwd}/{to_branch}/src/main/java')
-    # if llm2jmh_dir.exists():
-    #     shutil.rmtree(str(llm2jmh_dir))
-    elif args.project == 'flink-17799':
-        llm2jmh_dir = Path(f'{mgr.cwd}/{to_branch}/src/main/java')
-
-    elif args.project == 'flink-16536':
-        llm2jmh_dir = Path(f'{mgr.cwd}/{to_branch}/src/main/java')
+    llm2jmh_dir = mgr.get_benchmark_src_dir(to_branch)
 
     valid_java_files = 0
     compiled_java_files = 0
     code_need_repair = {}
+    dst_to_java_file = {}
 
-    import jpype
-    from com.github.javaparser import StaticJavaParser
-    from com.github.javaparser.ast.body import ClassOrInterfaceDeclaration
-    # StaticJavaParser = jpype.JClass("com.github.javaparser.StaticJavaParser")
-    # ClassOrInterfaceDeclaration = jpype.JClass("com.github.javaparser.ast.body.ClassOrInterfaceDeclaration")
+    # NOTE: resolve the classpath once and check the generated files with the warm javac of the jvm service,
+    # the maven/gradle build only runs once at the end to produce the benchmark jar
+    classpath = mgr.resolve_classpath(to_branch)
+    classes_dir = Path(f'./tmp/{mgr.cwd}/{to_branch}/classes')
 
+    imports = [f'{package}.*' for package in subpackages] + ['org.openjdk.jmh.infra.Blackhole']
+    requests = []
     for java_file in java_files:
         with open(java_file, 'r') as fd:
             code = fd.read()
-        try:
-            cu = StaticJavaParser.parse(code)
-        except Exception as ex:
+        dst_jmh_dir = (llm2jmh_dir / java_file.relative_to(save_dir)).parent
+        pkg_name = str(dst_jmh_dir.relative_to(llm2jmh_dir)).replace('/', '.')
+        requests.append(('relocate_benchmark', {'code': code, 'package': pkg_name, 'imports': imports}))
+    responses = call_batch(requests)
+
+    for java_file, response in zip(java_files, responses):
+        if not response['ok']:
             logging.info(f'{java_file} fail to parse')
             continue
 
-        top_level_classes = [t.getNameAsString() for t in cu.getTypes() if isinstance(t, ClassOrInterfaceDeclaration) and not t.isInterface()]
-
+        top_level_classes = response['result']['classes']
         if len(top_level_classes) != 1:
             print(top_level_classes)
-            # import ipdb; ipdb.set_trace()
+            if len(top_level_classes) == 0:
+                continue
 
         class_name = top_level_classes[0]
 
-        for package in subpackages:
-            try:
-                cu.addImport(f'{package}.*')
-            except Exception as ex:
-                logging.error(f"Fail to add package {package}")
-                # import ipdb; ipdb.set_trace()
-
-        cu.addImport('org.openjdk.jmh.infra.Blackhole')
-
         dst_jmh_dir = (llm2jmh_dir / java_file.relative_to(save_dir)).parent
         dst_jmh_dir.mkdir(parents=True, exist_ok=True)
         dst_jmh_file = dst_jmh_dir / f'{class_name}.java'
 
         if dst_jmh_file.exists() and dst_jmh_file.stat().st_size > 0:
+            manifest.update(str(java_file.relative_to(save_dir)), benchmark=str(dst_jmh_file))
             compiled_java_files += 1
             valid_java_files += 1
             continue
 
-
-        pkg_decl = cu.getPackageDeclaration()
-        if pkg_decl.isPresent():
-            cu.removePackageDeclaration()
-
-        pkg_name = str(dst_jmh_dir.relative_to(llm2jmh_dir)).replace('/', '.')
-        cu.setPackageDeclaration(pkg_name)
-
-        code = str(cu.toString())
-
         with open(dst_jmh_file, 'w') as fd:
-            fd.write(code)
-
-        logging.info(f"Try compile with {dst_jmh_file}")
-        try:
-            mgr.compile(to_branch)
-            compiled_java_files += 1
-        except Exception as ex:
-            if 'FAILED' in ex.output:
-                # NOTE: rxjava compilation error message
-                logging.error("------------------------------------------------------------")
-                logging.error(f"Fail to compile the java code {str(dst_jmh_file)}, {ex.output}")
-                err_msg = grok_gradlew_error_message(ex.output)
-                code_need_repair[str(java_file)] = err_msg
-                dst_jmh_file.unlink()
-                logging.error("------------------------------------------------------------")
-            elif 'ERROR' in ex.output:
-                logging.error("------------------------------------------------------------")
-                logging.error(f"Fail to compile the java code {str(dst_jmh_file)}, {ex.output}")
-                err_msg = grok_maven_error_message(ex.output)
-                code_need_repair[str(java_file)] = err_msg
-                dst_jmh_file.unlink()
-                logging.error("------------------------------------------------------------")
-            else:
-                logging.info(f"Compile java code successfully, {str(dst_jmh_file)}")
-                import ipdb; ipdb.set_trace()
-                dst_jmh_file.unlink()
+            fd.write(response['result']['code'])
 
+        dst_to_java_file[dst_jmh_file] = java_file
         valid_java_files += 1
 
+    # NOTE: compile all candidates in one javac task, diagnostics are split per source file
+    logging.info(f"Try compile {len(dst_to_java_file)} generated jmh files")
+    failed = compile_batch(classpath, classes_dir, list(dst_to_java_file.keys()))
+    compiled_java_files += len(dst_to_java_file) - len(failed)
+    for dst_jmh_file, diagnostics in failed.items():
+        java_file = dst_to_java_file[dst_jmh_file]
+        err_msg = normalize_diagnostics(diagnostics_of(diagnostics, dst_jmh_file), dst_jmh_file.read_text())
+        logging.error("------------------------------------------------------------")
+        logging.error(f"Fail to compile the java code {str(dst_jmh_file)}, {err_msg}")
+        logging.error("------------------------------------------------------------")
+        code_need_repair[str(java_file)] = err_msg
+        dst_jmh_file.unlink()
+
+    for dst_jmh_file, java_file in dst_to_java_file.items():
+        if dst_jmh_file not in failed:
+            manifest.update(str(java_file.relative_to(save_dir)), benchmark=str(dst_jmh_file))
+    manifest.save()
+
     with open(save_dir / f'repair-list-{repair_cnt}.json', 'w') as fd:
         json.dump(code_need_repair, fd, indent=2)
 
     logging.info(f"Analayze source code: {len(source_files)}, generated jmh files: {len(java_files)}, skip from respponse: {skip_cnt}, valid java file/compiled java file: {valid_java_files}/{compiled_java_files}")
+    try:
+        logging.info(f"Building jmh jar for [{mgr.cwd}]-[{to_branch}]...")
+        mgr.compile(to_branch)
+    except Exception as ex:
+        logging.error(f"Fail to build the jmh jar of {to_branch}, ex: {str(ex)}")
     mgr.checkout_new_branch(to_branch)
 
 
@@ -354,7 +446,15 @@ if __name__ ==  "__main__":
     parser.add_argument("--model", type=str, default='deepseek-chat')
     parser.add_argument("--strategy", type=str, default=None, help='with-junit')
     parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=64, help='max in-flight requests with --parallel')
+    parser.add_argument('--rpm', type=float, default=None, help='requests per minute limit of the provider')
+    parser.add_argument('--tpm', type=float, default=None, help='tokens per minute limit of the provider')
+    parser.add_argument('--stream', action='store_true', help='stream answers, cancel them after SKIP or the first code block')
+    parser.add_argument('--batch', action='store_true', help='submit all prompts through the provider batch endpoint')
     parser.add_argument('--repair_cnt', type=int, default=0)
+    parser.add_argument('--prefilter_threshold', type=int, default=None, help='skip sources whose static score is below this without prompting, e.g. 2')
+    parser.add_argument('--chunk_tokens', type=int, default=None, help='split sources larger than this many tokens into method chunks')
+    parser.add_argument('--compile', action='store_true', help='compile generated jmh files after generation')
     args = parser.parse_args()
 
     main(args)
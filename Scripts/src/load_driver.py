@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+from typing import List, Dict, Any
+from pathlib import Path
+import logging
+from mock_llm_server import MockState, ReplayIndex, FaultInjector, make_server, DEFAULT_RESPONSE
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: the sdks refuse to start without a key, the mock server ignores it
+MOCK_KEYS = {
+    'OPENAI_API_KEY': 'mock',
+    'DEEPSEEK_API_KEY': 'mock',
+    'ANTHROPIC_API_KEY': 'mock',
+    'GOOGLE_API_KEY': 'mock',
+}
+
+
+def mock_env(base_url: str, cache: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({k: v for k, v in MOCK_KEYS.items() if not env.get(k)})
+    env.update({
+        'OPENAI_BASE_URL': f'{base_url}/v1',
+        'DEEPSEEK_BASE_URL': f'{base_url}/v1',
+        'ANTHROPIC_BASE_URL': base_url,
+        'GEMINI_BASE_URL': base_url,
+        'LLM4JMH_CACHE': cache,
+    })
+    return env
+
+
+def run_generation(args, concurrency: int, base_url: str, cache: str) -> Dict[str, Any]:
+    """Run llm_gen once against the mock server into a scratch strategy dir and measure files per minute."""
+    strategy = f'loadtest-c{concurrency}'
+    save_dir = Path(f'results/projects/{args.project}/generated/{args.model}-{strategy}')
+    if save_dir.exists():
+        shutil.rmtree(save_dir)
+    manifest_path = save_dir.parent / f'{save_dir.name}.manifest.json'
+    if manifest_path.exists():
+        manifest_path.unlink()
+
+    cmd = [sys.executable, str(Path(__file__).parent / 'llm_gen.py'), '--project', args.project, '--model', args.model,
+           '--strategy', strategy, '--parallel', '--concurrency', str(concurrency)]
+    if args.stream:
+        cmd.append('--stream')
+    if args.rpm is not None:
+        cmd.extend(['--rpm', str(args.rpm)])
+    logging.info(f"Running {' '.join(cmd)}")
+    start = time.time()
+    proc = subprocess.run(cmd, env=mock_env(base_url, cache))
+    elapsed = time.time() - start
+
+    answered = len([x for x in save_dir.rglob('*.txt')]) if save_dir.exists() else 0
+    return {
+        'concurrency': concurrency,
+        'returncode': proc.returncode,
+        'seconds': round(elapsed, 2),
+        'answered_files': answered,
+        'files_per_minute': round(answered / elapsed * 60, 2) if elapsed > 0 else 0.0,
+    }
+
+
+def main(args):
+    replay = ReplayIndex([Path(x) for x in args.replay]) if len(args.replay) > 0 else None
+    report: List[Dict[str, Any]] = []
+    for concurrency in args.concurrency:
+        for cache_mode in args.cache:
+            faults = FaultInjector(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_limit_rpm=args.rate_limit_rpm,
+                                   error_rate=args.error_rate, timeout_rate=args.timeout_rate, hang_s=args.hang_s,
+                                   tokens_per_second=args.tokens_per_second)
+            state = MockState(DEFAULT_RESPONSE, replay, faults)
+            server = make_server('127.0.0.1', 0, state)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+            # NOTE: `off` measures the provider path, `fresh` fills an empty cache, `warm` replays the cache of `fresh`
+            cache_path = Path(f'./tmp/loadtest/llm-cache-c{concurrency}.sqlite')
+            if cache_mode == 'fresh' and cache_path.exists():
+                cache_path.unlink()
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache = 'off' if cache_mode == 'off' else str(cache_path)
+            try:
+                result = run_generation(args, concurrency, base_url, cache)
+            finally:
+                server.shutdown()
+                server.server_close()
+            result.update({'cache': cache_mode, 'server': dict(state.counters)})
+            logging.info(f"Load test result: {result}")
+            report.append(result)
+
+    report_path = Path(f'results/loadtest-{args.project}-{args.model}.json')
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, 'w') as fd:
+        json.dump(report, fd, indent=2)
+
+    print(f"{'concurrency':>12} {'cache':>6} {'files':>6} {'seconds':>8} {'files/min':>10} {'429':>5} {'500':>5}")
+    for x in report:
+        print(f"{x['concurrency']:>12} {x['cache']:>6} {x['answered_files']:>6} {x['seconds']:>8} {x['files_per_minute']:>10} "
+              f"{x['server']['rate_limit']:>5} {x['server']['server']:>5}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", type=str, required=True, help='rxjava, eclipse-collections, zipkin')
+    parser.add_argument("--model", type=str, default='deepseek-chat')
+    parser.add_argument("--replay", type=str, nargs='*', default=[], help='generated dirs to replay, e.g. results/projects/rxjava/generated/deepseek-chat')
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[8, 32, 64])
+    parser.add_argument("--cache", type=str, nargs='+', default=['off'], choices=['off', 'fresh', 'warm'])
+    parser.add_argument("--stream", action='store_true')
+    parser.add_argument("--rpm", type=float, default=None, help='client side requests per minute limit')
+    parser.add_argument("--latency_ms", type=float, default=500.0)
+    parser.add_argument("--jitter_ms", type=float, default=200.0)
+    parser.add_argument("--tokens_per_second", type=float, default=None)
+    parser.add_argument("--rate_limit_rpm", type=float, default=None, help='server side limit answered with 429')
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--timeout_rate", type=float, default=0.0)
+    parser.add_argument("--hang_s", type=float, default=30.0)
+    args = parser.parse_args()
+
+    main(args)
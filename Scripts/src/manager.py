@@ -1,14 +1,24 @@
 import platform
-from typing import List, Union, Literal, Optional
+from typing import List, Dict, Union, Literal, Optional, Iterator
 import sys
+import copy
+import time
+import fcntl
+import tempfile
+import threading
 import shutil
 import subprocess
 import os
 from pathlib import Path
 from collections import defaultdict, Counter
+from contextlib import contextmanager
 import re
 import json
+import hashlib
 import logging
+from benchmark_list import read_benchmark_list, benchmark_names
+from build_cache import get_build_cache
+from incremental_build import base_branch_of, build_mutant_jar
 
 
 logging.basicConfig(
@@ -16,8 +26,33 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+WORKTREE_ROOT = Path('./tmp/worktrees')
+# NOTE: set LLM4JMH_WORKTREES to bound the checked out copies of a project, one per core by default
+MAX_WORKTREES = int(os.environ.get('LLM4JMH_WORKTREES', str(os.cpu_count() or 1)))
+BUILD_LOCK_DIR = Path('./tmp/build-locks')
+_build_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+_build_locks_guard = threading.Lock()
+
+
+@contextmanager
+def build_lock(name: str) -> Iterator[None]:
+    """One build of a jar at a time, across the threads of this process and other processes."""
+    with _build_locks_guard:
+        lock = _build_locks[name]
+    with lock:
+        BUILD_LOCK_DIR.mkdir(parents=True, exist_ok=True)
+        with open(BUILD_LOCK_DIR / f'{name}.lock', 'w') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
 
 class Manager:
+    # NOTE: the clone under projects/ a worktree manager was derived from, see `at`
+    origin_cwd: Optional[str] = None
+
     def run_cmd(self, cmd: str, cwd: Optional[str] = None):
         _cwd = self.cwd if cwd is None else cwd
         try:
@@ -69,6 +104,65 @@ class Manager:
         cmd = f'git checkout {file}'
         self.run_cmd(cmd)
 
+    def commit_to_branch(self, branch: str, path: str, msg: str):
+        """Commit the changes under `path` of a detached worktree and move `branch` onto the new commit."""
+        self.run_cmd(f'git add {path}')
+        if self.run_cmd('git status --porcelain --untracked-files=no').stdout.strip() == '':
+            return
+        self.run_cmd(f'git commit -q -m "{msg}"')
+        # NOTE: git refuses to force-move a branch checked out elsewhere, e.g. in the main clone after
+        # `checkout_branch`, detach that checkout first so its next checkout picks up the new commit
+        for worktree in self.checked_out_at(branch):
+            logging.info(f"Detaching {worktree} from {branch} before moving the branch")
+            self.run_cmd(f'git -C {worktree} checkout -q --detach')
+        self.run_cmd(f'git update-ref refs/heads/{branch} HEAD HEAD~1')
+
+    def checked_out_at(self, branch: str) -> List[str]:
+        """Worktrees of this repository, the main clone included, which have `branch` checked out."""
+        worktrees, path = [], None
+        for line in self.run_cmd('git worktree list --porcelain').stdout.split('\n'):
+            if line.startswith('worktree '):
+                path = line[len('worktree '):]
+            elif line == f'branch refs/heads/{branch}':
+                worktrees.append(path)
+        return worktrees
+
+    def list_files(self, rev: str, paths: List[str]) -> Dict[str, str]:
+        """Path to file mode of every file under `paths` at `rev`, without checking it out."""
+        listing = self.run_cmd(f"git ls-tree -r {rev} -- {' '.join(paths)}").stdout
+        files = {}
+        for line in listing.split('\n'):
+            if line:
+                meta, path = line.split('\t', 1)
+                files[path] = meta.split()[0]
+        return files
+
+    def commit_file(self, base: str, path: str, content: str, mode: str, msg: str) -> str:
+        """
+        Commit `content` as `path` on top of `base` with git plumbing and a private index, return the commit.
+        No checkout is touched and no branch is moved, so many commits can be made at the same time.
+        """
+        Path('./tmp').mkdir(exist_ok=True)
+        with tempfile.TemporaryDirectory(dir='./tmp') as tmp_dir:
+            blob_file = Path(tmp_dir) / 'blob'
+            blob_file.write_text(content)
+            index = f'GIT_INDEX_FILE={Path(tmp_dir).resolve() / "index"}'
+            blob = self.run_cmd(f'git hash-object -w {blob_file.resolve()}').stdout.strip()
+            self.run_cmd(f'{index} git read-tree {base} && {index} git update-index --cacheinfo {mode},{blob},{path}')
+            tree = self.run_cmd(f'{index} git write-tree').stdout.strip()
+        return self.run_cmd(f'git commit-tree {tree} -p {base} -m "{msg}"').stdout.strip()
+
+    def update_branches(self, branch_to_commit: Dict[str, str]):
+        """Point every branch at its commit in one `git update-ref` transaction."""
+        Path('./tmp').mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir='./tmp', suffix='.refs') as fd:
+            fd.write(''.join(f'update refs/heads/{branch} {commit}\n' for branch, commit in branch_to_commit.items()))
+            fd.flush()
+            self.run_cmd(f'git update-ref --stdin < {Path(fd.name).resolve()}')
+
+    def delete_branch(self, branch: str):
+        self.run_cmd(f'git branch -D {branch}')
+
     def is_branch_exists(self, branch: str) -> bool:
         cmd = f"git show-ref --verify refs/heads/{branch}"
         try:
@@ -77,13 +171,74 @@ class Manager:
         except Exception as ex:
             return False
 
-    def commit_injected_bug(self, file: str, msg: str):
-        cmd = f'git add {file}'
-        self.run_cmd(cmd)
-        cmd = f'git commit -m "{msg}"'
-        self.run_cmd(cmd)
+    def at(self, cwd: str) -> 'Manager':
+        """A copy of this manager rooted at another checkout of the same project, e.g. a worktree."""
+        mgr = copy.copy(self)
+        mgr.cwd = cwd
+        mgr.origin_cwd = self.origin_cwd or self.cwd
+
+        def rebase(x):
+            if isinstance(x, Path) and x.is_relative_to(self.cwd):
+                return Path(cwd) / x.relative_to(self.cwd)
+            if isinstance(x, list):
+                return [rebase(y) for y in x]
+            return x
+
+        for name, value in vars(self).items():
+            setattr(mgr, name, rebase(value))
+        return mgr
+
+    def _acquire_worktree_slot(self, pool_dir: Path, branch: str):
+        """Lock a free slot of the pool, preferring one which had `branch` checked out last for incremental builds."""
+        slots = list(range(MAX_WORKTREES))
+        slots.sort(key=lambda n: (pool_dir / f'slot-{n}.branch').exists() and (pool_dir / f'slot-{n}.branch').read_text() == branch, reverse=True)
+        while True:
+            for n in slots:
+                fd = open(pool_dir / f'slot-{n}.lock', 'w')
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return n, fd
+                except BlockingIOError:
+                    fd.close()
+            time.sleep(1)
+
+    @contextmanager
+    def worktree(self, branch: str) -> Iterator['Manager']:
+        """
+        Check out `branch` (detached) into a free worktree of the pool under ./tmp/worktrees/<project> and
+        yield a manager rooted there, so several branches can be built or edited at the same time without
+        touching the main clone. Branches created inside are released again on exit.
+        """
+        origin_cwd = self.origin_cwd or self.cwd
+        pool_dir = WORKTREE_ROOT / Path(origin_cwd).name
+        pool_dir.mkdir(parents=True, exist_ok=True)
+        slot, lock_fd = self._acquire_worktree_slot(pool_dir, branch)
+        path = (pool_dir / f'slot-{slot}').resolve()
+        try:
+            rev = branch if self.is_branch_exists(branch) else f'origin/{branch}'
+            if not (path / '.git').exists():
+                # NOTE: `worktree add` writes into the shared .git, one at a time
+                with open(pool_dir / 'pool.lock', 'w') as pool_lock:
+                    fcntl.flock(pool_lock, fcntl.LOCK_EX)
+                    self.run_cmd('git worktree prune', origin_cwd)
+                    self.run_cmd(f'git worktree add --detach {path} {rev}', origin_cwd)
+            else:
+                self.run_cmd(f'git checkout -q -f --detach {rev} && git clean -q -fd', str(path))
+            (pool_dir / f'slot-{slot}.branch').write_text(branch)
+            yield self.at(str(path))
+        finally:
+            try:
+                self.run_cmd('git checkout -q --detach', str(path))
+            except Exception:
+                pass
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            lock_fd.close()
 
     def list_benchmark_methods(self, jar_path: Path) -> List[str]:
+        try:
+            return benchmark_names(read_benchmark_list(jar_path), self.package)
+        except Exception as ex:
+            logging.error(f"Fail to read the benchmark list of {jar_path}, fall back to `-l`, ex: {str(ex)}")
         cmd = f'java  --add-opens java.base/java.io=ALL-UNNAMED -jar {jar_path.resolve()} -l | grep "{self.package}"'
         methods = self.run_cmd(cmd)
         methods = methods.stdout.split('\n')
@@ -105,14 +260,14 @@ class Manager:
                     packages.add(package_name)
         return sorted(list(packages))
 
-    def unzip_jar_for_class_dirs(self):
+    def unzip_jar_for_class_dirs(self, jar_path: Optional[Path] = None):
         import zipfile
         import shutil
         target_dir = Path(f"./tmp/{self.cwd}/{self.branch}")
         # if target_dir.exists():
         #     shutil.rmtree(target_dir.resolve())
         target_dir.mkdir(parents=True, exist_ok=True)
-        with zipfile.ZipFile(self.jar_path, 'r') as jar:
+        with zipfile.ZipFile(jar_path or self.jar_path, 'r') as jar:
             # jar.extractall(target_dir.resolve())
             for member in jar.infolist():
                 if member.is_dir():
@@ -125,21 +280,112 @@ class Manager:
         self.class_dirs = [Path(f'{(target_dir / self.package.replace(".", "/")).resolve()}')]
         return self.class_dirs
 
-    def compile_if_needed(self, branch: str):
-        jar_path = Path(f'./tmp/{self.cwd}/{branch}') / self.jar_path.name
-        if not jar_path.exists():
-            jar_path.parent.mkdir(parents=True, exist_ok=True)
-            logging.info(f"Checkout to branch [{self.cwd}]-[{branch}]")
-            self.checkout_branch(branch)
-            logging.info(f"Compiling jmh jar for [{self.cwd}]...")
-            self.compile(branch)
-            logging.info("Compiled jmh jar for [{self.cwd}] successfully")
-            shutil.copy(self.jar_path, jar_path)
+    def get_module(self, path: str) -> str:
+        """Map a branch name to the benchmark module built by `compile`."""
+        if 'llm2jmh-junit' in path:
+            return 'llm2jmh-junit'
+        elif 'llm2jmh' in path:
+            return 'llm2jmh'
+        elif 'ju2jmh' in path:
+            return 'ju2jmh'
+        return self.jmh_module
+
+    def get_benchmark_src_dir(self, path: str) -> Path:
+        """Source root of the generated benchmarks of branch `path`, e.g. llm2jmh/src/main/java."""
+        return Path(f'{self.cwd}/{path}/src/main/java')
+
+    def resolve_classpath(self, path: str) -> List[str]:
+        """
+        Resolve the compile classpath of the benchmark module once and cache it
+        under ./tmp, so generated files can be checked with javac directly.
+        """
+        classpath_file = Path(f'./tmp/{self.cwd}/{path}/classpath.txt')
+        if not (classpath_file.exists() and classpath_file.stat().st_size > 0):
+            classpath_file.parent.mkdir(parents=True, exist_ok=True)
+            logging.info(f"Resolving classpath of [{self.cwd}]-[{path}]...")
+            self.write_classpath(path, classpath_file.resolve())
+        return [x for x in classpath_file.read_text().strip().split(os.pathsep) if x]
+
+    def write_classpath(self, path: str, classpath_file: Path):
+        module = self.get_module(path)
+        cmd = f"mvn -q dependency:build-classpath -Dmdep.includeScope=compile -Dmdep.outputFile={classpath_file}"
+        cwd = f'{self.cwd}/{module}'
+        self.run_cmd(cmd, cwd)
+
+    def build_key(self, branch: str) -> str:
+        """
+        Hash of the git trees a benchmark jar of `branch` is built from: the source dirs, the benchmark
+        module and the top level build files. Equal for branches with identical trees.
+        """
+        rev = branch if self.is_branch_exists(branch) else f'origin/{branch}'
+        paths = [str(x.relative_to(self.cwd)) for x in self.src_dirs] + [self.get_module(branch)]
+        listing = self.run_cmd(f"git ls-tree {rev} -- {' '.join(sorted(set(paths)))}").stdout
+        top_level = [x for x in self.run_cmd(f'git ls-tree {rev}').stdout.split('\n') if ' blob ' in x]
+        payload = json.dumps({'cwd': self.origin_cwd or self.cwd, 'jar': self.jar_path.name, 'trees': listing.split('\n') + top_level})
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def compile_if_needed(self, branch: str) -> Path:
+        """
+        Build the jmh jar of `branch` unless the build cache has a jar of the same trees, return the jar.
+        Safe to call for several branches at once: concurrent calls for the same jar wait for one build.
+        """
+        # NOTE: resolve the base jar of a mutant before locking the mutant, both builds never share a lock
+        base_branch = base_branch_of(branch)
+        base_jar = self.compile_if_needed(base_branch) if base_branch is not None else None
+
+        build_dir = Path(f'./tmp/{self.cwd}/{branch}')
+        # NOTE: a build dir per thread, the cache names its copy after the jar
+        build_path = build_dir / f'build-{os.getpid()}-{threading.get_ident()}' / self.jar_path.name
+        cache = get_build_cache()
+        if cache is None:
+            jar_path = build_dir / self.jar_path.name
+            with build_lock(hashlib.sha256(str(jar_path.resolve()).encode('utf-8')).hexdigest()):
+                if not jar_path.exists():
+                    try:
+                        self.build_jar(branch, build_path, base_jar)
+                        build_path.replace(jar_path)
+                    finally:
+                        shutil.rmtree(build_path.parent, ignore_errors=True)
+            return jar_path
+
+        key = self.build_key(branch)
+        with build_lock(key):
+            jar_path = cache.get(key, branch)
+            if jar_path is None:
+                try:
+                    self.build_jar(branch, build_path, base_jar)
+                    jar_path = cache.put(key, self.cwd, branch, build_path)
+                finally:
+                    shutil.rmtree(build_path.parent, ignore_errors=True)
+        logging.info(f"Build cache: {cache.stats()}")
+        return jar_path
+
+    def build_jar(self, branch: str, dst: Path, base_jar: Optional[Path] = None):
+        """
+        Build the jar of `branch` into `dst`. Mutant branches of bug_injector are patched from the jar of their
+        base branch when only method bodies changed, other branches are built in a worktree.
+        """
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        base_branch = base_branch_of(branch)
+        if base_branch is not None:
+            if base_jar is None:
+                base_jar = self.compile_if_needed(base_branch)
+            if build_mutant_jar(self, branch, base_branch, base_jar, dst):
+                return
+        with self.worktree(branch) as mgr:
+            mgr.compile_branch(branch)
+            shutil.copy(mgr.jar_path, dst)
+
+    def compile_branch(self, branch: str):
+        logging.info(f"Compiling jmh jar for [{self.cwd}]-[{branch}]...")
+        self.compile(branch)
+        logging.info(f"Compiled jmh jar for [{self.cwd}]-[{branch}] successfully")
 
 
 class RxJavaManager(Manager):
     cwd = 'projects/rxjava'
     package = 'io.reactivex.rxjava3'
+    jmh_module = 'src/jmh'
 
     def __init__(self, branch: str):
         self.check_java_version()
@@ -167,16 +413,35 @@ class RxJavaManager(Manager):
         self.save_coverage_html_dir = Path(f'results/{cwd}/coverage_html/{branch}')
         self.save_coverage_html_dir.mkdir(parents=True, exist_ok=True)
 
+    def get_benchmark_src_dir(self, path: str) -> Path:
+        return Path(f'{self.cwd}/{path}/java')
+
     def compile(self, path: Optional[str] = None):
         if self.jar_path.exists():
             self.jar_path.unlink()
         cmd = './gradlew clean jmhJar'
         self.run_cmd(cmd)
 
+    def write_classpath(self, path: str, classpath_file: Path):
+        init_script = classpath_file.parent / 'print-jmh-classpath.gradle'
+        with open(init_script, 'w') as fd:
+            fd.write(
+                "allprojects {\n"
+                "    tasks.register('printJmhClasspath') {\n"
+                "        doLast {\n"
+                f"            new File('{classpath_file}').text = project.sourceSets.jmh.compileClasspath.asPath\n"
+                "        }\n"
+                "    }\n"
+                "}\n"
+            )
+        cmd = f'./gradlew -q --init-script {init_script.resolve()} classes printJmhClasspath'
+        self.run_cmd(cmd)
+
 
 class EclipseCollectionManager(Manager):
     cwd = 'projects/eclipse-collections'
     package = 'org.eclipse.collections'
+    jmh_module = 'jmh-tests'
 
     def __init__(self, branch: str):
         self.check_java_version()
@@ -221,14 +486,7 @@ class EclipseCollectionManager(Manager):
             self.jar_path.unlink()
         # cmd = 'mvn install -DskipTests=true'
         # self.run_cmd(cmd)
-        if 'llm2jmh-junit' in path:
-            path = 'llm2jmh-junit'
-        elif 'llm2jmh' in path:
-            path = 'llm2jmh'
-        elif 'ju2jmh' in path:
-            path = 'ju2jmh'
-        else:
-            path = 'jmh-tests'
+        path = self.get_module(path)
 
         cmd = "mvn clean package -DskipTests=true"
         cwd = f'{self.cwd}/{path}'
@@ -238,6 +496,7 @@ class EclipseCollectionManager(Manager):
 class ZipkinManager(Manager):
     cwd = 'projects/zipkin'
     package = 'zipkin2'
+    jmh_module = 'benchmarks'
 
     def __init__(self, branch: str):
         # self.check_java_version()
@@ -325,14 +584,7 @@ class ZipkinManager(Manager):
             self.jar_path.unlink()
         # cmd = 'mvn install -DskipTests=true -Denforcer.skip=true'
         # self.run_cmd(cmd)
-        if 'llm2jmh-junit' in path:
-            path = 'llm2jmh-junit'
-        elif 'llm2jmh' in path:
-            path = 'llm2jmh'
-        elif 'ju2jmh' in path:
-            path = 'ju2jmh'
-        else:
-            path = 'benchmarks'
+        path = self.get_module(path)
 
         cmd = "mvn clean package -DskipTests=true -Danimal.sniffer.skip=true -Denforcer.skip=true"
         cwd = f'{self.cwd}/{path}'
@@ -342,6 +594,7 @@ class ZipkinManager(Manager):
 class Flink17799Manager(Manager):
     cwd = 'projects/flink-17799'
     package = 'org.apache.flink'
+    jmh_module = 'flink-benchmarks'
 
     def __init__(self, branch: str):
         # self.check_java_version()
@@ -444,14 +697,7 @@ class Flink17799Manager(Manager):
             self.jar_path.unlink()
         # cmd = 'mvn install -DskipTests=true -Denforcer.skip=true -Drat.skip=true '
         # self.run_cmd(cmd)
-        if 'llm2jmh-junit' in path:
-            path = 'llm2jmh-junit'
-        elif 'llm2jmh' in path:
-            path = 'llm2jmh'
-        elif 'ju2jmh' in path:
-            path = 'ju2jmh'
-        else:
-            path = 'flink-benchmarks'
+        path = self.get_module(path)
 
         cmd = "mvn clean package -DskipTests=true -Danimal.sniffer.skip=true -Denforcer.skip=true -Dcheckstyle.skip -Drat.skip=true"
         cwd = f'{self.cwd}/{path}'
@@ -461,6 +707,7 @@ class Flink17799Manager(Manager):
 class Flink16536Manager(Manager):
     cwd = 'projects/flink-16536'
     package = 'org.apache.flink'
+    jmh_module = 'flink-benchmarks'
 
     def __init__(self, branch: str):
         # self.check_java_version()
@@ -563,14 +810,7 @@ class Flink16536Manager(Manager):
             self.jar_path.unlink()
         # cmd = 'mvn install -DskipTests=true -Denforcer.skip=true -Drat.skip=true '
         # self.run_cmd(cmd)
-        if 'llm2jmh-junit' in path:
-            path = 'llm2jmh-junit'
-        elif 'llm2jmh' in path:
-            path = 'llm2jmh'
-        elif 'ju2jmh' in path:
-            path = 'ju2jmh'
-        else:
-            path = 'flink-benchmarks'
+        path = self.get_module(path)
 
         cmd = "mvn clean package -DskipTests=true -Danimal.sniffer.skip=true -Denforcer.skip=true -Dcheckstyle.skip -Drat.skip=true"
         cwd = f'{self.cwd}/{path}'
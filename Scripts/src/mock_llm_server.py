@@ -0,0 +1,444 @@
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from typing import Dict, Any, Optional, List, Tuple
+from pathlib import Path
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import logging
+from generation_manifest import content_hash
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# NOTE: point the scripts to this server with
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 DEEPSEEK_BASE_URL=http://127.0.0.1:8765/v1
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:8765 GEMINI_BASE_URL=http://127.0.0.1:8765
+DEFAULT_RESPONSE = 'SKIP: answered by the mock server'
+
+
+class ReplayIndex:
+    """
+    Recorded answers of earlier runs, found through the generation manifest: the source code embedded in
+    a generation prompt hashes to the manifest `source_hash` of its file, whose `<file>.txt` is replayed.
+    """
+
+    def __init__(self, generated_dirs: List[Path]):
+        self.responses: Dict[str, Path] = {}
+        for save_dir in generated_dirs:
+            manifest_path = save_dir.parent / f'{save_dir.name}.manifest.json'
+            if not manifest_path.exists():
+                logging.error(f"No manifest for {str(save_dir)}, run llm_gen on it once to record the source hashes")
+                continue
+            with open(manifest_path, 'r') as fd:
+                entries = json.load(fd)
+            for key, entry in entries.items():
+                response_path = save_dir / f'{key}.txt'
+                if entry.get('source_hash') and response_path.exists():
+                    self.responses[entry['source_hash']] = response_path
+        logging.info(f"Replaying {len(self.responses)} recorded responses")
+
+    def lookup(self, prompt: str) -> Optional[str]:
+        if 'Source Code:\n' not in prompt:
+            return None
+        # NOTE: the generation prompt ends with "Source Code:\n{src_code}\n"
+        src_code = prompt.split('Source Code:\n', 1)[1]
+        if src_code.endswith('\n'):
+            src_code = src_code[:-1]
+        path = self.responses.get(content_hash(src_code))
+        if path is None:
+            return None
+        with open(path, 'r') as fd:
+            return fd.read()
+
+
+class FaultInjector:
+    """Latency, rate limits, server errors and hanging requests, drawn independently for every request."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, rate_limit_rpm: Optional[float] = None,
+                 retry_after_s: float = 1.0, error_rate: float = 0.0, timeout_rate: float = 0.0, hang_s: float = 30.0,
+                 tokens_per_second: Optional[float] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit_rpm = rate_limit_rpm
+        self.retry_after_s = retry_after_s
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_s = hang_s
+        self.tokens_per_second = tokens_per_second
+        self.lock = threading.Lock()
+        self.window: List[float] = []
+
+    def rate_limited(self) -> bool:
+        if self.rate_limit_rpm is None:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.window = [x for x in self.window if now - x < 60]
+            if len(self.window) >= self.rate_limit_rpm:
+                return True
+            self.window.append(now)
+        return False
+
+    def draw(self) -> Optional[str]:
+        """Return the fault to inject into the next request: rate_limit, server, timeout or None."""
+        if self.rate_limited():
+            return 'rate_limit'
+        x = random.random()
+        if x < self.error_rate:
+            return 'server'
+        if x < self.error_rate + self.timeout_rate:
+            return 'timeout'
+        return None
+
+    def delay(self, text: str):
+        delay = max(self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms), 0) / 1000
+        if self.tokens_per_second:
+            delay += len(text) / 4 / self.tokens_per_second
+        time.sleep(delay)
+
+
+class MockState:
+    """Uploaded files, submitted batches and counters, shared by the handler threads."""
+
+    def __init__(self, response: str, replay: Optional[ReplayIndex] = None, faults: Optional[FaultInjector] = None):
+        self.response = response
+        self.replay = replay
+        self.faults = faults or FaultInjector()
+        self.lock = threading.Lock()
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.counters: Dict[str, int] = {'requests': 0, 'replayed': 0, 'fallback': 0, 'rate_limit': 0, 'server': 0, 'timeout': 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def add_file(self, content: bytes) -> str:
+        file_id = f'file-{uuid.uuid4().hex[:24]}'
+        with self.lock:
+            self.files[file_id] = content
+        return file_id
+
+    def answer(self, prompt: str) -> str:
+        self.count('requests')
+        text = self.replay.lookup(prompt) if self.replay is not None else None
+        self.count('fallback' if text is None else 'replayed')
+        return self.response if text is None else text
+
+
+# ---------------------------------------------------------------- provider formats
+
+
+def chat_completion(model: str, text: str) -> Dict[str, Any]:
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex[:24]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+    }
+
+
+def chat_completion_chunk(chunk_id: str, model: str, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        'id': chunk_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    }
+
+
+def anthropic_message(model: str, text: str) -> Dict[str, Any]:
+    return {
+        'id': f'msg_{uuid.uuid4().hex[:24]}',
+        'type': 'message',
+        'role': 'assistant',
+        'model': model,
+        'content': [{'type': 'text', 'text': text}],
+        'stop_reason': 'end_turn',
+        'stop_sequence': None,
+        'usage': {'input_tokens': 0, 'output_tokens': 0},
+    }
+
+
+def gemini_response(text: str, finish_reason: Optional[str] = 'STOP') -> Dict[str, Any]:
+    candidate = {'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}
+    if finish_reason is not None:
+        candidate['finishReason'] = finish_reason
+    return {'candidates': [candidate], 'usageMetadata': {'promptTokenCount': 0, 'candidatesTokenCount': 0, 'totalTokenCount': 0}}
+
+
+def message_text(content: Any) -> str:
+    """Text of an OpenAI or Anthropic message content, either a string or a list of typed parts."""
+    if isinstance(content, str):
+        return content
+    return ''.join(x.get('text', '') for x in content if x.get('type') == 'text')
+
+
+def split_deltas(text: str, size: int = 16) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+
+ERROR_STATUS = {'rate_limit': 429, 'server': 500}
+
+
+def error_payload(api: str, kind: str) -> Dict[str, Any]:
+    message = 'Rate limit reached, retry later' if kind == 'rate_limit' else 'Internal server error injected by the mock server'
+    if api == 'anthropic':
+        return {'type': 'error', 'error': {'type': 'rate_limit_error' if kind == 'rate_limit' else 'api_error', 'message': message}}
+    if api == 'gemini':
+        return {'error': {'code': ERROR_STATUS[kind], 'message': message, 'status': 'RESOURCE_EXHAUSTED' if kind == 'rate_limit' else 'INTERNAL'}}
+    return {'error': {'message': message, 'type': 'rate_limit_exceeded' if kind == 'rate_limit' else 'server_error', 'code': None}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state: MockState = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def _send_event(self, payload: Any, event: Optional[str] = None):
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        prefix = f'event: {event}\n' if event is not None else ''
+        self.wfile.write(f'{prefix}data: {data}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _inject_fault(self, api: str) -> bool:
+        """Answer the request with an injected fault, return False if it should be served normally."""
+        kind = self.state.faults.draw()
+        if kind is None:
+            return False
+        self.state.count(kind)
+        if kind == 'timeout':
+            # NOTE: hold the request and drop the connection, the client sees a timeout or a disconnect
+            time.sleep(self.state.faults.hang_s)
+            self.close_connection = True
+            return True
+        headers = {'Retry-After': str(self.state.faults.retry_after_s)} if kind == 'rate_limit' else None
+        self._send_json(ERROR_STATUS[kind], error_payload(api, kind), headers)
+        return True
+
+    def _stream_pause(self, delta: str):
+        if self.state.faults.tokens_per_second:
+            time.sleep(len(delta) / 4 / self.state.faults.tokens_per_second)
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        try:
+            if path.endswith('/chat/completions'):
+                self._openai_chat(json.loads(self._read_body()))
+            elif path.endswith('/messages'):
+                self._anthropic_messages(json.loads(self._read_body()))
+            elif ':generateContent' in path or ':streamGenerateContent' in path:
+                self._gemini_generate(path, json.loads(self._read_body()))
+            elif path.endswith('/files'):
+                self._upload_file()
+            elif path.endswith('/batches'):
+                self._create_batch(json.loads(self._read_body()))
+            else:
+                self._send_json(404, {'error': {'message': f'unknown endpoint {path}'}})
+        except (BrokenPipeError, ConnectionResetError):
+            # NOTE: streaming clients cancel after SKIP or the first code block
+            self.close_connection = True
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        m_content = re.search(r'/files/([^/]+)/content$', path)
+        m_batch = re.search(r'/batches/([^/]+)$', path)
+        if m_content and m_content.group(1) in self.state.files:
+            content = self.state.files[m_content.group(1)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif m_batch and m_batch.group(1) in self.state.batches:
+            self._send_json(200, self.state.batches[m_batch.group(1)])
+        elif path.endswith('/stats'):
+            self._send_json(200, self.state.counters)
+        else:
+            self._send_json(404, {'error': {'message': f'unknown resource {path}'}})
+
+    # ------------------------------------------------------------ chat endpoints
+
+    def _openai_chat(self, body: Dict[str, Any]):
+        if self._inject_fault('openai'):
+            return
+        model = body.get('model', 'mock')
+        text = self.state.answer(message_text(body['messages'][-1]['content']))
+        if not body.get('stream'):
+            self.state.faults.delay(text)
+            self._send_json(200, chat_completion(model, text))
+            return
+
+        self.state.faults.delay('')
+        chunk_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        self._start_events()
+        self._send_event(chat_completion_chunk(chunk_id, model, {'role': 'assistant', 'content': ''}))
+        for delta in split_deltas(text):
+            self._stream_pause(delta)
+            self._send_event(chat_completion_chunk(chunk_id, model, {'content': delta}))
+        self._send_event(chat_completion_chunk(chunk_id, model, {}, 'stop'))
+        self._send_event('[DONE]')
+
+    def _anthropic_messages(self, body: Dict[str, Any]):
+        if self._inject_fault('anthropic'):
+            return
+        model = body.get('model', 'mock')
+        text = self.state.answer(message_text(body['messages'][-1]['content']))
+        if not body.get('stream'):
+            self.state.faults.delay(text)
+            self._send_json(200, anthropic_message(model, text))
+            return
+
+        self.state.faults.delay('')
+        message = anthropic_message(model, '')
+        message['content'] = []
+        message['stop_reason'] = None
+        self._start_events()
+        self._send_event({'type': 'message_start', 'message': message}, 'message_start')
+        self._send_event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}, 'content_block_start')
+        for delta in split_deltas(text):
+            self._stream_pause(delta)
+            self._send_event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': delta}}, 'content_block_delta')
+        self._send_event({'type': 'content_block_stop', 'index': 0}, 'content_block_stop')
+        self._send_event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                          'usage': {'output_tokens': 0}}, 'message_delta')
+        self._send_event({'type': 'message_stop'}, 'message_stop')
+
+    def _gemini_generate(self, path: str, body: Dict[str, Any]):
+        if self._inject_fault('gemini'):
+            return
+        parts = body['contents'][-1]['parts']
+        text = self.state.answer(''.join(x.get('text', '') for x in parts))
+        if ':generateContent' in path:
+            self.state.faults.delay(text)
+            self._send_json(200, gemini_response(text))
+            return
+
+        self.state.faults.delay('')
+        deltas = split_deltas(text)
+        if 'alt=sse' in self.path:
+            self._start_events()
+            for i, delta in enumerate(deltas):
+                self._stream_pause(delta)
+                self._send_event(gemini_response(delta, 'STOP' if i == len(deltas) - 1 else None))
+            return
+        # NOTE: without alt=sse the stream is one JSON array
+        self.state.faults.delay(text)
+        self._send_json(200, [gemini_response(delta, 'STOP' if i == len(deltas) - 1 else None) for i, delta in enumerate(deltas)])
+
+    # ------------------------------------------------------------ batch endpoints
+
+    def _upload_file(self):
+        message = BytesParser(policy=default_policy).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + self._read_body())
+        content = b''
+        for part in message.iter_parts():
+            if part.get_filename() is not None:
+                content = part.get_payload(decode=True)
+        file_id = self.state.add_file(content)
+        self._send_json(200, {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                              'filename': 'batch.jsonl', 'purpose': 'batch', 'status': 'processed'})
+
+    def _create_batch(self, body: Dict[str, Any]):
+        # NOTE: batches are answered synchronously without faults, the first poll already sees them completed
+        lines = self.state.files.get(body['input_file_id'], b'').decode('utf-8').splitlines()
+        outputs = []
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            text = self.state.answer(message_text(request['body']['messages'][-1]['content']))
+            payload = chat_completion(request['body'].get('model', 'mock'), text)
+            outputs.append(json.dumps({'id': f'batch_req_{uuid.uuid4().hex[:24]}', 'custom_id': request['custom_id'],
+                                       'response': {'status_code': 200, 'body': payload}, 'error': None}))
+        output_file_id = self.state.add_file(('\n'.join(outputs) + '\n').encode('utf-8'))
+        batch_id = f'batch_{uuid.uuid4().hex[:24]}'
+        now = int(time.time())
+        batch = {
+            'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint'), 'errors': None,
+            'input_file_id': body['input_file_id'], 'completion_window': body.get('completion_window', '24h'),
+            'status': 'completed', 'output_file_id': output_file_id, 'error_file_id': None,
+            'created_at': now, 'completed_at': now,
+            'request_counts': {'total': len(outputs), 'completed': len(outputs), 'failed': 0},
+        }
+        with self.state.lock:
+            self.state.batches[batch_id] = batch
+        self._send_json(200, batch)
+
+
+def make_server(host: str, port: int, state: MockState) -> ThreadingHTTPServer:
+    MockHandler.state = state
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(host: str, port: int, state: MockState):
+    server = make_server(host, port, state)
+    logging.info(f"Mock LLM server listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        logging.info(f"Mock LLM server stats: {state.counters}")
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--response_file", type=str, default=None, help='text returned for prompts without a recorded response')
+    parser.add_argument("--replay", type=str, nargs='*', default=[], help='generated dirs to replay, e.g. results/projects/rxjava/generated/deepseek-chat')
+    parser.add_argument("--latency_ms", type=float, default=0.0, help='time to first token')
+    parser.add_argument("--jitter_ms", type=float, default=0.0)
+    parser.add_argument("--tokens_per_second", type=float, default=None, help='output speed, ~4 characters per token')
+    parser.add_argument("--rate_limit_rpm", type=float, default=None, help='answer 429 with Retry-After above this many requests per minute')
+    parser.add_argument("--retry_after", type=float, default=1.0)
+    parser.add_argument("--error_rate", type=float, default=0.0, help='fraction of requests answered with a 500')
+    parser.add_argument("--timeout_rate", type=float, default=0.0, help='fraction of requests held for --hang_s and dropped')
+    parser.add_argument("--hang_s", type=float, default=30.0)
+    args = parser.parse_args()
+
+    response = DEFAULT_RESPONSE
+    if args.response_file is not None:
+        with open(args.response_file, 'r') as fd:
+            response = fd.read()
+    replay = ReplayIndex([Path(x) for x in args.replay]) if len(args.replay) > 0 else None
+    faults = FaultInjector(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_limit_rpm=args.rate_limit_rpm,
+                           retry_after_s=args.retry_after, error_rate=args.error_rate, timeout_rate=args.timeout_rate,
+                           hang_s=args.hang_s, tokens_per_second=args.tokens_per_second)
+    serve(args.host, args.port, MockState(response, replay, faults))
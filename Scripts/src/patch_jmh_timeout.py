@@ -13,10 +13,9 @@ from multiprocessing import Pool, Process, Value
 from concurrent.futures import ProcessPoolExecutor
 import logging
 from multiprocessing import Manager
-from utils_llm import get_commercial_model, prompt_commercial_model
-import pandas as pd
 from manager import get_manager
 from utils import patch_jpype
+from jvm_service import call_batch
 
 
 logging.basicConfig(
@@ -53,72 +52,15 @@ logging.basicConfig(
 #         compilation_unit.addImport(imp)
 
 
-# def patch_file(file_path: Path):
-#     from com.github.javaparser import StaticJavaParser
-#     from com.github.javaparser.ast.expr import NormalAnnotationExpr, Name, MemberValuePair, FieldAccessExpr
-#     from com.github.javaparser.ast.expr import NameExpr
-#     from com.github.javaparser.ast.body import MethodDeclaration
-#     from com.github.javaparser.ast.Modifier import Keyword
-#     from com.github.javaparser.ast.body import ClassOrInterfaceDeclaration
-#     from com.github.javaparser.ast import ImportDeclaration
-
-#     with file_path.open('r', encoding='utf-8') as f:
-#         content = f.read()
-
-#     cu = StaticJavaParser.parse(content)
-#     for type_decl in cu.getTypes():
-#         if isinstance(type_decl, ClassOrInterfaceDeclaration):
-#             process_methods(type_decl)
-
-#     # Ensure required imports
-#     ensure_imports(cu)
-
-
-def patch_file(file_path: Path):
-    from com.github.javaparser import StaticJavaParser
-    from com.github.javaparser.ast.expr import NormalAnnotationExpr, Name, MemberValuePair, FieldAccessExpr
-    from com.github.javaparser.ast.expr import NameExpr
-    from com.github.javaparser.ast.body import MethodDeclaration
-    from com.github.javaparser.ast.Modifier import Keyword
-    from com.github.javaparser.ast.body import ClassOrInterfaceDeclaration
-    from com.github.javaparser.ast import ImportDeclaration
-
-    with file_path.open('r', encoding='utf-8') as f:
-        content = f.read()
-
-    cu = StaticJavaParser.parse(content)
-
-    # Ensure required imports exist
-    imports = [imp.getNameAsString() for imp in cu.getImports()]
-    if 'org.openjdk.jmh.annotations.Timeout' not in imports:
-        cu.addImport('org.openjdk.jmh.annotations.Timeout')
-    if 'java.util.concurrent.TimeUnit' not in imports:
-        cu.addImport('java.util.concurrent.TimeUnit')
-
-    def process_methods(cls: ClassOrInterfaceDeclaration):
-        for method in cls.getMethods():
-            # for annotation in method.getAnnotations():
-            #     if annotation.getNameAsString().endsWith("Benchmark"):
-            if method.isAnnotationPresent("Benchmark") and not method.isAnnotationPresent("Timeout"):
-                    # Create and add @Timeout annotation
-                    timeout_annotation = NormalAnnotationExpr()
-                    timeout_annotation.setName(Name("Timeout"))
-                    timeout_annotation.addPair("time", "2")
-                    timeout_annotation.addPair("timeUnit", FieldAccessExpr(NameExpr("TimeUnit"), "SECONDS"))
-                    method.addAnnotation(timeout_annotation)
-
-        # Process inner classes
-
-        for member in cls.getMembers():
-            if isinstance(member, ClassOrInterfaceDeclaration):
-                process_methods(member)
-
-    for type_decl in cu.getTypes():
-        if isinstance(type_decl, ClassOrInterfaceDeclaration):
-            process_methods(type_decl)
-
-    with file_path.open('w', encoding='utf-8') as f:
-        f.write(str(cu))
+def patch_files(file_paths: List[Path]):
+    """Patch all files of a branch in one round trip to the jvm service."""
+    contents = [x.read_text(encoding='utf-8') for x in file_paths]
+    responses = call_batch([('add_jmh_timeout', {'code': content}) for content in contents])
+    for file_path, response in zip(file_paths, responses):
+        if not response['ok']:
+            logging.error(f"Fail to patch {file_path}: {response['error']}")
+            continue
+        file_path.write_text(response['result'], encoding='utf-8')
         print(f"✅ Patched: {file_path}")
 
 
@@ -127,11 +69,12 @@ def main(args):
     branches = args.branch
     for branch in branches:
         mgr = get_manager(args.project, branch)
-        mgr.checkout_branch(branch)
-        for path in Path(mgr.jmh_dir).rglob("*.java"):
-            # if 'ju2jmh/java/io/reactivex/rxjava3/parallel/ParallelPeekTest.java' not in str(path):
-            #     continue
-            patch_file(path)
+        # NOTE: patch in a worktree and commit onto the branch, a pooled worktree does not keep uncommitted edits
+        with mgr.worktree(branch) as wt:
+            paths = sorted(Path(wt.jmh_dir).rglob("*.java"))
+            # paths = [x for x in paths if 'ju2jmh/java/io/reactivex/rxjava3/parallel/ParallelPeekTest.java' in str(x)]
+            patch_files(paths)
+            wt.commit_to_branch(branch, str(wt.jmh_dir.relative_to(wt.cwd)), 'Add @Timeout to jmh benchmarks')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,55 @@
+import re
+import difflib
+from typing import List
+
+HUNK_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+NO_NEWLINE = '\\ No newline at end of file\n'
+
+
+def _split(text: str) -> List[str]:
+    lines = text.splitlines(keepends=True)
+    if lines and not lines[-1].endswith('\n'):
+        # NOTE: marked like `diff` does, otherwise the next diff line would be glued to it
+        lines[-1] = lines[-1] + '\n' + NO_NEWLINE
+    return lines
+
+
+def make_patch(old: str, new: str, path: str = 'a', context: int = 3) -> str:
+    """Unified diff of two versions of one file, the compact form mutants are stored in."""
+    return ''.join(difflib.unified_diff(_split(old), _split(new), fromfile=path, tofile=path, n=context))
+
+
+def apply_patch(old: str, patch: str) -> str:
+    """
+    Apply a patch of `make_patch` to the exact file it was made from. Raises ValueError when the
+    context does not match, i.e. the file changed since.
+    """
+    lines = _split(old)
+    out: List[str] = []
+    pos = 0
+    patch_lines = patch.splitlines(keepends=True)
+    i = 0
+    while i < len(patch_lines):
+        found = HUNK_PATTERN.match(patch_lines[i])
+        i += 1
+        if found is None:
+            continue
+        start = int(found.group(1)) - (0 if found.group(2) == '0' else 1)
+        out.extend(lines[pos:start])
+        pos = start
+        while i < len(patch_lines) and not patch_lines[i].startswith('@@'):
+            tag, text = patch_lines[i][0], patch_lines[i][1:]
+            i += 1
+            if i < len(patch_lines) and patch_lines[i] == NO_NEWLINE:
+                text += NO_NEWLINE
+                i += 1
+            if tag in (' ', '-'):
+                if pos >= len(lines) or lines[pos] != text:
+                    raise ValueError(f'Patch does not apply at line {pos + 1}')
+                if tag == ' ':
+                    out.append(lines[pos])
+                pos += 1
+            elif tag == '+':
+                out.append(text)
+    out.extend(lines[pos:])
+    return ''.join(out).replace('\n' + NO_NEWLINE, '')
@@ -0,0 +1,411 @@
+import json
+import asyncio
+import argparse
+from typing import List, Dict, Set, Tuple, Optional, TypedDict
+from pathlib import Path
+from collections import Counter
+import logging
+from utils_llm import AsyncLLMClient, LLMResult, load_dead_letters, save_dead_letters
+from llm_batch import run_batch
+from utils import patch_jpype
+from java_compiler import compile_batch, JavaDiagnostic
+from diagnostics import diagnostics_of, normalize_diagnostics, file_signature, template_fix, build_class_index, FixCache
+from jvm_service import call
+from jmh_smoke import smoke_test_file
+from generation_manifest import GenerationManifest
+from llm_gen import remove_java_comments, extract_code_in_backticks
+from manager import get_manager, Manager
+
+logging.basicConfig(
+    level=logging.INFO,  # Set the logging level
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def get_llm_repair_prompt(code: str, err_msg: str, kind: str) -> str:
+    if kind == 'runtime':
+        prompt = f"""Fix the bug in JMH code according to the runtime exception
+
+JMH Code:
+{code}
+
+Runtime Message:
+{err_msg}
+
+Output instructions:
+  - Do not add any explanation or commentary before or after the test code.
+  - Wrap the entire code inside triple backticks like this:
+  ```
+  // your code here
+  ```
+"""
+    else:
+        prompt = f"""Fix the bug in JMH code according to the compilation message
+
+JMH Code:
+{code}
+
+Comilation Message:
+{err_msg}
+
+Output instructions:
+  - Do not add any explanation or commentary before or after the test code.
+  - Wrap the entire code inside triple backticks like this:
+  ```
+  // your code here
+  ```
+"""
+    return prompt
+
+
+class RepairTask(TypedDict):
+    # NOTE: path of the source file relative to its source dir, also the key of the generation manifest
+    key: str
+    kind: str
+    error: str
+    # NOTE: the compiled benchmark of a runtime failure, None for compile failures
+    benchmark: Optional[Path]
+
+
+class RepairOutcome(TypedDict):
+    status: str
+    rounds: int
+    kind: str
+    error: Optional[str]
+    benchmark: Optional[str]
+
+
+class CheckResult(TypedDict):
+    benchmark: Optional[Path]
+    # NOTE: compile or runtime, empty when the candidate passed
+    kind: str
+    error: Optional[str]
+    diagnostics: List[JavaDiagnostic]
+    # NOTE: the relocated code the diagnostics point to
+    code: str
+
+
+class RepairEngine:
+    """
+    Repair generated benchmarks which fail to compile or crash at runtime, up to `rounds` times per file:
+
+        LLM repair -> extract the code block -> relocate + incremental javac -> smoke run -> next round
+
+    Every file runs its own loop, so a slow answer or build only delays that file. LLM requests are
+    bounded by the client, builds and smoke runs by `build_jobs`. Answers are saved as
+    `<file>.repair-<round>.txt` and replayed when the engine is run again.
+
+    Compile errors are tried with local fixes before each LLM round: missing imports, and line edits
+    which fixed the same error signature in another file (`repair-fixes.json`).
+
+    With `batch`, the prompts of a round go through the provider batch endpoint: they are submitted
+    together once every unfinished file waits for an answer. Prompts without an answer are written to
+    `dead-letter-repair-<round>.json` / `dead-letter-runtime-repair-<round>.json`, and their files are
+    repaired first in the next run.
+    """
+
+    def __init__(self, mgr: Manager, save_dir: Path, to_branch: str, model: str, rounds: int = 3,
+                 concurrency: int = 8, build_jobs: int = 4, smoke: bool = True, smoke_timeout: float = 30.0,
+                 rpm: Optional[float] = None, tpm: Optional[float] = None, batch: bool = False):
+        self.mgr = mgr
+        self.model = model
+        self.batch = batch
+        self.save_dir = save_dir
+        self.rounds = rounds
+        self.smoke = smoke
+        self.smoke_timeout = smoke_timeout
+        self.build_jobs = build_jobs
+        self.client = AsyncLLMClient(model, max_in_flight=concurrency, rpm=rpm, tpm=tpm)
+        self.manifest = GenerationManifest(save_dir)
+
+        self.llm2jmh_dir = mgr.get_benchmark_src_dir(to_branch)
+        self.classpath = mgr.resolve_classpath(to_branch)
+        self.classes_dir = Path(f'./tmp/{mgr.cwd}/{to_branch}/classes')
+        self.smoke_dir = Path(f'./tmp/{mgr.cwd}/{to_branch}/smoke')
+        self.imports = [f'{package}.*' for package in mgr.get_all_subpackages()] + ['org.openjdk.jmh.infra.Blackhole']
+        self.class_index = build_class_index(mgr.src_dirs)
+        self.fix_cache = FixCache(save_dir / 'repair-fixes.json')
+
+    def load_tasks(self, repair_list: Optional[Path], runtime_errors: Optional[Path]) -> List[RepairTask]:
+        """Compile failures keyed by generated file (`repair-list-<n>.json`), runtime failures by benchmark method (`runtime-errors.json`)."""
+        tasks: Dict[str, RepairTask] = {}
+        if repair_list is not None and repair_list.exists():
+            with open(repair_list, 'r') as fd:
+                for java_file, err_msg in json.load(fd).items():
+                    key = str(Path(java_file).relative_to(self.save_dir))
+                    tasks[key] = RepairTask(key=key, kind='compile', error=err_msg, benchmark=None)
+
+        if runtime_errors is not None and runtime_errors.exists():
+            benchmark_to_key = {entry['benchmark']: key for key, entry in self.manifest.entries.items() if entry.get('benchmark')}
+            with open(runtime_errors, 'r') as fd:
+                benchmark_errors = json.load(fd)
+            for method, err_msg in sorted(benchmark_errors.items()):
+                class_name = method.rsplit('.', 1)[0]
+                benchmark = self.llm2jmh_dir / f"{class_name.replace('.', '/')}.java"
+                key = benchmark_to_key.get(str(benchmark))
+                if key is None:
+                    logging.error(f"No generated file recorded for {method}, skip")
+                    continue
+                if key in tasks:
+                    tasks[key]['error'] += f'\n\nBenchmark: {method}\n{err_msg}'
+                    continue
+                tasks[key] = RepairTask(key=key, kind='runtime', error=f'Benchmark: {method}\n{err_msg}', benchmark=benchmark)
+        return list(tasks.values())
+
+    def check(self, task: RepairTask, code: str) -> CheckResult:
+        """Relocate, compile and smoke run a candidate. Failed candidates are reverted."""
+        package = str(Path(task['key']).parent).replace('/', '.')
+        try:
+            relocated = call('relocate_benchmark', code=code, package=package, imports=self.imports)
+        except Exception as ex:
+            return CheckResult(benchmark=None, kind='compile', error=f'Fail to parse the JMH code: {str(ex)}', diagnostics=[], code=code)
+        if len(relocated['classes']) == 0:
+            return CheckResult(benchmark=None, kind='compile', error='No top level class found in the JMH code', diagnostics=[], code=code)
+
+        class_name = relocated['classes'][0]
+        dst = self.llm2jmh_dir / Path(task['key']).parent / f'{class_name}.java'
+        taken = {Path(x['benchmark']) for k, x in self.manifest.entries.items() if k != task['key'] and x.get('benchmark')}
+        if dst in taken or (dst.exists() and dst != task['benchmark']):
+            return CheckResult(benchmark=None, kind='compile', diagnostics=[], code=code,
+                               error=f'A benchmark class named {class_name} already exists in package {package}, use another class name')
+
+        original = dst.read_text() if dst == task['benchmark'] and dst.exists() else None
+
+        def revert():
+            if original is not None:
+                dst.write_text(original)
+            elif dst.exists():
+                dst.unlink()
+
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        dst.write_text(relocated['code'])
+        failed = compile_batch(self.classpath, self.classes_dir, [dst])
+        if dst in failed:
+            revert()
+            # NOTE: only the errors of this file, with the source lines they point to
+            diagnostics = diagnostics_of(failed[dst], dst)
+            return CheckResult(benchmark=None, kind='compile', error=normalize_diagnostics(diagnostics, relocated['code']),
+                               diagnostics=diagnostics, code=relocated['code'])
+
+        if self.smoke:
+            failures = smoke_test_file(dst, f'{package}.{class_name}', [str(self.classes_dir.resolve())] + self.classpath,
+                                       self.smoke_dir / package / class_name, self.smoke_timeout)
+            if len(failures) > 0:
+                revert()
+                return CheckResult(benchmark=None, kind='runtime', diagnostics=[], code=relocated['code'],
+                                   error='\n\n'.join(f'Benchmark: {k}\n{v}' for k, v in failures.items()))
+        return CheckResult(benchmark=dst, kind='', error=None, diagnostics=[], code=relocated['code'])
+
+    def dead_letter_path(self, kind: str, i: int) -> Path:
+        return self.save_dir / (f'dead-letter-repair-{i}.json' if kind == 'compile' else f'dead-letter-runtime-repair-{i}.json')
+
+    def dead_letters_first(self, tasks: List[RepairTask]) -> List[RepairTask]:
+        """Move the files whose repair request failed in the last run to the front."""
+        failed = {y for x in self.save_dir.glob('dead-letter-*repair-*.json') for y in load_dead_letters(x)}
+        tasks_failed = {x['key'] for x in tasks if any(y.startswith(f"{self.save_dir / x['key']}.repair-") for y in failed)}
+        if len(tasks_failed) > 0:
+            logging.info(f"Retrying {len(tasks_failed)} failed requests of the last run first")
+        return sorted(tasks, key=lambda x: x['key'] not in tasks_failed)
+
+    def save_dead_letters(self):
+        for kind in ('compile', 'runtime'):
+            for i in range(self.rounds):
+                path = self.dead_letter_path(kind, i)
+                failures = self.dead_letters.get(path, {})
+                # NOTE: also overwrite the letters of the last run, their requests were answered this time
+                if len(failures) > 0 or path.exists():
+                    save_dead_letters(path, failures)
+
+    async def ask(self, prompt: str) -> LLMResult:
+        if not self.batch:
+            return await self.client.prompt(prompt)
+        future = asyncio.get_running_loop().create_future()
+        self.batch_queue.append((prompt, future))
+        self.maybe_flush()
+        return await future
+
+    def maybe_flush(self):
+        """Submit the queued prompts as one batch once no unfinished file can add another prompt to it."""
+        if len(self.batch_queue) == 0 or len(self.batch_queue) + self.following < self.active:
+            return
+        queued, self.batch_queue = self.batch_queue, []
+        self.flushes.append(asyncio.create_task(self.flush(queued)))
+
+    async def flush(self, queued: List[Tuple[str, 'asyncio.Future[LLMResult]']]):
+        logging.info(f"Submitting a batch of {len(queued)} repair prompts")
+        try:
+            results = await asyncio.to_thread(run_batch, self.model, [x for x, _ in queued], self.save_dir / 'batches')
+        except Exception as ex:
+            for _, future in queued:
+                future.set_exception(ex)
+            return
+        for (_, future), result in zip(queued, results):
+            future.set_result(result)
+
+    async def check_async(self, task: RepairTask, code: str) -> CheckResult:
+        async with self.build_slots:
+            return await asyncio.to_thread(self.check, task, code)
+
+    async def wait_for_leader(self, signature: str, led: Set[str]):
+        """
+        The first file failing with an error signature asks the LLM, the following ones wait for it so
+        they can reuse its fix. Only files which lead no signature wait, so waits never form a cycle.
+        """
+        if signature in self.leaders:
+            if len(led) == 0 and not self.leaders[signature].is_set():
+                self.following += 1
+                self.maybe_flush()
+                try:
+                    await self.leaders[signature].wait()
+                finally:
+                    self.following -= 1
+            return
+        self.leaders[signature] = asyncio.Event()
+        led.add(signature)
+
+    def local_fix(self, result: CheckResult) -> Optional[str]:
+        code = template_fix(result['diagnostics'], result['code'], self.class_index) or result['code']
+        code = self.fix_cache.apply(result['diagnostics'], code) or code
+        return code if code != result['code'] else None
+
+    def accept(self, task: RepairTask, result: CheckResult, rounds: int, local: bool) -> RepairOutcome:
+        dst = result['benchmark']
+        if task['benchmark'] is not None and task['benchmark'] != dst and task['benchmark'].exists():
+            task['benchmark'].unlink()
+        self.manifest.update(task['key'], benchmark=str(dst))
+        logging.info(f"Repaired {task['key']} after {rounds} LLM rounds{' with a local fix' if local else ''}: {str(dst)}")
+        return RepairOutcome(status='fixed_locally' if local else 'fixed', rounds=rounds, kind=task['kind'], error=None, benchmark=str(dst))
+
+    async def repair(self, task: RepairTask) -> RepairOutcome:
+        led: Set[str] = set()
+        try:
+            return await self._repair(task, led)
+        finally:
+            for signature in led:
+                self.leaders[signature].set()
+            self.active -= 1
+            self.maybe_flush()
+
+    async def _repair(self, task: RepairTask, led: Set[str]) -> RepairOutcome:
+        java_file = self.save_dir / task['key']
+        code = java_file.read_text()
+        result = CheckResult(benchmark=task['benchmark'], kind=task['kind'], error=task['error'], diagnostics=[], code=code)
+        if task['kind'] == 'compile':
+            # NOTE: recompile first, to get structured diagnostics and skip files fixed in the meantime
+            result = await self.check_async(task, code)
+            if result['error'] is None:
+                return self.accept(task, result, 0, False)
+
+        for i in range(self.rounds):
+            if len(result['diagnostics']) > 0:
+                await self.wait_for_leader(file_signature(result['diagnostics']), led)
+                local = self.local_fix(result)
+                if local is not None:
+                    local_result = await self.check_async(task, local)
+                    if local_result['error'] is None:
+                        java_file.write_text(local)
+                        return self.accept(task, local_result, i, True)
+                    result = local_result
+
+            save_path = self.save_dir / f"{task['key']}.repair-{i}.txt"
+            if save_path.exists() and save_path.stat().st_size > 0:
+                text = save_path.read_text()
+            else:
+                result_llm = await self.ask(get_llm_repair_prompt(remove_java_comments(result['code']), result['error'], result['kind']))
+                if result_llm['text'] is None:
+                    logging.error(f"No response for {save_path} ({result_llm['error_kind']}), will retry in the next run")
+                    self.dead_letters.setdefault(self.dead_letter_path(result['kind'], i), {})[str(save_path)] = result_llm
+                    return RepairOutcome(status='no_response', rounds=i, kind=result['kind'], error=result_llm['error'], benchmark=None)
+                text = result_llm['text']
+                save_path.write_text(text)
+
+            fixed = extract_code_in_backticks(text)
+            if fixed is None:
+                return RepairOutcome(status='no_code', rounds=i + 1, kind=result['kind'], error=result['error'], benchmark=None)
+            java_file.write_text(fixed)
+
+            next_result = await self.check_async(task, fixed)
+            if next_result['error'] is None:
+                if len(result['diagnostics']) > 0:
+                    self.fix_cache.learn(result['diagnostics'], result['code'], next_result['code'])
+                return self.accept(task, next_result, i + 1, False)
+            logging.info(f"Round {i + 1} of {task['key']} still fails ({next_result['kind']})")
+            result = next_result
+
+        return RepairOutcome(status=f"{result['kind']}_error", rounds=self.rounds, kind=result['kind'], error=result['error'],
+                             benchmark=str(task['benchmark']) if task['benchmark'] is not None else None)
+
+    async def run(self, tasks: List[RepairTask]) -> Dict[str, RepairOutcome]:
+        if not self.batch:
+            await self.client.start()
+        self.build_slots = asyncio.Semaphore(self.build_jobs)
+        self.leaders: Dict[str, asyncio.Event] = {}
+        self.dead_letters: Dict[Path, Dict[str, LLMResult]] = {}
+        self.batch_queue: List[Tuple[str, 'asyncio.Future[LLMResult]']] = []
+        self.flushes: List[asyncio.Task] = []
+        self.active, self.following = len(tasks), 0
+        tasks = self.dead_letters_first(tasks)
+        outcomes = await asyncio.gather(*[self.repair(task) for task in tasks])
+        self.save_dead_letters()
+        self.fix_cache.save()
+        logging.info(f"Fix cache: {len(self.fix_cache.fixes)} signatures, reused {self.fix_cache.hits} times")
+        return {task['key']: outcome for task, outcome in zip(tasks, outcomes)}
+
+
+@patch_jpype
+def main(args):
+    project = args.project
+    mgr = get_manager(project, args.to_branch)
+    model = args.model
+    if args.strategy is None:
+        save_dir = Path(f'results/projects/{project}/generated/{model}')
+    else:
+        save_dir = Path(f'results/projects/{project}/generated/{model}-{args.strategy}')
+
+    engine = RepairEngine(mgr, save_dir, args.to_branch, model, rounds=args.rounds, concurrency=args.concurrency,
+                          build_jobs=args.build_jobs, smoke=not args.no_smoke, smoke_timeout=args.smoke_timeout,
+                          rpm=args.rpm, tpm=args.tpm, batch=args.batch)
+    if args.runtime_errors is not None:
+        runtime_errors = save_dir / args.runtime_errors
+    else:
+        # NOTE: written by `benchmark_mix_runner.py --smoke` of the same branch
+        runtime_errors = mgr.save_benchmark_dir / 'runtime-errors.json'
+    tasks = engine.load_tasks(save_dir / args.repair_list, runtime_errors)
+    logging.info(f"Repairing {len(tasks)} jmh files with {model}, up to {args.rounds} rounds each")
+    outcomes = asyncio.run(engine.run(tasks))
+    engine.manifest.save()
+
+    with open(save_dir / 'repair-report.json', 'w') as fd:
+        json.dump(outcomes, fd, indent=2, sort_keys=True)
+    statuses = Counter(x['status'] for x in outcomes.values())
+    rounds = Counter(x['rounds'] for x in outcomes.values() if x['status'] in ('fixed', 'fixed_locally'))
+    logging.info(f"Repair outcomes: {dict(statuses)}, fixed after n LLM rounds: {dict(sorted(rounds.items()))}")
+
+    if args.build:
+        try:
+            logging.info(f"Building jmh jar for [{mgr.cwd}]-[{args.to_branch}]...")
+            mgr.compile(args.to_branch)
+        except Exception as ex:
+            logging.error(f"Fail to build the jmh jar of {args.to_branch}, ex: {str(ex)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", type=str, required=True, help='rxjava, eclipse-collections, zipkin')
+    parser.add_argument("--to_branch", type=str, default='llm2jmh')
+    parser.add_argument("--model", type=str, default='deepseek-chat')
+    parser.add_argument("--strategy", type=str, default=None, help='with-junit')
+    parser.add_argument('--rounds', type=int, default=3, help='max repair rounds per file')
+    parser.add_argument('--repair_list', type=str, default='repair-list-0.json', help='compile failures written by llm_gen')
+    parser.add_argument('--runtime_errors', type=str, default=None, help='runtime failures per benchmark method, relative to the generated dir; the smoke run result of --to_branch by default')
+    parser.add_argument('--concurrency', type=int, default=8, help='max in-flight LLM requests')
+    parser.add_argument('--build_jobs', type=int, default=4, help='max concurrent compile and smoke runs')
+    parser.add_argument('--rpm', type=float, default=None, help='requests per minute limit of the provider')
+    parser.add_argument('--tpm', type=float, default=None, help='tokens per minute limit of the provider')
+    parser.add_argument('--batch', action='store_true', help='submit the prompts of each round through the provider batch endpoint')
+    parser.add_argument('--no_smoke', action='store_true', help='accept repairs once they compile')
+    parser.add_argument('--smoke_timeout', type=float, default=30.0, help='seconds a single benchmark may run in the smoke run')
+    parser.add_argument('--build', action='store_true', help='build the jmh jar after repairing')
+    args = parser.parse_args()
+
+    main(args)
@@ -123,22 +123,14 @@ def compile_mutator():
 
 def patch_jpype(func):
     def wrapper(*args, **kwargs):
-        import jpype
-        import jpype.imports
-        # from jpype.types import *
-        # NOTE: `compile_mutator` is only used for `bug injector.py`, can comment it out if running other scripts
-        # compile_mutator()
-        project_root = Path(os.getcwd())
-        classpath = []
-        classpath.append(str(project_root / 'target/automator-guard-1.0-SNAPSHOT.jar'))
-        javaparser_jar = str(Path("deps/javaparser-core-3.26.4.jar").resolve())
-        classpath.append(javaparser_jar)
-        if not jpype.isJVMStarted():
-            jpype.startJVM(classpath=classpath)
+        from jvm_service import is_service_running, start_jvm, shutdown_jvm
+        # NOTE: reuse the warm JVM of a running `jvm_service.py` if any, otherwise fall back to an in-process JVM
+        if not is_service_running():
+            start_jvm()
 
         result = func(*args, **kwargs)
 
-        jpype.shutdownJVM()
+        shutdown_jvm()
         return result
     return wrapper
 
@@ -1,33 +1,79 @@
 # from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration
 # from transformers import AutoModel, AutoTokenizer
-from api_resource import *
 # import torch
 # import torchvision.transforms as T
-from openai import OpenAI
-from PIL import Image
 # from io import BytesIO
 # import requests
 import base64
-import anthropic
-import google.generativeai as genai
 # import mimetypes
 # from PIL import Image
 # import base64
 import io
 import time
 import os
-from typing import List, Dict, Any, Union, Optional
+import json
+import re
+import random
+import asyncio
+import logging
+import importlib
+from functools import lru_cache
+from pathlib import Path
+from collections import Counter
+from typing import List, Dict, Any, Union, Optional, Callable, Tuple, TypedDict, NotRequired
+from llm_cache import get_response_cache
 # import base64
 
+# ---------------------------------------------------------------- lazy provider registry
+
+# NOTE: SDKs are imported on first use, scripts only need (and only pay for) the SDK of the selected model
+PROVIDER_SDKS = {
+    "openai": "openai",
+    "deepseek": "openai",
+    "anthropic": "anthropic",
+    "gemini": "google.generativeai",
+}
+
+# NOTE: api_resource.py is optional, the environment is used for keys missing from it
+API_KEYS = {
+    "openai": ("openai_api", "OPENAI_API_KEY"),
+    "deepseek": ("deepseek_api_key", "DEEPSEEK_API_KEY"),
+    "anthropic": ("anthropic_api_key", "ANTHROPIC_API_KEY"),
+    "gemini": ("gemini_api", "GOOGLE_API_KEY"),
+}
+
+
+@lru_cache(maxsize=None)
+def import_sdk(provider: str):
+    if provider not in PROVIDER_SDKS:
+        raise ValueError(f"Unknown provider: {provider}")
+    try:
+        return importlib.import_module(PROVIDER_SDKS[provider])
+    except ImportError as ex:
+        raise ImportError(f"The {provider} models need the `{PROVIDER_SDKS[provider]}` package: {str(ex)}")
+
+
+@lru_cache(maxsize=None)
+def get_api_key(provider: str) -> Optional[str]:
+    name, env = API_KEYS[provider]
+    try:
+        import api_resource
+        key = getattr(api_resource, name, None)
+    except ImportError:
+        key = None
+    return key or os.environ.get(env)
+
+
 def load_image(image_path):
     """Load an image from the given path and return it as a base64-encoded string."""
+    from PIL import Image
     with Image.open(image_path) as img:
         buffered = io.BytesIO()
         img.save(buffered, format=img.format)
         return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
 def get_gpt_model(model_name):
-    model = OpenAI(api_key=openai_api)
+    model = import_sdk("openai").OpenAI(api_key=get_api_key("openai"))
     return NamedModel(model, model_name)
 
 # def prompt_gpt4o(model, prompt, image_path=None):
@@ -153,8 +199,19 @@ class NamedModel:
         self.model = model
         self.model_name = model_name
 
+# NOTE: e.g. http://127.0.0.1:8765 to use the mock server, which only speaks the REST transport
+GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL')
+
+def configure_gemini():
+    genai = import_sdk("gemini")
+    if GEMINI_BASE_URL is None:
+        genai.configure(api_key=get_api_key("gemini"))
+    else:
+        genai.configure(api_key=get_api_key("gemini"), transport='rest', client_options={'api_endpoint': GEMINI_BASE_URL})
+    return genai
+
 def get_gemini_model(model_name='gemini-2.0-flash'):
-    genai.configure(api_key=gemini_api)
+    genai = configure_gemini()
     model = genai.GenerativeModel(model_name)
     return NamedModel(model, model_name)
 
@@ -163,7 +220,7 @@ def get_gemini_model(model_name='gemini-2.0-flash'):
 #     client = genai.GenerativeModel('gemini-1.5-flash')
 #     return client
 
-def get_claude(model_name="claude-3-haiku") -> anthropic.Anthropic:
+def get_claude(model_name="claude-3-haiku") -> "anthropic.Anthropic":
     """
     创建并返回一个Claude API客户端实例。
 
@@ -173,7 +230,7 @@ def get_claude(model_name="claude-3-haiku") -> anthropic.Anthropic:
     返回:
         anthropic.Anthropic: Claude API客户端实例
     """
-    model = anthropic.Anthropic(api_key=anthropic_api_key)
+    model = import_sdk("anthropic").Anthropic(api_key=get_api_key("anthropic"))
     return NamedModel(model, model_name)
 def prompt_gemini(client, prompt, image_path=None, demonstrations=None):
     """
@@ -233,11 +290,9 @@ def prompt_gemini(client, prompt, image_path=None, demonstrations=None):
     content_parts.append(prompt)
 
     # Generate the response
-    try:
-        response = client.model.generate_content(content_parts, generation_config={"temperature": 0.0})
-        return response.text
-    except Exception as e:
-        return f"Error generating response: {str(e)}"
+    # NOTE: errors are raised so they can be classified and retried by the caller
+    response = client.model.generate_content(content_parts, generation_config={"temperature": 0.0})
+    return response.text
 
 
 def prompt_claude(client,
@@ -357,8 +412,11 @@ def prompt_claude(client,
 #     except Exception as e:
 #         raise RuntimeError(f"An error occurred while querying the Gemini model: {e}")
 
+# NOTE: OPENAI_BASE_URL is read by the openai SDK itself, both point to a local stand-in server in offline tests
+DEEPSEEK_BASE_URL = os.environ.get('DEEPSEEK_BASE_URL', 'https://api.deepseek.com')
+
 def get_deepseek_chat_model(model_name="deepseek-chat"):
-    model = OpenAI(api_key=os.environ.get('DEEPSEEK_API_KEY'), base_url='https://api.deepseek.com')
+    model = import_sdk("deepseek").OpenAI(api_key=get_api_key("deepseek"), base_url=DEEPSEEK_BASE_URL)
     return NamedModel(model, model_name)
 
 def prompt_deepseek_chat(model, prompt, image_path=None, demonstrations=None):
@@ -445,8 +503,85 @@ def get_commercial_model(model_name):
         return model_map[model_name](model_name)
     raise ValueError(f"Unknown model name: {model_name}")
 
-def prompt_commercial_model(client, model_name, prompt, image_id, demonstrations=None):
-    # print(prompt)
+# ---------------------------------------------------------------- failure handling
+
+class LLMResult(TypedDict):
+    text: Optional[str]
+    # NOTE: one of rate_limit, timeout, context_length, content, server, unknown
+    error_kind: Optional[str]
+    error: Optional[str]
+    attempts: int
+    # NOTE: only set in streaming mode, the first fenced code block of `text`
+    code: NotRequired[Optional[str]]
+
+
+RETRYABLE_ERRORS = {"rate_limit", "timeout", "server"}
+
+
+def classify_error(ex: Exception) -> str:
+    status = getattr(ex, "status_code", None)
+    if status is None:
+        status = getattr(getattr(ex, "response", None), "status_code", None)
+    name = type(ex).__name__.lower()
+    msg = str(ex).lower()
+
+    if status == 429 or "ratelimit" in name or "resourceexhausted" in name or "rate limit" in msg or "quota" in msg:
+        return "rate_limit"
+    if "timeout" in name or "timed out" in msg or "deadlineexceeded" in name or isinstance(ex, asyncio.TimeoutError):
+        return "timeout"
+    if "context_length" in msg or "context length" in msg or "prompt is too long" in msg or "too many tokens" in msg:
+        return "context_length"
+    if "safety" in msg or "content_filter" in msg or "blocked" in msg or "finish_reason" in msg or "empty response" in msg:
+        return "content"
+    if (status is not None and status >= 500) or "overloaded" in msg or "connection" in name or "internalserver" in name or "unavailable" in name:
+        return "server"
+    return "unknown"
+
+
+def retry_after_seconds(ex: Exception) -> Optional[float]:
+    """Read the Retry-After hint of a failed request, if the provider sent one."""
+    headers = getattr(getattr(ex, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None, base: float = 1.0, cap: float = 60.0) -> float:
+    # NOTE: full jitter, so concurrent requests do not retry in lockstep
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def load_dead_letters(path: Path) -> Dict[str, LLMResult]:
+    if not path.exists():
+        return {}
+    with open(path, 'r') as fd:
+        return json.load(fd)
+
+
+def save_dead_letters(path: Path, failures: Dict[str, LLMResult]):
+    with open(path, 'w') as fd:
+        json.dump(failures, fd, indent=2)
+
+
+def dead_letters_first(jobs: List[Tuple[Path, str]], dead_letter_path: Path) -> List[Tuple[Path, str]]:
+    """Move the (save_path, prompt) jobs which failed in the last run to the front."""
+    dead_letters = load_dead_letters(dead_letter_path)
+    if len(dead_letters) > 0:
+        logging.info(f"Retrying {len(dead_letters)} failed requests of the last run first")
+    return sorted(jobs, key=lambda job: str(job[0]) not in dead_letters)
+
+
+def prompt_commercial_model_result(client, model_name, prompt, image_id, demonstrations=None, max_retries: int = 5) -> LLMResult:
     prompt_map = {
         "gpt-4o": prompt_gpt4o,
         "gpt-4o-mini": prompt_gpt4o,
@@ -454,15 +589,350 @@ def prompt_commercial_model(client, model_name, prompt, image_id, demonstrations
         "claude-3-haiku": prompt_claude,
         "deepseek-chat": prompt_deepseek_chat,
     }
-    if model_name in prompt_map:
+    if model_name not in prompt_map:
+        raise ValueError(f"Unknown model name: {model_name}")
+
+    # NOTE: only plain text prompts are cached
+    cache = get_response_cache() if not image_id and not demonstrations else None
+    params = SAMPLING_PARAMS[PROVIDER_OF_MODEL[model_name]]
+    if cache is not None:
+        res = cache.get(model_name, prompt, params)
+        if res is not None:
+            return LLMResult(text=res, error_kind=None, error=None, attempts=0)
+
+    attempt = 0
+    while True:
+        attempt += 1
         try:
             res = prompt_map[model_name](client, prompt, image_id, demonstrations)
+            if not res:
+                raise ValueError("empty response")
             print(res)
-            return res
+            if cache is not None:
+                cache.put(model_name, prompt, params, res)
+            return LLMResult(text=res, error_kind=None, error=None, attempts=attempt)
         except Exception as e:
-            print(image_id, str(e))
-            return ""
-    raise ValueError(f"Unknown model name: {model_name}")
+            kind = classify_error(e)
+            print(image_id, kind, str(e))
+            if kind not in RETRYABLE_ERRORS or attempt > max_retries:
+                return LLMResult(text=None, error_kind=kind, error=str(e), attempts=attempt)
+            time.sleep(backoff_delay(attempt, retry_after_seconds(e)))
+
+
+def prompt_commercial_model(client, model_name, prompt, image_id, demonstrations=None) -> Optional[str]:
+    # print(prompt)
+    return prompt_commercial_model_result(client, model_name, prompt, image_id, demonstrations)['text']
+
+
+# ---------------------------------------------------------------- async client layer
+
+PROVIDER_OF_MODEL = {
+    "gpt-4o": "openai",
+    "gpt-4o-mini": "openai",
+    "gemini-2.0-flash": "gemini",
+    "claude-3-haiku": "anthropic",
+    "deepseek-chat": "deepseek",
+}
+
+# NOTE: the model id sent to the provider when it differs from our model name
+PROVIDER_MODEL_ID = {
+    "claude-3-haiku": "claude-3-haiku-20240307",
+}
+
+# NOTE: sampling parameters sent by the prompt functions, part of the response cache key
+SAMPLING_PARAMS = {
+    "openai": {"temperature": 0, "max_tokens": 4096},
+    "deepseek": {"temperature": 0, "max_tokens": 4096},
+    "anthropic": {"max_tokens": 4096},
+    "gemini": {"temperature": 0.0},
+}
+
+_async_provider_clients: Dict[Any, Any] = {}
+
+
+def get_async_provider_client(provider: str):
+    """Return the pooled async SDK client of a provider, one instance (and connection pool) per event loop."""
+    key = (provider, id(asyncio.get_running_loop()))
+    if key in _async_provider_clients:
+        return _async_provider_clients[key]
+
+    if provider == "openai":
+        client = import_sdk(provider).AsyncOpenAI(api_key=get_api_key(provider))
+    elif provider == "deepseek":
+        client = import_sdk(provider).AsyncOpenAI(api_key=get_api_key(provider), base_url=DEEPSEEK_BASE_URL)
+    elif provider == "anthropic":
+        client = import_sdk(provider).AsyncAnthropic(api_key=get_api_key(provider))
+    elif provider == "gemini":
+        client = configure_gemini()
+    else:
+        raise ValueError(f"Unknown provider: {provider}")
+    _async_provider_clients[key] = client
+    return client
+
+
+def estimate_tokens(text: str) -> int:
+    # NOTE: ~4 characters per token is close enough for pacing
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """
+    Refill `rate_per_minute` tokens continuously, holding at most one minute of burst.
+    The balance may go negative when a cost is only known afterwards (`charge`).
+    """
+
+    def __init__(self, rate_per_minute: Optional[float]):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = rate_per_minute or 0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_minute / 60)
+        self.updated_at = now
+
+    async def acquire(self, amount: float = 1):
+        if not self.rate_per_minute:
+            return
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) * 60 / self.rate_per_minute)
+                self._refill()
+            self.tokens -= amount
+
+    def charge(self, amount: float):
+        if not self.rate_per_minute:
+            return
+        self._refill()
+        self.tokens -= amount
+
+
+class StreamingCodeExtractor:
+    """
+    Follow an answer while it streams in and tell when the rest is not needed: the answer
+    starts a line with SKIP before any code block, or the first code block is closed. `code`
+    matches what `extract_code_in_backticks` returns for the complete answer.
+    """
+    # NOTE: the prompt asks to output SKIP, prose mentioning it ("I would not SKIP this") is no skip
+    SKIP_PATTERN = re.compile(r'^\s*SKIP\b', re.M)
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.text = ''
+        self.skip = False
+        self.code: Optional[str] = None
+        self.done = False
+        self._fence = -1
+        self._code_start = -1
+
+    def feed(self, delta: str) -> bool:
+        if self.done or not delta:
+            return self.done
+        # NOTE: rescan a few characters of the previous text, a marker may be split between deltas
+        scan_from = max(len(self.text) - 4, 0)
+        self.text += delta
+
+        if self._code_start < 0:
+            if self._fence < 0:
+                self._fence = self.text.find('```', scan_from)
+                prefix = self.text if self._fence < 0 else self.text[:self._fence]
+                # NOTE: from the start of the line the new text is in, `^` only matches at line starts
+                found = self.SKIP_PATTERN.search(prefix, prefix.rfind('\n', 0, max(scan_from - 4, 0)) + 1)
+                # NOTE: a SKIP at the very end may still grow into another word, e.g. SKIPPING
+                if found is not None and (found.end() < len(prefix) or self._fence >= 0):
+                    self.skip = True
+                    self.done = True
+                    return True
+                if self._fence < 0:
+                    return False
+            header_end = self.text.find('\n', self._fence)
+            if header_end < 0:
+                return False
+            self._code_start = header_end + 1
+            scan_from = self._code_start
+
+        close = self.text.find('```', max(scan_from, self._code_start))
+        if close >= 0:
+            self.code = self.text[self._code_start:close]
+            self.text = self.text[:close + 3]
+            self.done = True
+        return self.done
+
+
+class AsyncLLMClient:
+    """
+    Submit prompts to one provider with a bounded number of requests in flight,
+    paced by token buckets on requests per minute (rpm) and tokens per minute (tpm).
+    """
+
+    def __init__(self, model_name: str, max_in_flight: int = 16, rpm: Optional[float] = None,
+                 tpm: Optional[float] = None, max_tokens: int = 4096, stream: bool = False):
+        if model_name not in PROVIDER_OF_MODEL:
+            raise ValueError(f"Unknown model name: {model_name}")
+        self.model_name = model_name
+        self.provider = PROVIDER_OF_MODEL[model_name]
+        self.max_tokens = max_tokens
+        self.max_in_flight = max_in_flight
+        self.rpm = rpm
+        self.tpm = tpm
+        self.params = SAMPLING_PARAMS[self.provider]
+        self.cache = get_response_cache()
+        self.stream = stream
+
+    async def start(self):
+        # NOTE: asyncio primitives are bound to the running loop
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.request_bucket = TokenBucket(self.rpm)
+        self.token_bucket = TokenBucket(self.tpm)
+        self.paused_until = 0.0
+        self.client = get_async_provider_client(self.provider)
+
+    async def _request(self, prompt: str) -> str:
+        model_id = PROVIDER_MODEL_ID.get(self.model_name, self.model_name)
+        if self.provider in ("openai", "deepseek"):
+            response = await self.client.chat.completions.create(
+                model=model_id,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                temperature=0,
+                max_tokens=self.max_tokens,
+            )
+            return response.choices[0].message.content
+        elif self.provider == "anthropic":
+            response = await self.client.messages.create(
+                model=model_id,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                max_tokens=self.max_tokens,
+            )
+            return response.content[0].text
+        elif self.provider == "gemini":
+            model = self.client.GenerativeModel(model_id)
+            response = await model.generate_content_async(prompt, generation_config={"temperature": 0.0})
+            return response.text
+        raise ValueError(f"Unknown provider: {self.provider}")
+
+    async def _request_stream(self, prompt: str) -> str:
+        """Stream the answer and cancel it as soon as the extractor has what it needs."""
+        model_id = PROVIDER_MODEL_ID.get(self.model_name, self.model_name)
+        extractor = StreamingCodeExtractor()
+        if self.provider in ("openai", "deepseek"):
+            stream = await self.client.chat.completions.create(
+                model=model_id,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                temperature=0,
+                max_tokens=self.max_tokens,
+                stream=True,
+            )
+            try:
+                async for chunk in stream:
+                    if len(chunk.choices) > 0 and extractor.feed(chunk.choices[0].delta.content or ''):
+                        break
+            finally:
+                await stream.close()
+        elif self.provider == "anthropic":
+            async with self.client.messages.stream(
+                model=model_id,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                max_tokens=self.max_tokens,
+            ) as stream:
+                async for text in stream.text_stream:
+                    if extractor.feed(text):
+                        break
+        elif self.provider == "gemini":
+            model = self.client.GenerativeModel(model_id)
+            response = await model.generate_content_async(prompt, generation_config={"temperature": 0.0}, stream=True)
+            async for chunk in response:
+                if extractor.feed(chunk.text):
+                    break
+        else:
+            raise ValueError(f"Unknown provider: {self.provider}")
+        if extractor.done and extractor.skip:
+            logging.info(f"{self.model_name} answered SKIP, cancelled after {len(extractor.text)} characters")
+        return extractor.text
+
+    async def _wait_if_paused(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def prompt(self, prompt: str, max_retries: int = 5) -> LLMResult:
+        if self.cache is not None:
+            res = self.cache.get(self.model_name, prompt, self.params)
+            if res is not None:
+                return self._result(res, 0)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._wait_if_paused()
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(estimate_tokens(prompt))
+            async with self.semaphore:
+                try:
+                    res = await (self._request_stream(prompt) if self.stream else self._request(prompt))
+                    if not res:
+                        raise ValueError("empty response")
+                except Exception as e:
+                    kind = classify_error(e)
+                    logging.error(f"{self.model_name} request failed ({kind}, attempt {attempt}): {str(e)}")
+                    if kind not in RETRYABLE_ERRORS or attempt > max_retries:
+                        return LLMResult(text=None, error_kind=kind, error=str(e), attempts=attempt)
+                    delay = backoff_delay(attempt, retry_after_seconds(e))
+                    if kind == "rate_limit":
+                        # NOTE: hold back every request of this client instead of letting them all hit the limit
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                    res = None
+            if res is None:
+                await asyncio.sleep(delay)
+                continue
+
+            # NOTE: the output tokens are only known afterwards
+            self.token_bucket.charge(estimate_tokens(res))
+            if self.cache is not None:
+                self.cache.put(self.model_name, prompt, self.params, res)
+            return self._result(res, attempt)
+
+    def _result(self, text: str, attempts: int) -> LLMResult:
+        result = LLMResult(text=text, error_kind=None, error=None, attempts=attempts)
+        if self.stream:
+            extractor = StreamingCodeExtractor()
+            extractor.feed(text)
+            result['code'] = extractor.code
+        return result
+
+    async def prompt_all(self, prompts: List[str], on_result: Optional[Callable[[int, LLMResult], None]] = None) -> List[LLMResult]:
+        await self.start()
+
+        async def _run(i: int, prompt: str):
+            res = await self.prompt(prompt)
+            if on_result is not None:
+                on_result(i, res)
+            return res
+
+        return await asyncio.gather(*[_run(i, prompt) for i, prompt in enumerate(prompts)])
+
+
+def prompt_many(model_name: str, prompts: List[str], on_result: Optional[Callable[[int, LLMResult], None]] = None,
+                max_in_flight: int = 16, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                stream: bool = False) -> List[LLMResult]:
+    """
+    Prompt `model_name` with all prompts concurrently, `on_result(index, result)` is called as soon as a result arrives.
+    Rate limits and timeouts are retried with backoff, the other failures are returned with `text=None`.
+    With `stream`, answers are cancelled after SKIP or the first code block, which is returned as `code`.
+    """
+    client = AsyncLLMClient(model_name, max_in_flight=max_in_flight, rpm=rpm, tpm=tpm, stream=stream)
+    results = asyncio.run(client.prompt_all(prompts, on_result))
+    if client.cache is not None:
+        logging.info(f"Response cache: {client.cache.stats()}")
+    failures = Counter(x['error_kind'] for x in results if x['text'] is None)
+    if len(failures) > 0:
+        logging.error(f"Failed requests: {dict(failures)}")
+    return results
 
 
 if __name__ == "__main__":